@@ -0,0 +1,242 @@
+# This script computes randomization-inference p-values for the difference-in-differences estimates of
+# analysis/causal_models.R, as a complement to the placebo regressions p1-p8. The timing of treatment (year_signed or
+# year_operational) is randomly reassigned across deals NUM_DRAWS times, and the DiD model of a3/a6 (treatment,
+# treatment x level_fe, treatment x palm_oil, controls, and deal, year and level fixed effects) is re-estimated for each
+# draw. The p-value of the estimate is the share of draws with an estimate at least as large in absolute value,
+# (1 + #{|b_draw| >= |b|}) / (1 + NUM_DRAWS). Each draw is also evaluated for the placebo timings of p3-p8, i.e. with
+# treatment years shifted by PLACEBO_SHIFTS. Alongside the standard errors clustered by deal, as in causal_models.R,
+# Conley spatial-HAC standard errors are reported, since the tiles of neighbouring deals overlap: observations in the
+# same period are correlated up to CONLEY_CUTOFF_KM between tile centroids, and those of the same tile up to
+# CONLEY_LAG_CUTOFF years apart. If the tiles were exported with a tile plan (TILE_PLAN_PATH, see
+# preprocessing/plan_tiles.py), the tile centroids are read from the plan.
+#
+# By Frisch-Waugh-Lovell, the outcome and controls are demeaned by the fixed effects (and the outcome residualized on
+# the controls) once, so each draw only demeans its few treatment columns and solves a small least-squares problem.
+# Draws are computed in chunks of DRAWS_PER_TASK across NUM_WORKERS processes; results are reproducible for a given
+# SEED and DRAWS_PER_TASK, whatever the number of workers.
+#
+# Reads the master data written by preprocessing/merge_and_validate.R as data/mdta.csv.
+#
+# Usage (from the repository root):
+#     python -m analysis.randomization_inference
+
+
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.fixed_effects import ConleyKernel, PartialledRegression, fe_codes
+from utils.tile_geometry import planned_tile_locations, tile_centroids
+
+
+# ==================== PARAMETERS ======================
+
+DATA_PATH = 'data/mdta.csv'
+OUTPUT_PATH = 'data/robustness/randomization_inference.csv'
+DRAWS_PATH = 'data/robustness/randomization_inference_draws.npz'   # placebo distributions of the estimates
+
+INVESTMENT_TYPES = ['Food', 'Livestock', 'Non-food']   # all agriculture, as in causal_models.R
+TREATMENTS = {'signed': 'year_signed', 'operational': 'year_operational'}   # treatment => year of treatment
+INTERACTIONS = ['palm_oil']                             # deal characteristics interacted with treatment
+CONTROLS = ['area_contracted', 'area_in_operation', 'deal_scope', 'property_rights', 'government_integrity']
+FIXED_EFFECTS = ['deal_id', 'year', 'level']
+CLUSTER = 'deal_id'
+PLACEBO_SHIFTS = [0, 3, 6, 9]    # years by which treatment is brought forward, 0 for the actual timing
+CONLEY_CUTOFF_KM = 50            # None to skip Conley standard errors
+CONLEY_LAG_CUTOFF = 6            # in years, i.e. two periods
+NRINGS = 2                       # as in export_images.py, to locate the tile centroids
+SCALE = 30
+TILE_PLAN_PATH = None            # tile plan from preprocessing/plan_tiles.py, if tiles were exported with it
+
+NUM_DRAWS = 5000
+DRAWS_PER_TASK = 100
+NUM_WORKERS = os.cpu_count() or 1
+SEED = 0
+
+
+# ==================== RANDOMIZATION INFERENCE ======================
+
+def load_sample(data_path: str, treatment_year: str, investment_types: list = INVESTMENT_TYPES) -> pd.DataFrame:
+    """
+    Args:
+        - data_path: Path to the master data CSV
+        - treatment_year: Column with the year of treatment of each deal
+        - investment_types: Investment types to keep, None to keep all deals
+
+    Returns:
+        - df: Observations with no missing values in the columns of the model, as used by lm()
+    """
+    df = pd.read_csv(data_path, low_memory=False)
+    if investment_types is not None:
+        df = df[df['investment_type'].isin(investment_types)]
+    cols = ['assets', 'year', 'level', 'tile_id', 'lat', 'lon', treatment_year, *INTERACTIONS, *CONTROLS,
+            *FIXED_EFFECTS, CLUSTER]
+    return df.dropna(subset=list(dict.fromkeys(cols))).reset_index(drop=True)
+
+
+def tile_locations(df: pd.DataFrame, nrings: int = NRINGS, scale: float = SCALE, tile_plan: pd.DataFrame = None):
+    """
+    Args:
+        - df: Observations with the deal_id, lat and lon of each deal and the tile_id of each tile
+        - nrings, scale: Geometry of the exported tiles
+        - tile_plan: Tile plan from plan_tiles.py, to locate the tiles if they were exported with it
+
+    Returns:
+        - lon, lat: Coordinates of the centroid of the tile of each observation
+    """
+    if tile_plan is not None:
+        lon, lat, _ = planned_tile_locations(tile_plan, df['deal_id'].to_numpy(), df['tile_id'].to_numpy())
+        return lon, lat
+    lon, lat = tile_centroids(df['lon'].to_numpy(), df['lat'].to_numpy(), nrings, scale)
+    rows, tiles = np.arange(len(df)), df['tile_id'].to_numpy(dtype=int)
+    return lon[rows, tiles], lat[rows, tiles]
+
+
+class TimingPermutation:
+    """Re-estimates the DiD coefficient of treatment for reassignments of the
+    treatment years of deals, reusing the fixed-effects projection of the outcome
+    and controls."""
+    def __init__(self, df: pd.DataFrame, treatment_year: str, shifts: list = PLACEBO_SHIFTS,
+                 conley_cutoff_km: float = CONLEY_CUTOFF_KM, conley_lag_cutoff: float = CONLEY_LAG_CUTOFF,
+                 tile_plan: pd.DataFrame = None):
+        """
+        Args:
+            - df: Sample, from load_sample()
+            - treatment_year: Column with the year of treatment of each deal
+            - shifts: Years by which treatment is brought forward for each placebo
+            - conley_cutoff_km, conley_lag_cutoff: Cutoffs of the Conley standard errors, None to skip them
+            - tile_plan: Tile plan from plan_tiles.py, to locate the tiles if they were exported with it
+        """
+        W = pd.get_dummies(df[CONTROLS], drop_first=True, dtype=np.float64)
+        self.model = PartialledRegression(df['assets'].to_numpy(), W.to_numpy(), fe_codes(df, FIXED_EFFECTS),
+                                          control_names=list(W.columns))
+        self.deal_codes, _ = pd.factorize(df['deal_id'])
+        self.deal_years = df.groupby(self.deal_codes)[treatment_year].first().to_numpy(dtype=np.float64)
+        self.year = df['year'].to_numpy(dtype=np.float64)
+        self.shifts = list(shifts)
+
+        # treatment is interacted with every level of level_fe but the first, and with INTERACTIONS
+        levels = np.sort(df['level'].unique())
+        self.moderators = np.stack(
+            [(df['level'].to_numpy() == level).astype(np.float64) for level in levels[1:]]
+            + [df[col].to_numpy(dtype=np.float64) for col in INTERACTIONS], axis=1)
+        self.treatment_names = ['treatment'] + [f'treatment:level_fe{level}' for level in levels[1:]] \
+            + [f'treatment:{col}' for col in INTERACTIONS]
+        self.clusters = df[CLUSTER].to_numpy()
+
+        self.conley = None
+        if conley_cutoff_km is not None:
+            lon, lat = tile_locations(df, tile_plan=tile_plan)
+            units = df['deal_id'].astype(str) + '_' + df['tile_id'].astype(str)
+            self.conley = ConleyKernel(lon, lat, df['year'].to_numpy(), conley_cutoff_km,
+                                       units=units.to_numpy(), lag_cutoff=conley_lag_cutoff)
+
+    def treatment_columns(self, deal_years: np.ndarray, shift: int = 0) -> np.ndarray:
+        """
+        Args:
+            - deal_years: Year of treatment of each deal, in the order of the deal codes
+            - shift: Years by which treatment is brought forward
+
+        Returns:
+            - T: Treatment indicator and its interactions, shape [N, J]
+        """
+        treated = (self.year >= deal_years[self.deal_codes] - shift).astype(np.float64)
+        return np.concatenate([treated[:, None], treated[:, None] * self.moderators], axis=1)
+
+    def estimates(self, deal_years: np.ndarray) -> np.ndarray:
+        """
+        Returns:
+            - Coefficient of the treatment indicator for each shift, shape [S]
+        """
+        return np.array([self.model.fit(self.treatment_columns(deal_years, shift))[0] for shift in self.shifts])
+
+    def draw(self, num_draws: int, seed) -> np.ndarray:
+        """
+        Args:
+            - num_draws: Number of random reassignments of treatment years across deals
+            - seed: Seed of the random reassignments
+
+        Returns:
+            - Coefficient of the treatment indicator for each draw and shift, shape [num_draws, S]
+        """
+        rng = np.random.default_rng(seed)
+        return np.stack([self.estimates(rng.permutation(self.deal_years)) for _ in range(num_draws)])
+
+    def observed(self) -> pd.DataFrame:
+        """
+        Returns:
+            - DataFrame with the estimate and clustered (and Conley) standard errors of treatment for each shift
+        """
+        rows = []
+        for shift in self.shifts:
+            fit = self.model.fit_full(self.treatment_columns(self.deal_years, shift), self.treatment_names,
+                                      clusters=self.clusters, conley=self.conley)
+            rows.append({'shift': shift, **fit.loc['treatment'].to_dict()})
+        return pd.DataFrame(rows)
+
+
+_PERMUTATION = None
+
+
+def _init_worker(permutation: TimingPermutation):
+    global _PERMUTATION
+    _PERMUTATION = permutation
+
+
+def _draw_chunk(args: tuple) -> np.ndarray:
+    num_draws, seed = args
+    return _PERMUTATION.draw(num_draws, seed)
+
+
+def randomization_inference(permutation: TimingPermutation, num_draws: int = NUM_DRAWS,
+                            draws_per_task: int = DRAWS_PER_TASK, num_workers: int = NUM_WORKERS, seed: int = SEED):
+    """
+    Args:
+        - permutation: Model of the treatment to permute
+        - num_draws: Number of random reassignments of treatment years
+        - draws_per_task: Number of draws per task sent to a worker
+        - num_workers: Number of worker processes
+        - seed: Seed of the random reassignments
+
+    Returns:
+        - summary: DataFrame with the estimate, standard errors and randomization p-value for each shift
+        - draws: Coefficient of treatment for each draw and shift, shape [num_draws, S]
+    """
+    sizes = [min(draws_per_task, num_draws - i) for i in range(0, num_draws, draws_per_task)]
+    tasks = list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+    if num_workers <= 1:
+        _init_worker(permutation)
+        chunks = [_draw_chunk(task) for task in tasks]
+    else:
+        with multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_worker,
+                                                       initargs=(permutation,)) as pool:
+            chunks = pool.map(_draw_chunk, tasks)
+    draws = np.concatenate(chunks)
+
+    summary = permutation.observed()
+    extreme = np.abs(draws) >= np.abs(summary['estimate'].to_numpy())[None, :] - 1e-12
+    summary['p_value'] = (1 + extreme.sum(axis=0)) / (1 + num_draws)
+    summary['num_draws'] = num_draws
+    return summary, draws
+
+
+# ==================== RUN =====================
+
+if __name__ == '__main__':
+    summaries = []
+    draws = {}
+    tile_plan = pd.read_csv(TILE_PLAN_PATH) if TILE_PLAN_PATH is not None else None
+    for treatment, treatment_year in TREATMENTS.items():
+        sample = load_sample(DATA_PATH, treatment_year)
+        permutation = TimingPermutation(sample, treatment_year, PLACEBO_SHIFTS, tile_plan=tile_plan)
+        print(f'{treatment}: {len(sample)} observations, {len(permutation.deal_years)} deals, {NUM_DRAWS} draws')
+        summary, draws[treatment] = randomization_inference(permutation)
+        summaries.append(summary.assign(treatment=treatment))
+        print(summary)
+
+    os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+    pd.concat(summaries, ignore_index=True).to_csv(OUTPUT_PATH, index=False)
+    np.savez(DRAWS_PATH, shifts=np.asarray(PLACEBO_SHIFTS), **draws)
+    print(f'Saved randomization inference results to {OUTPUT_PATH} and placebo distributions to {DRAWS_PATH}')
@@ -0,0 +1,103 @@
+# This script benchmarks the client-side construction of Earth Engine export graphs in preprocessing/export_images.py
+# offline, using the test double in utils/ee_fake.py instead of the real `ee` module (so no network access or Earth
+# Engine credentials are needed, and no tasks are started). For each export mode, it reports the time taken, the
+# number of tasks and the number of ee nodes built, with the memoized Landsat collections in ee_utils.LandsatSR and
+# with the memoization disabled (i.e. rebuilding every collection for every LandsatSR instance, as before).
+#
+# Usage (from the repository root):
+#     python -m benchmarks.benchmark_ee_graph
+
+
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils import ee_fake
+ee_fake.install()
+
+from preprocessing import export_images  # noqa: E402 (must be imported after installing the fake)
+from utils import ee_utils  # noqa: E402
+
+
+# ==================== PARAMETERS ======================
+
+NUM_DEALS = 200
+START_YEAR = 1985
+END_YEAR = 2021
+MOSAIC_PERIOD = 3
+NRINGS = 2
+DEALS_PER_TASK = 20
+OUTPUT_PATH = 'bench_ee_graph.json'
+
+
+# ==================== BENCHMARK ======================
+
+def synthetic_deals(num_deals: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'deal_id': np.arange(1000, 1000 + num_deals),
+        'lat': rng.uniform(-30, 15, num_deals),
+        'lon': rng.uniform(-15, 40, num_deals),
+    })
+
+
+def time_export(fn, memoize: bool, **kwargs) -> dict:
+    """
+    Times fn(**kwargs) and counts the ee nodes it builds, optionally clearing the
+    memoized Landsat collections before every LandsatSR instance is created.
+    """
+    init = ee_utils.LandsatSR.__init__
+
+    def uncached_init(self, *args, **init_kwargs):
+        ee_utils.LandsatSR.collection.cache_clear()
+        init(self, *args, **init_kwargs)
+
+    if not memoize:
+        ee_utils.LandsatSR.__init__ = uncached_init
+    try:
+        ee_utils.LandsatSR.collection.cache_clear()
+        ee_fake.reset()
+        start = time.perf_counter()
+        tasks = fn(**kwargs)
+        seconds = time.perf_counter() - start
+    finally:
+        ee_utils.LandsatSR.__init__ = init
+    return {
+        'memoize': memoize,
+        'num_tasks': len(tasks),
+        'num_nodes': ee_fake.node_count(),
+        'nodes_per_task': ee_fake.node_count() / max(len(tasks), 1),
+        'seconds': seconds,
+    }
+
+
+def main() -> None:
+    df = synthetic_deals(NUM_DEALS)
+    common = dict(df=df, start_year=START_YEAR, end_year=END_YEAR, export_folder='bench',
+                  n=NRINGS, mosaic_period=MOSAIC_PERIOD)
+
+    results = []
+    for memoize in [False, True]:
+        result = time_export(export_images.export_images, memoize, **common)
+        results.append(dict(result, mode='per_deal'))
+        print(json.dumps(results[-1]))
+    for memoize in [False, True]:
+        result = time_export(export_images.export_images_batched, memoize,
+                             deals_per_task=DEALS_PER_TASK, **common)
+        results.append(dict(result, mode='batched'))
+        print(json.dumps(results[-1]))
+
+    report = {
+        'params': {'num_deals': NUM_DEALS, 'start_year': START_YEAR, 'end_year': END_YEAR,
+                   'mosaic_period': MOSAIC_PERIOD, 'nrings': NRINGS, 'deals_per_task': DEALS_PER_TASK},
+        'results': results,
+    }
+    with open(OUTPUT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved benchmark results to {OUTPUT_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# This script benchmarks each stage of the tile processing and inference pipeline on synthetic data, so that
+# throughput can be tracked between commits without Earth Engine exports or model checkpoints. It generates raw
+# TFRecords shaped like the Earth Engine exports (9 bands of 255x255 pixels, 25 tiles per deal and period) in a
+# temporary directory, then times the following stages, each in a freshly spawned process so that peak memory is
+# measured per stage:
+#
+#   1. process_tfrecords:  splitting raw exports into per-tile TFRecords (preprocessing/process_tfrecords.py)
+#   2. batcher:            decoding tiles with Batcher for rgb/ms bands, with and without normalization and caching
+#   3. resnet_forward:     a forward pass of Hyperspectral_Resnet on the CPU (randomly initialized weights)
+#   4. predict_assets:     applying ridge weights to extracted features (preprocessing/predict_assets.py)
+#   5. predict_dataframe:  building the asset predictions table (build_dataframe() in preprocessing/predict_assets.py);
+#                          the panel itself is built by merge_and_validate.R, which is not benchmarked here
+#
+# Results (records/sec, MB/sec and peak RSS for each stage) are printed and saved as JSON.
+#
+# Usage (from the repository root):
+#     python -m benchmarks.benchmark_pipeline
+
+
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+
+# ==================== PARAMETERS ======================
+
+NUM_DEALS = 4                       # number of synthetic deals
+YEARS = [1985, 1988]                # synthetic mosaic periods
+NRINGS = 2                          # 25 tiles per deal and period
+BATCH_SIZE = 32
+RESNET_LAYERS = 18
+RESNET_BATCHES = 5                  # number of batches for the CNN forward pass benchmark
+NUM_PREDICT_TILES = 100000          # number of tiles for predict_assets and predict_dataframe benchmarks
+NUM_THREADS = 4
+OUTPUT_PATH = 'bench_output.json'
+
+RAW_FEATURES = ['BLUE', 'GREEN', 'LAT', 'LON', 'NIR', 'RED', 'SWIR1', 'SWIR2', 'TEMP1']
+TILE_SIZE = 255
+CROP_SIZE = 224                     # tiles are center-cropped by the Batcher
+
+
+# ==================== SYNTHETIC DATA ======================
+
+def make_raw_example(rng: np.random.Generator, lat: float, lon: float):
+    """
+    Creates a tf.train.Example shaped like a single Earth Engine image patch.
+    """
+    import tensorflow as tf
+
+    bands = {}
+    for band in RAW_FEATURES:
+        if band == 'TEMP1':
+            values = rng.uniform(290, 310, TILE_SIZE ** 2)
+        elif band == 'LAT':
+            values = np.repeat(lat + np.linspace(0.035, -0.035, TILE_SIZE), TILE_SIZE)
+        elif band == 'LON':
+            values = np.tile(lon + np.linspace(-0.035, 0.035, TILE_SIZE), TILE_SIZE)
+        else:
+            values = rng.uniform(0, 0.4, TILE_SIZE ** 2)
+        bands[band] = tf.train.Feature(float_list=tf.train.FloatList(value=values.astype(np.float32)))
+    return tf.train.Example(features=tf.train.Features(feature=bands))
+
+
+def generate_raw_tfrecords(raw_dir: str, csv_path: str, num_deals: int, years: list, nrings: int,
+                           seed: int = 0) -> int:
+    """
+    Writes one raw TFRecord per (deal_id, year) named '{deal_id}_{year}.tfrecord', each with (2*nrings+1)^2 tiles,
+    and a CSV of deal locations in the format of data/intermediate/earthengine_locs.csv.
+
+    Returns:
+    - total size of the raw TFRecords in bytes
+    """
+    import tensorflow as tf
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(raw_dir, exist_ok=True)
+    deal_ids = list(range(1000, 1000 + num_deals))
+    lats = rng.uniform(-30, 15, num_deals)
+    lons = rng.uniform(-15, 40, num_deals)
+    pd.DataFrame({'deal_id': deal_ids, 'lat': lats, 'lon': lons}).to_csv(csv_path, index=False)
+
+    num_tiles = (2 * nrings + 1) ** 2
+    for deal_id, lat, lon in zip(deal_ids, lats, lons):
+        for year in years:
+            with tf.io.TFRecordWriter(os.path.join(raw_dir, f'{deal_id}_{year}.tfrecord')) as writer:
+                for _ in range(num_tiles):
+                    writer.write(make_raw_example(rng, lat, lon).SerializeToString())
+    return dir_size(raw_dir)
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in glob(os.path.join(path, '**', '*'), recursive=True) if os.path.isfile(p))
+
+
+# ==================== STAGES ======================
+# Each stage returns a dict with the number of records and bytes it processed and the time taken (in seconds),
+# excluding any setup such as building the TensorFlow graph.
+
+def stage_process_tfrecords(raw_dir: str, csv_path: str, processed_dir: str) -> dict:
+    import tensorflow as tf
+    if hasattr(tf, 'enable_eager_execution') and not tf.executing_eagerly():
+        tf.enable_eager_execution()  # process_tfrecords iterates over datasets eagerly
+    from preprocessing.process_tfrecords import process_tfrecords
+
+    start = time.perf_counter()
+    process_tfrecords(csv_path=csv_path, input_dir=raw_dir, processed_dir=processed_dir)
+    seconds = time.perf_counter() - start
+    num_records = len(glob(os.path.join(processed_dir, '*', '*.tfrecord.gz')))
+    return {'records': num_records, 'bytes': dir_size(raw_dir), 'seconds': seconds}
+
+
+def stage_batcher(processed_dir: str, ls_bands: str, normalize: str, cache: bool) -> dict:
+    import tensorflow as tf
+    from utils.batcher import Batcher
+
+    paths = sorted(glob(os.path.join(processed_dir, '*', '*.tfrecord.gz')))
+    epochs = 2 if cache else 1  # caching only pays off from the 2nd epoch on
+    paths_ph = tf.placeholder(tf.string, shape=[len(paths)])
+    b = Batcher(tfrecord_files=paths_ph, label_name='wealthpooled', ls_bands=ls_bands, nl_band=None,
+                batch_size=BATCH_SIZE, epochs=epochs, normalize=normalize, shuffle=False, augment=False,
+                clipneg=True, cache=cache, num_threads=NUM_THREADS)
+    init_iter, batch_op = b.get_batch()
+
+    num_records = 0
+    with tf.Session() as sess:
+        sess.run(init_iter, feed_dict={paths_ph: paths})
+        start = time.perf_counter()
+        try:
+            while True:
+                num_records += len(sess.run(batch_op['labels']))
+        except tf.errors.OutOfRangeError:
+            pass
+        seconds = time.perf_counter() - start
+    num_bands = 3 if ls_bands == 'rgb' else 7
+    image_size = CROP_SIZE if b.crop else TILE_SIZE   # size of the images fed to the CNN
+    return {'records': num_records, 'bytes': num_records * num_bands * image_size ** 2 * 4, 'seconds': seconds}
+
+
+def stage_resnet_forward() -> dict:
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import tensorflow as tf
+    from models.resnet_model import Hyperspectral_Resnet
+
+    images = tf.placeholder(tf.float32, shape=[None, CROP_SIZE, CROP_SIZE, 7])
+    model = Hyperspectral_Resnet(images, num_outputs=1, is_training=False, num_layers=RESNET_LAYERS)
+    batch = np.random.default_rng(0).standard_normal((BATCH_SIZE, CROP_SIZE, CROP_SIZE, 7)).astype(np.float32)
+
+    config_proto = tf.ConfigProto(intra_op_parallelism_threads=NUM_THREADS, device_count={'GPU': 0})
+    with tf.Session(config=config_proto) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(model.features_layer, feed_dict={images: batch})  # warm-up
+        start = time.perf_counter()
+        for _ in range(RESNET_BATCHES):
+            sess.run([model.features_layer, model.outputs], feed_dict={images: batch})
+        seconds = time.perf_counter() - start
+    num_records = RESNET_BATCHES * BATCH_SIZE
+    return {'records': num_records, 'bytes': num_records * batch[0].nbytes, 'seconds': seconds}
+
+
+def _synthetic_predictions_inputs(num_tiles: int):
+    from preprocessing.predict_assets import MODEL_FOLDS
+
+    rng = np.random.default_rng(0)
+    deal_ids = 1000 + np.arange(num_tiles) // 25
+    labels = (deal_ids * 1000 + np.arange(num_tiles) % 25).astype(np.float32)
+    years = np.full(num_tiles, 1985, dtype=np.int32)
+    features_dict = {fold: rng.random((num_tiles, 512), dtype=np.float32) for fold in MODEL_FOLDS}
+    weights_dict = {}
+    for fold in MODEL_FOLDS:
+        weights_dict[f'{fold}_w'] = rng.standard_normal(512).astype(np.float32)
+        weights_dict[f'{fold}_b'] = rng.standard_normal(1).astype(np.float32)
+    labels_dict = {fold: labels for fold in MODEL_FOLDS}
+    years_dict = {fold: years for fold in MODEL_FOLDS}
+    return features_dict, weights_dict, labels_dict, years_dict
+
+
+def stage_predict_assets(num_tiles: int) -> dict:
+    from preprocessing.predict_assets import predict_assets
+
+    features_dict, weights_dict, labels_dict, years_dict = _synthetic_predictions_inputs(num_tiles)
+    start = time.perf_counter()
+    predict_assets(features_dict, weights_dict, labels_dict, years_dict)
+    seconds = time.perf_counter() - start
+    return {'records': num_tiles, 'bytes': sum(f.nbytes for f in features_dict.values()), 'seconds': seconds}
+
+
+def stage_predict_dataframe(num_tiles: int) -> dict:
+    from preprocessing.predict_assets import build_dataframe
+
+    deal_ids = 1000 + np.arange(num_tiles) // 25
+    tile_ids = [f'{d}{i % 25:03d}' for i, d in enumerate(deal_ids)]
+    assets = np.random.default_rng(0).standard_normal(num_tiles).tolist()
+    years = [1985] * num_tiles
+    start = time.perf_counter()
+    dataframe = build_dataframe(assets, tile_ids, years, NRINGS)
+    seconds = time.perf_counter() - start
+    return {'records': num_tiles, 'bytes': int(dataframe.memory_usage(deep=True).sum()), 'seconds': seconds}
+
+
+# ==================== HARNESS ======================
+
+def _run_in_child(conn, fn, args) -> None:
+    try:
+        result = fn(*args)
+        # ru_maxrss is in kilobytes on Linux
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        conn.send(result)
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    finally:
+        conn.close()
+
+
+def run_stage(name: str, fn, *args) -> dict:
+    """
+    Runs a stage in a freshly spawned process and summarizes its throughput.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe()
+    p = ctx.Process(target=_run_in_child, args=(child_conn, fn, args))
+    p.start()
+    result = parent_conn.recv()
+    p.join()
+
+    if 'error' not in result:
+        seconds = max(result['seconds'], 1e-9)
+        result['records_per_sec'] = result['records'] / seconds
+        result['mb_per_sec'] = result['bytes'] / 2**20 / seconds
+    result['stage'] = name
+    print(json.dumps(result))
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main() -> None:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = os.path.join(tmp_dir, 'tfrecords_raw')
+        processed_dir = os.path.join(tmp_dir, 'tfrecords')
+        csv_path = os.path.join(tmp_dir, 'earthengine_locs.csv')
+
+        print('Generating synthetic raw TFRecords...')
+        raw_bytes = generate_raw_tfrecords(raw_dir, csv_path, NUM_DEALS, YEARS, NRINGS)
+        print(f'Generated {raw_bytes / 2**20:.1f} MB of raw TFRecords')
+
+        results.append(run_stage('process_tfrecords', stage_process_tfrecords, raw_dir, csv_path, processed_dir))
+        for ls_bands in ['rgb', 'ms']:
+            for normalize in [None, 'DHS']:
+                for cache in [False, True]:
+                    name = f'batcher[{ls_bands},normalize={normalize},cache={cache}]'
+                    results.append(run_stage(name, stage_batcher, processed_dir, ls_bands, normalize, cache))
+        results.append(run_stage('resnet_forward', stage_resnet_forward))
+        results.append(run_stage('predict_assets', stage_predict_assets, NUM_PREDICT_TILES))
+        results.append(run_stage('predict_dataframe', stage_predict_dataframe, NUM_PREDICT_TILES))
+
+    report = {
+        'commit': git_commit(),
+        'params': {'num_deals': NUM_DEALS, 'years': YEARS, 'nrings': NRINGS, 'batch_size': BATCH_SIZE,
+                   'resnet_layers': RESNET_LAYERS, 'num_threads': NUM_THREADS},
+        'stages': results,
+    }
+    with open(OUTPUT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved benchmark results to {OUTPUT_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,7 @@ from __future__ import annotations
 
 from collections import defaultdict
 from collections.abc import Callable, Iterable
+from functools import partial
 from glob import glob
 import json
 import os
@@ -27,8 +28,14 @@ import numpy as np
 import tensorflow as tf
 
 from utils import batcher, tfrecord_paths_utils
+from utils.dataset_constants import load_band_stats
 from models.resnet_model import Hyperspectral_Resnet
+from utils.instrumentation import log_filename
+from utils.mosaic import TILE_FILENAME_RE, check_pooling_equivalence, group_tile_paths
+from utils.parallel import (
+    merge_shards, pin_to_cpus, run_workers, shard_filename, shard_indices, worker_cpus)
 from utils.run import check_existing, run_extraction_on_models
+from utils.tile_shards import load_shard_index, select_shards
 
 
 OUTPUTS_ROOT_DIR = 'outputs'
@@ -46,6 +53,68 @@ IS_TRAINING = False
 # only if you have enough RAM (>= 300 GB)
 CACHE = False
 
+# BLOCK numbers (not LAYER numbers) whose average-pooled outputs should also be
+# saved to features.npz, e.g. [2, 4, 6] for ResNet-18. Set to None to only save
+# the final features layer.
+BLOCKS_TO_SAVE: Optional[list[int]] = None
+
+# set SAVE_SPATIAL = True to also save the non-pooled 7x7x512 final conv layer of
+# each tile (as float16, ~50KB per tile) to a spatial_features/ directory next to
+# features.npz, see utils/spatial_features.py
+SAVE_SPATIAL = False
+
+# set TTA = True to average every output over the 8 dihedral flips/rotations of
+# each tile, computed in a single forward pass (~8x the CNN compute per tile)
+TTA = False
+
+# set MOSAIC = True to run the CNN once over each whole (2*NRINGS+1)^2-tile mosaic
+# instead of over each 224x224 tile crop, pooling per-tile features from the
+# shared feature map (see utils/mosaic.py). Before extracting, the pooling is
+# checked against the per-tile path on a synthetic mosaic, within a relative
+# difference of MOSAIC_RTOL (see utils.mosaic.check_pooling_equivalence()).
+# Features are saved to features_mosaic.npz, which can be validated against
+# features.npz with utils.mosaic.compare_extractions(). Mosaics cannot be assembled from tiles
+# exported with a tile plan (preprocessing/plan_tiles.py), which only exports the
+# canonical tile of each grid cell: set TILE_PLAN_PATH to the plan used by
+# preprocessing/export_images.py, if any, so that MOSAIC is rejected with it.
+MOSAIC = False
+NRINGS = 2
+TILE_PLAN_PATH: Optional[str] = None
+MOSAIC_RTOL = 0.05
+MOSAIC_BATCH_SIZE = max(1, BATCH_SIZE // 32)  # a 1275x1275 mosaic has ~32x the pixels of a tile
+SAVE_FILENAME = 'features_mosaic.npz' if MOSAIC else 'features.npz'
+
+# set INSTRUMENT = True to record the latency of every batch and tf.data
+# statistics of the input pipeline to features_log.json next to features.npz, to
+# tell whether extraction is bound by I/O, parsing or compute. Set TRACE_BATCHES
+# to (start, end) to also save TF profiler traces (viewable in chrome://tracing)
+# of those batches to a traces/ directory.
+INSTRUMENT = False
+TRACE_BATCHES: Optional[tuple[int, int]] = None
+
+# band statistics used to normalize images. The checkpoints below were trained on
+# images normalized with the 'DHS' statistics, so only change this for models
+# trained or fine-tuned with other statistics. Set BAND_STATS_PATH to a JSON file
+# written by preprocessing/compute_band_stats.py to normalize with statistics
+# computed over our own tiles (registered under the name saved in the file).
+NORMALIZE = 'DHS'
+BAND_STATS_PATH: Optional[str] = None
+
+# how image bands are stored in the tiles, must match BAND_ENCODING in
+# preprocessing/process_tfrecords.py: 'float' (float_list) or 'bytes' (raw float32)
+BAND_ENCODING = 'float'
+
+# set SHARD_DIR to the SHARD_DIR of preprocessing/process_tfrecords.py to read
+# tiles from multi-tile shards (listed in its shard_index.csv) instead of from
+# the per-tile TFRecords in INPUTS_DIR
+SHARD_DIR: Optional[str] = None
+
+# incremental update: set NEW_PERIODS to the start years of newly added periods
+# (e.g. [2022]) to only extract features for their tiles and append them to the
+# existing SAVE_FILENAME, replacing any existing rows for those years. Set to
+# None to extract features for all tiles into a new SAVE_FILENAME.
+NEW_PERIODS: Optional[list[int]] = None
+
 MULTISPECTRAL_MODELS: list[str] = [
     # Paths to checkpoints for in-country multi-spectral models from Yeh et al. (2020)
     'ms_incountry/DHS_Incountry_A_ms_samescaled_b64_fc01_conv01_lr001',
@@ -58,6 +127,15 @@ MULTISPECTRAL_MODELS: list[str] = [
 # choose which GPU to run on
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
+# data-parallel CPU extraction: set NUM_WORKERS > 1 and/or NUM_NODES > 1 to split
+# the tiles into NUM_WORKERS * NUM_NODES disjoint shards, each extracted by its
+# own CPU-pinned worker process. Run this script once on each node (all nodes
+# must share OUTPUTS_ROOT_DIR and INPUTS_DIR) with its own NODE_RANK; node 0
+# merges the shards into SAVE_FILENAME once all of them are written.
+NUM_WORKERS = 1
+NUM_NODES = 1
+NODE_RANK = 0
+
 MODEL_PARAMS = {
     'fc_reg': 5e-3,  # this doesn't actually matter
     'conv_reg': 5e-3,  # this doesn't actually matter
@@ -81,7 +159,14 @@ def get_model_class(model_arch: str) -> Callable:
 
 
 def get_batcher(tfrecord_dir: str, ls_bands: str, nl_band: str, num_epochs: int,
-                cache: bool) -> tuple[batcher.Batcher, int, dict]:
+                cache: bool, mosaic: bool = False,
+                shard: Optional[tuple[int, int]] = None,
+                num_threads: int = 5, instrument: bool = False,
+                normalize: Optional[str] = 'DHS',
+                years: Optional[Iterable[int]] = None,
+                band_encoding: str = 'float',
+                shard_dir: Optional[str] = None
+                ) -> tuple[batcher.Batcher, int, dict]:
     """
     Gets the batcher for a given dataset.
     Args
@@ -90,35 +175,92 @@ def get_batcher(tfrecord_dir: str, ls_bands: str, nl_band: str, num_epochs: int,
     - nl_band: one of [None, 'merge', 'split']
     - num_epochs: int
     - cache: bool, whether to cache the dataset in memory if num_epochs > 1
+    - mosaic: bool, whether to batch whole mosaics with a MosaicBatcher
+    - shard: tuple (index, num_shards), to only read the index-th of num_shards
+        disjoint, contiguous shards of the (sorted) tiles, or None to read all tiles
+    - num_threads: int, number of threads for parallel reads and parsing
+    - instrument: bool, whether to record tf.data statistics
+    - normalize: str, key of MEANS_DICT to normalize with, or None
+    - years: list of int, only read tiles for these years, or None to read all tiles
+    - band_encoding: str, one of ['float', 'bytes'], how bands are stored in the tiles
+    - shard_dir: str, directory of multi-tile shards to read instead of the
+        per-tile TFRecords in tfrecord_dir, or None. Shards are never split, so
+        `shard` partitions whole shard files between workers.
     Returns
     - b: Batcher
-    - size: int, length of dataset
+    - size: int, length of dataset (number of mosaics if mosaic=True)
     - feed_dict: dict, feed_dict for initializing the dataset iterator
     """
-    tfrecord_paths = glob(os.path.join(tfrecord_dir, '*', '*.tfrecord.gz'))
+    grid_width = 2 * NRINGS + 1
+    files_per_item = grid_width ** 2 if mosaic else 1  # tiles per item
+
+    if shard_dir is not None:
+        tfrecord_paths, num_records = select_shards(
+            load_shard_index(shard_dir), years=years,
+            group_size=grid_width ** 2 if mosaic else None)
+        if shard is not None:
+            # shard whole shard files, which only contain whole mosaics
+            files = shard_indices(len(tfrecord_paths), shard[1])[shard[0]]
+            tfrecord_paths = [tfrecord_paths[i] for i in files]
+            num_records = num_records[files]
+        size = int(num_records.sum()) // files_per_item
+    else:
+        tfrecord_paths = sorted(glob(os.path.join(tfrecord_dir, '*', '*.tfrecord.gz')))
+        if years is not None:
+            years = set(years)
+            tfrecord_paths = [
+                path for path in tfrecord_paths
+                if int(TILE_FILENAME_RE.match(os.path.basename(path)).group(2)) in years]
+        if mosaic:
+            tfrecord_paths = group_tile_paths(tfrecord_paths, grid_width=grid_width)
+
+        size = len(tfrecord_paths) // files_per_item
+        if shard is not None:
+            # shard whole items (tiles or mosaics) so that no mosaic is split across shards
+            items = shard_indices(size, shard[1])[shard[0]]
+            size = len(items)
+            if size > 0:
+                tfrecord_paths = tfrecord_paths[items[0] * files_per_item:(items[-1] + 1) * files_per_item]
+            else:
+                tfrecord_paths = []
+
+    if mosaic:
+        BatcherClass = partial(batcher.MosaicBatcher, grid_width=grid_width)
+        batch_size = MOSAIC_BATCH_SIZE
+    else:
+        BatcherClass = batcher.Batcher
+        batch_size = BATCH_SIZE
 
-    size = len(tfrecord_paths)
-    tfrecord_paths_ph = tf.placeholder(tf.string, shape=[size])
+    tfrecord_paths_ph = tf.placeholder(tf.string, shape=[len(tfrecord_paths)])
     feed_dict = {tfrecord_paths_ph: tfrecord_paths}
 
-    b = batcher.Batcher(
+    b = BatcherClass(
         tfrecord_files=tfrecord_paths_ph,
         label_name='wealthpooled',
         ls_bands=ls_bands,
         nl_band=nl_band,
         nl_label=None,
-        batch_size=BATCH_SIZE,
+        batch_size=batch_size,
         epochs=num_epochs,
-        normalize='DHS',
+        normalize=normalize,
         shuffle=False,
         augment=False,
         clipneg=True,
         cache=(num_epochs > 1) and cache,
-        num_threads=5)
+        num_threads=num_threads,
+        instrument=instrument,
+        band_encoding=band_encoding)
 
     return b, size, feed_dict
 
 
+def get_normalize() -> str:
+    """Gets the normalization key, registering the statistics at BAND_STATS_PATH if set."""
+    if BAND_STATS_PATH is not None:
+        return load_band_stats(BAND_STATS_PATH)
+    return NORMALIZE
+
+
 def read_params_json(model_dir: str, keys: Iterable[str]) -> tuple:
     """
     Reads requested keys from json file at `model_dir/params.json`.
@@ -137,11 +279,81 @@ def read_params_json(model_dir: str, keys: Iterable[str]) -> tuple:
     return result
 
 
+def extract_shard(shard: int, num_shards: int, worker: int,
+                  model_dirs: list[str], config: tuple) -> None:
+    """
+    Runs feature extraction for one shard of the tiles on the CPU, in a worker
+    process pinned to its own subset of this node's CPUs. Shards that were
+    already written (e.g. by an earlier, interrupted run) are skipped.
+    Args
+    - shard: int, index of the shard in [0, num_shards)
+    - num_shards: int, total number of shards across all nodes
+    - worker: int, index of this worker on the node in [0, NUM_WORKERS)
+    - model_dirs: list of str, model directories within OUTPUTS_ROOT_DIR
+    - config: tuple (dataset, ls_bands, nl_band, model_arch)
+    """
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    cpus = worker_cpus(worker, NUM_WORKERS)
+    pin_to_cpus(cpus)
+
+    shard_name = shard_filename(SAVE_FILENAME, shard, num_shards)
+    model_dirs = [
+        model_dir for model_dir in model_dirs
+        if not os.path.exists(os.path.join(OUTPUTS_ROOT_DIR, model_dir, shard_name))]
+    if len(model_dirs) == 0:
+        return
+
+    _, ls_bands, nl_band, model_arch = config
+    b, size, feed_dict = get_batcher(
+        tfrecord_dir=INPUTS_DIR, ls_bands=ls_bands, nl_band=nl_band,
+        num_epochs=len(model_dirs), cache=CACHE, mosaic=MOSAIC,
+        shard=(shard, num_shards), num_threads=len(cpus), instrument=INSTRUMENT,
+        normalize=get_normalize(), band_encoding=BAND_ENCODING, shard_dir=SHARD_DIR)
+    print(f'Shard {shard}/{num_shards}: {size} items on CPUs {cpus}')
+
+    config_proto = tf.ConfigProto(
+        intra_op_parallelism_threads=len(cpus),
+        inter_op_parallelism_threads=2,
+        device_count={'GPU': 0})
+
+    # write under a temporary name, then rename, so that other nodes never
+    # merge a partially written shard
+    tmp_name = 'partial-' + shard_name
+    run_extraction_on_models(
+        model_dirs,
+        ModelClass=get_model_class(model_arch),
+        model_params=MODEL_PARAMS,
+        batcher=b,
+        batches_per_epoch=int(np.ceil(size / b.batch_size)),
+        out_root_dir=OUTPUTS_ROOT_DIR,
+        save_filename=tmp_name,
+        batch_keys=['labels', 'locs', 'years'],
+        feed_dict=feed_dict,
+        blocks_to_save=BLOCKS_TO_SAVE,
+        tta=TTA,
+        mosaic_grid_width=(2 * NRINGS + 1) if MOSAIC else None,
+        config_proto=config_proto,
+        instrument=INSTRUMENT,
+        trace_batches=TRACE_BATCHES)
+    for model_dir in model_dirs:
+        out_dir = os.path.join(OUTPUTS_ROOT_DIR, model_dir)
+        if INSTRUMENT:
+            os.replace(os.path.join(out_dir, log_filename(tmp_name)),
+                       os.path.join(out_dir, log_filename(shard_name)))
+        os.replace(os.path.join(out_dir, tmp_name), os.path.join(out_dir, shard_name))
+
+
 def main() -> None:
+    if MOSAIC and TILE_PLAN_PATH is not None:
+        raise ValueError('MOSAIC is not supported with TILE_PLAN_PATH: deals whose tiles are shared with other deals '
+                         'are missing the non-canonical tiles of their mosaics')
+    if MOSAIC:
+        check_pooling_equivalence(grid_width=2 * NRINGS + 1, rtol=MOSAIC_RTOL)
+
     for model_dirs in [MULTISPECTRAL_MODELS]:
         if not check_existing(model_dirs,
                               outputs_root_dir=OUTPUTS_ROOT_DIR,
-                              test_filename='features.npz'):
+                              test_filename=None if NEW_PERIODS is not None else SAVE_FILENAME):
             print('Stopping')
             return
 
@@ -169,10 +381,25 @@ def main() -> None:
         print('- number of models:', len(model_dirs))
         print()
 
+        num_shards = NUM_WORKERS * NUM_NODES
+        if num_shards > 1:
+            if SAVE_SPATIAL or NEW_PERIODS is not None:
+                raise ValueError('SAVE_SPATIAL and NEW_PERIODS are not supported with data-parallel extraction')
+            run_workers(extract_shard, [
+                (NODE_RANK * NUM_WORKERS + worker, num_shards, worker, model_dirs, config)
+                for worker in range(NUM_WORKERS)])
+            if NODE_RANK == 0:
+                for model_dir in model_dirs:
+                    merge_shards(os.path.join(OUTPUTS_ROOT_DIR, model_dir),
+                                 filename=SAVE_FILENAME, num_shards=num_shards, wait=True)
+            continue
+
         b, size, feed_dict = get_batcher(
             tfrecord_dir=INPUTS_DIR, ls_bands=ls_bands, nl_band=nl_band,
-            num_epochs=len(model_dirs), cache=CACHE)
-        batches_per_epoch = int(np.ceil(size / BATCH_SIZE))
+            num_epochs=len(model_dirs), cache=CACHE, mosaic=MOSAIC,
+            instrument=INSTRUMENT, normalize=get_normalize(), years=NEW_PERIODS,
+            band_encoding=BAND_ENCODING, shard_dir=SHARD_DIR)
+        batches_per_epoch = int(np.ceil(size / b.batch_size))
 
         run_extraction_on_models(
             model_dirs,
@@ -181,9 +408,16 @@ def main() -> None:
             batcher=b,
             batches_per_epoch=batches_per_epoch,
             out_root_dir=OUTPUTS_ROOT_DIR,
-            save_filename='features.npz',
+            save_filename=SAVE_FILENAME,
             batch_keys=['labels', 'locs', 'years'],
-            feed_dict=feed_dict)
+            feed_dict=feed_dict,
+            blocks_to_save=BLOCKS_TO_SAVE,
+            save_spatial=SAVE_SPATIAL,
+            tta=TTA,
+            mosaic_grid_width=(2 * NRINGS + 1) if MOSAIC else None,
+            instrument=INSTRUMENT,
+            trace_batches=TRACE_BATCHES,
+            append=NEW_PERIODS is not None)
 
 
 if __name__ == '__main__':
@@ -29,6 +29,7 @@ class BaseModel(metaclass=ABCMeta):
         # in subclasses, these should be initialized during __init__()
         self.outputs: tf.Tensor = None  # tf.Tensor, shape [batch_size, num_outputs]
         self.features_layer: tf.Tensor = None  # tf.Tensor, shape [batch_size, num_features]
+        self.spatial_features_layer: tf.Tensor = None  # tf.Tensor, shape [batch_size, h, w, num_features]
 
     @abstractmethod
     def init_from_numpy(self, path: str, sess: tf.Session, hs_weight_init: str) -> None:
@@ -8,13 +8,21 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+import os
 import pickle
-import statistics
-from collections import defaultdict
+
+from models.evaluation import bootstrap_metrics, evaluate
+from utils.location_index import LocationIndex
 
 
 # =================== LOAD DATA & DEFINE CONSTANTS =====================
 
+NUM_BOOT = 1000                          # number of bootstrap replicates for confidence intervals
+NUM_WORKERS = 1                          # number of processes computing bootstrap replicates
+METRICS_PATH = './data/resnet_ms/test_metrics.csv'
+LOC_DICT_PATH = './data/yeh_et_al/dhs_loc_dict.pkl'
+LOC_INDEX_PATH = './data/yeh_et_al/dhs_loc_index.npz'   # built from LOC_DICT_PATH on first use
+
 # List of countries which appear in DHS surveys
 DHS_COUNTRIES = [
     'angola', 'benin', 'burkina_faso', 'cameroon', 'cote_d_ivoire',
@@ -27,29 +35,22 @@ predictions = np.load('./data/resnet_ms/test_preds.npz')
 labels = predictions.f.labels
 predictions = predictions.f.test_preds
 
-# TODO: Refactor this out to a separate file and generate the index there.
-# For consistency with Yeh et al. (2020), I am loading their files and processing it as
-# they suggest in africa_poverty repo. This snippet of code generates an index showing
-# which prediction belongs to which feature.
+# For consistency with Yeh et al. (2020), the country of each cluster comes from their dhs_loc_dict.pkl. It is
+# converted once into a location index (sorted location keys and integer country codes), so that the country of
+# every cluster is found with a single vectorized lookup.
 npz = np.load('./data/yeh_et_al/dhs_image_hists.npz')
 locs = npz['locs']
 years = npz['years']
 
-loc_dict_path = './data/yeh_et_al/dhs_loc_dict.pkl'
-with open(loc_dict_path, 'rb') as f:
-    loc_dict = pickle.load(f)
-
-country_indices = defaultdict(list)  # country => np.array of indices
-country_labels = np.zeros(19669, dtype=np.int32)  # np.array of country labels
-
-for i, loc in enumerate(locs):
-    country = loc_dict[tuple(loc)]['country']
-    country_indices[country].append(i)
+if os.path.exists(LOC_INDEX_PATH):
+    loc_index = LocationIndex.load(LOC_INDEX_PATH)
+else:
+    with open(LOC_DICT_PATH, 'rb') as f:
+        loc_index = LocationIndex.from_loc_dict(pickle.load(f), field='country')
+    loc_index.save(LOC_INDEX_PATH)
 
-for i, country in enumerate(DHS_COUNTRIES):
-    country_indices[country] = np.asarray(country_indices[country])
-    indices = country_indices[country]
-    country_labels[indices] = i
+country_codes = loc_index.lookup(locs)  # np.array of country codes
+assert set(loc_index.names) <= set(DHS_COUNTRIES)
 
 
 # ================== CALCULATE PREDICTION ERRORS ====================
@@ -63,38 +64,42 @@ model_df = pd.DataFrame(
     columns=['lat', 'lon', 'country', 'year', 'label', 'resnet-18-ms', 'error', 'sq_error'])
 model_df['lat'] = locs[:, 0]
 model_df['lon'] = locs[:, 1]
-model_df['country'] = np.asarray(DHS_COUNTRIES)[country_labels]
+model_df['country'] = loc_index.names[country_codes]
 model_df['year'] = years
 model_df['label'] = labels
 model_df['resnet-18-ms'] = predictions
 model_df['error'] = errors
 model_df['sq_error'] = squared_errors
 
-
-# Calculate overall model performance
-mse = statistics.mean(squared_errors)
-r_sq = 1 - (sum((labels - predictions)**2))/(sum(labels**2))   # R^2 = 1 - RSS/TSS
-
-# Plot predictions against labels
-plt.scatter(labels, predictions, alpha=0.01)
-plt.show()
-
-
-# Calculate model performance by country
-mse_country = defaultdict(list)
-for country in DHS_COUNTRIES:
-    index = country_indices[country]
-    mse_country[country] = statistics.mean(model_df['sq_error'][index])
-
-r_sq_country = defaultdict(list)
-for country in DHS_COUNTRIES:
-    index = country_indices[country]
-    rss = sum((model_df['label'][index] - model_df['resnet-18-ms'][index])**2)
-    tss = sum((model_df['label'][index])**2)
-    r_sq_country[country] = 1 - (rss/tss)
-
-
-
-
-
-
+# Urban/rural indicator of each cluster, if available
+groupings = {'country': model_df['country'], 'year': model_df['year']}
+if 'urban_rural' in npz.files:
+    model_df['urban_rural'] = npz['urban_rural']
+    groupings['urban_rural'] = model_df['urban_rural']
+
+
+# ================== CALCULATE MODEL PERFORMANCE ====================
+
+# Overall and grouped MSE, R^2 (centered, and uncentered as in Yeh et al. (2020): 1 - RSS/sum(label^2)) and
+# correlation, each computed with a single pass of grouped reductions
+metrics = evaluate(labels, predictions, groupings)
+mse = metrics['overall']['mse'].iloc[0]
+r_sq = metrics['overall']['r2_uncentered'].iloc[0]
+mse_country = metrics['country']['mse'].to_dict()
+r_sq_country = metrics['country']['r2_uncentered'].to_dict()
+
+
+# Bootstrap confidence intervals (under __main__, since worker processes re-import this file)
+if __name__ == '__main__':
+    overall_ci = bootstrap_metrics(labels, predictions, num_boot=NUM_BOOT, num_workers=NUM_WORKERS)
+    country_ci = bootstrap_metrics(labels, predictions, model_df['country'], num_boot=NUM_BOOT,
+                                   num_workers=NUM_WORKERS)
+    print(overall_ci.T)
+    for name, df in metrics.items():
+        if name != 'overall':
+            print(df)
+    pd.concat({'overall': overall_ci, 'country': country_ci}).to_csv(METRICS_PATH)
+
+    # Plot predictions against labels
+    plt.scatter(labels, predictions, alpha=0.01)
+    plt.show()
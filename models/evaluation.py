@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+import multiprocessing
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+METRICS = ['n', 'mse', 'r2', 'r2_uncentered', 'pearson_r']
+
+# sufficient statistics from which all METRICS are computed, summed within each group
+_SUMS = ['n', 'y', 'p', 'yy', 'pp', 'yp']
+
+
+def load_predictions(path: str, label_key: str = 'labels', pred_key: str = 'preds',
+                     keys: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Loads labels and predictions (and any grouping variables) from a .npz, .csv
+    or .parquet file, e.g. the test predictions of a model, or the features.npz
+    written by extract_features.py together with predictions saved alongside it.
+    Args
+    - path: str, path to the file
+    - label_key: str, name of the labels array or column
+    - pred_key: str, name of the predictions array or column
+    - keys: list of str, names of other 1-D arrays or columns to load
+    Returns: pd.DataFrame with columns 'label', 'pred' and keys
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == '.npz':
+        npz = np.load(path)
+        store = {key: npz[key] for key in [label_key, pred_key, *keys]}
+    elif ext == '.csv':
+        store = pd.read_csv(path)
+    elif ext == '.parquet':
+        store = pd.read_parquet(path)
+    else:
+        raise ValueError(f'Unsupported file type: {path}')
+    df = pd.DataFrame({'label': np.asarray(store[label_key]), 'pred': np.asarray(store[pred_key])})
+    for key in keys:
+        df[key] = np.asarray(store[key])
+    return df
+
+
+def group_codes(groups: Optional[Sequence] = None, n: Optional[int] = None) -> tuple[np.ndarray, pd.Index]:
+    """
+    Args
+    - groups: array-like of group labels (e.g. countries), shape [N], or None for a single group
+    - n: int, number of observations, only needed if groups is None
+    Returns
+    - codes: np.array of int, shape [N], the group of each observation
+    - names: pd.Index, name of each group, sorted
+    """
+    if groups is None:
+        return np.zeros(n, dtype=np.int64), pd.Index(['all'])
+    codes, names = pd.factorize(pd.Series(groups), sort=True)
+    if np.any(codes < 0):
+        raise ValueError('groups must not contain missing values')
+    return codes, names
+
+
+def _group_sums(labels: np.ndarray, preds: np.ndarray, codes: np.ndarray, num_groups: int,
+                weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Computes the sufficient statistics _SUMS within each group in one pass.
+    Args
+    - labels, preds: np.array, shape [N]
+    - codes: np.array of int, shape [N], group of each observation
+    - num_groups: int
+    - weights: np.array, shape [B, N], number of times each observation is drawn
+        in each of B bootstrap replicates, or None for a single unweighted sample
+    Returns: np.array, shape [len(_SUMS), G] or [B, len(_SUMS), G]
+    """
+    values = np.stack([np.ones_like(labels), labels, preds, labels * labels, preds * preds, labels * preds])
+    if weights is None:
+        return np.stack([np.bincount(codes, weights=v, minlength=num_groups) for v in values])
+
+    # one-hot by group, so that each replicate's grouped sums are a single matrix product
+    onehot = np.zeros([len(codes), num_groups])
+    onehot[np.arange(len(codes)), codes] = 1
+    design = (values.T[:, :, None] * onehot[:, None, :]).reshape(len(codes), -1)  # [N, S * G]
+    return (weights @ design).reshape(len(weights), len(_SUMS), num_groups)
+
+
+def _metrics_from_sums(sums: np.ndarray) -> dict[str, np.ndarray]:
+    n, sy, sp, syy, spp, syp = (sums[..., k, :] for k in range(len(_SUMS)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rss = syy - 2 * syp + spp
+        tss = syy - sy * sy / n
+        cov = syp - sy * sp / n
+        var_p = spp - sp * sp / n
+        return {
+            'n': n,
+            'mse': rss / n,
+            'r2': 1 - rss / tss,
+            'r2_uncentered': 1 - rss / syy,
+            'pearson_r': cov / np.sqrt(tss * var_p),
+        }
+
+
+def grouped_metrics(labels: Sequence[float], preds: Sequence[float], groups: Optional[Sequence] = None
+                    ) -> pd.DataFrame:
+    """
+    Computes MSE, R^2 (centered, and uncentered as in Yeh et al. (2020), i.e.
+    1 - RSS / sum(label^2)) and Pearson correlation, overall or within each group.
+    Args
+    - labels, preds: array-like, shape [N]
+    - groups: array-like, shape [N], group of each observation (e.g. country), or None
+    Returns: pd.DataFrame, indexed by group, with columns METRICS
+    """
+    labels = np.asarray(labels, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    codes, names = group_codes(groups, len(labels))
+    metrics = _metrics_from_sums(_group_sums(labels, preds, codes, len(names)))
+    df = pd.DataFrame(metrics, index=names)[METRICS]
+    df['n'] = df['n'].astype(np.int64)
+    return df
+
+
+def evaluate(labels: Sequence[float], preds: Sequence[float],
+             groupings: Optional[Mapping[str, Sequence]] = None) -> dict[str, pd.DataFrame]:
+    """
+    Args
+    - labels, preds: array-like, shape [N]
+    - groupings: dict, maps the name of each grouping (e.g. 'country', 'year',
+        'urban_rural') to the group of each observation
+    Returns: dict, maps 'overall' and each grouping name to a pd.DataFrame of METRICS
+    """
+    results = {'overall': grouped_metrics(labels, preds)}
+    for name, groups in (groupings or {}).items():
+        results[name] = grouped_metrics(labels, preds, groups)
+    return results
+
+
+def _bootstrap_chunk(args: tuple) -> np.ndarray:
+    labels, preds, codes, num_groups, num_boot, seed = args
+    rng = np.random.default_rng(seed)
+    n = len(labels)
+    # each replicate resamples n observations with replacement, i.e. draws multinomial counts
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=num_boot).astype(np.float64)
+    metrics = _metrics_from_sums(_group_sums(labels, preds, codes, num_groups, weights))
+    return np.stack([metrics[m] for m in METRICS[1:]], axis=1)  # [B, M, G]
+
+
+def bootstrap_metrics(labels: Sequence[float], preds: Sequence[float], groups: Optional[Sequence] = None,
+                      num_boot: int = 1000, alpha: float = 0.05, seed: int = 0,
+                      num_workers: int = 1, boot_per_task: int = 50) -> pd.DataFrame:
+    """
+    Computes percentile bootstrap confidence intervals for METRICS, overall or
+    within each group. Observations are resampled with replacement from all
+    observations (so group sizes vary between replicates). Each task draws the
+    resampling counts of boot_per_task replicates at once and computes their
+    grouped statistics with a single matrix product; tasks run in parallel.
+    Args
+    - labels, preds: array-like, shape [N]
+    - groups: array-like, shape [N], group of each observation, or None
+    - num_boot: int, number of bootstrap replicates
+    - alpha: float, the intervals cover 1 - alpha
+    - seed: int, results are reproducible for a given seed and boot_per_task,
+        whatever the number of workers
+    - num_workers: int, number of worker processes
+    - boot_per_task: int, number of replicates per task (memory use per worker
+        is ~16 * boot_per_task * N bytes)
+    Returns: pd.DataFrame, indexed by group, with the point estimate and the
+        '{metric}_lo' and '{metric}_hi' bounds of each metric
+    """
+    labels = np.asarray(labels, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    codes, names = group_codes(groups, len(labels))
+
+    sizes = [min(boot_per_task, num_boot - i) for i in range(0, num_boot, boot_per_task)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(labels, preds, codes, len(names), size, s) for size, s in zip(sizes, seeds)]
+    if num_workers <= 1:
+        chunks = [_bootstrap_chunk(task) for task in tasks]
+    else:
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            chunks = pool.map(_bootstrap_chunk, tasks)
+    boot = np.concatenate(chunks)  # [num_boot, M, G]
+
+    lo, hi = np.nanpercentile(boot, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)  # [M, G]
+    df = grouped_metrics(labels, preds, groups)
+    for m, metric in enumerate(METRICS[1:]):
+        df[f'{metric}_lo'] = lo[m]
+        df[f'{metric}_hi'] = hi[m]
+    return df
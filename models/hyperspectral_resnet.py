@@ -42,7 +42,8 @@ def inference(x: tf.Tensor,
               use_dilated_conv_in_first_layer: bool = False,
               blocks_to_save: dict[int, Optional[bool]] = None,
               conv_reg: float = 0.001,
-              fc_reg: float = 0.001
+              fc_reg: float = 0.001,
+              end_points: Optional[dict[str, tf.Tensor]] = None
               ) -> tuple[tf.Tensor, tf.Tensor]:
     '''Implements Resnet v2 (preactivation).
     Args
@@ -58,6 +59,9 @@ def inference(x: tf.Tensor,
         NOTE: the keys are BLOCK numbers, not LAYER numbers
     - conv_reg: float, L2 weight regularization penalty for conv layers
     - fc_reg: float, L2 weight regularization penalty for fully-connected layer
+    - end_points: dict, if given, is filled with the (non-pooled) output of each scale,
+        keyed by 'scale1' through 'scale5', e.g. end_points['scale5'] has shape
+        [batch_size, H/32, W/32, num_final_filters]
     Returns:
     - x: if num_classes is None, x is equal to features_layer
         otherwise, x is a tf.Tensor with shape [batch_size, num_classes]
@@ -100,6 +104,8 @@ def inference(x: tf.Tensor,
                 x = conv(x, c)
             x = bn_activation(x, c)
             x = tf.identity(x, name='scale1_img')
+            if end_points is not None:
+                end_points['scale1'] = x
 
         with tf.variable_scope('scale2'):
             x = _max_pool(x, ksize=3, stride=2)
@@ -109,6 +115,8 @@ def inference(x: tf.Tensor,
             c['block_filters_internal'] = 64
             x = stack(x, c)
             x = tf.identity(x, name='scale2_img')
+            if end_points is not None:
+                end_points['scale2'] = x
 
         with tf.variable_scope('scale3'):
             c['num_blocks'] = num_blocks[1]
@@ -117,18 +125,24 @@ def inference(x: tf.Tensor,
             assert c['stack_stride'] == 2
             x = stack(x, c)
             x = tf.identity(x, name='scale3_img')
+            if end_points is not None:
+                end_points['scale3'] = x
 
         with tf.variable_scope('scale4'):
             c['num_blocks'] = num_blocks[2]
             c['block_filters_internal'] = 256
             x = stack(x, c)
             x = tf.identity(x, name='scale4_img')
+            if end_points is not None:
+                end_points['scale4'] = x
 
         with tf.variable_scope('scale5'):
             c['num_blocks'] = num_blocks[3]
             c['block_filters_internal'] = 512
             x = stack(x, c)
             x = tf.identity(x, name='scale5_img')
+            if end_points is not None:
+                end_points['scale5'] = x
 
         # post-net
         x = tf.reduce_mean(x, axis=[1, 2], name='avg_pool')  # avg pool across image width and height
@@ -57,6 +57,7 @@ class Hyperspectral_Resnet(BaseModel):
 
         # outputs: tf.Tensor, shape [batch_size, num_outputs], type float32
         # features_layer: tf.Tensor, shape [batch_size, num_features], type float32
+        self.end_points: dict[str, tf.Tensor] = {}
         self.outputs, self.features_layer = hyperspectral_resnet.inference(
             inputs,
             is_training=is_training,
@@ -66,7 +67,12 @@ class Hyperspectral_Resnet(BaseModel):
             use_dilated_conv_in_first_layer=use_dilated_conv_in_first_layer,
             blocks_to_save=self.block_features,
             conv_reg=conv_reg,
-            fc_reg=fc_reg)
+            fc_reg=fc_reg,
+            end_points=self.end_points)
+
+        # spatial_features_layer: tf.Tensor, shape [batch_size, H/32, W/32, num_features], type float32
+        # - the final conv layer before average-pooling, i.e. 7x7 cells for a 224x224 input
+        self.spatial_features_layer = self.end_points['scale5']
 
     def init_from_numpy(self, path: str, sess: tf.Session,
                         hs_weight_init: str = 'random') -> None:
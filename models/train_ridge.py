@@ -0,0 +1,190 @@
+# This script fits the final ridge regression layer of each of the five in-country models from Yeh et al. (2020) on
+# features extracted from the DHS cluster images, and saves the weights to outputs/ridge_weights.npz in the layout
+# read by preprocessing/predict_assets.py ('{fold}_w' of shape [512] and '{fold}_b' of shape [1]).
+#
+# For each fold, the regularization strength is chosen on the fold's 'val' split out of the whole LAMBDAS grid. The
+# features are centered (so that the bias is not penalized), and the Gram matrix X'X of the training features is
+# eigendecomposed once, X'X = V diag(s) V'. The weights for every lambda then follow in closed form,
+# w(lambda) = V diag(1 / (s + lambda)) V'X'y, at the cost of a few matrix products instead of one solve per lambda. The
+# model is finally refit with the chosen lambda on the 'train' and 'val' splits, and evaluated on the 'test' split.
+#
+# Features must first be extracted for every DHS cluster with each fold's model, e.g. by running extract_features.py
+# with INPUTS_DIR = 'data/dhs_tfrecords' and SAVE_FILENAME = DHS_FEATURES_FILENAME. The extracted features are matched
+# to the clusters of the folds by location and year, using the cluster order of REFERENCE_PATH.
+#
+# Usage (from the repository root):
+#     python -m models.train_ridge
+
+
+import json
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from utils.tfrecord_paths_utils import DHS_INCOUNTRY_FOLDS_PATH, incountry_fold_indices
+
+
+# ==================== PARAMETERS ======================
+
+MODEL_FOLDS = ['A', 'B', 'C', 'D', 'E']
+MODEL_DIR = 'outputs/ms_incountry'
+DHS_FEATURES_FILENAME = 'dhs_features.npz'     # features of the DHS clusters, in each DHS_Incountry_{fold}_* directory
+REFERENCE_PATH = './data/yeh_et_al/dhs_image_hists.npz'   # 'locs' and 'years' of the clusters in sorted order
+FOLDS_PATH = DHS_INCOUNTRY_FOLDS_PATH
+WEIGHTS_PATH = 'outputs/ridge_weights.npz'
+LOG_PATH = 'outputs/ridge_path.csv'
+
+LAMBDAS = np.logspace(-2, 6, 81)    # grid of regularization strengths
+REFIT = True                        # refit on the 'train' and 'val' splits with the chosen lambda
+
+
+# ==================== RIDGE REGRESSION ======================
+
+def align_features(features: np.ndarray, labels: np.ndarray, locs: np.ndarray, years: np.ndarray,
+                   ref_locs: np.ndarray, ref_years: np.ndarray):
+    """
+    Reorders extracted features to the order of the reference clusters (i.e. of the sorted DHS TFRecords, which the
+    indices of the in-country folds refer to), since feature extraction may read TFRecords in a different order.
+
+    Args:
+        - features, labels, locs, years: Outputs of feature extraction, with N rows
+        - ref_locs, ref_years: Locations [lat, lon] and years of the reference clusters, with M rows
+
+    Returns:
+        - features, labels: Arrays with M rows, in the order of the reference clusters
+    """
+    keys = pd.MultiIndex.from_arrays([np.float32(locs[:, 0]), np.float32(locs[:, 1]), np.asarray(years, dtype=int)])
+    if keys.has_duplicates:
+        raise ValueError('Extracted features contain duplicate (lat, lon, year) clusters')
+    ref_keys = pd.MultiIndex.from_arrays(
+        [np.float32(ref_locs[:, 0]), np.float32(ref_locs[:, 1]), np.asarray(ref_years, dtype=int)])
+    order = keys.get_indexer(ref_keys)
+    if np.any(order < 0):
+        raise ValueError(f'{np.sum(order < 0)} of {len(ref_keys)} reference clusters are missing extracted features')
+    return features[order], labels[order]
+
+
+def ridge_path(X: np.ndarray, y: np.ndarray, lambdas: np.ndarray):
+    """
+    Fits ridge regression for every lambda from a single eigendecomposition of the Gram matrix of the centered
+    features. The bias is not penalized.
+
+    Args:
+        - X: Features, shape [N, D]
+        - y: Labels, shape [N]
+        - lambdas: Regularization strengths, shape [L]
+
+    Returns:
+        - W: Weights for each lambda, shape [D, L]
+        - b: Bias for each lambda, shape [L]
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lambdas = np.asarray(lambdas, dtype=np.float64)
+    x_mean, y_mean = X.mean(axis=0), y.mean()
+    Xc = X - x_mean
+
+    s, V = np.linalg.eigh(Xc.T @ Xc)
+    s = np.maximum(s, 0)                          # clip round-off below 0
+    Vty = V.T @ (Xc.T @ (y - y_mean))             # [D]
+    W = V @ (Vty[:, None] / (s[:, None] + lambdas[None, :]))
+    b = y_mean - x_mean @ W
+    return W, b
+
+
+def r2(y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        - y_true: Labels, shape [N]
+        - y_pred: Predictions, shape [N] or [N, L]
+
+    Returns:
+        - Coefficient of determination, 1 - RSS/TSS (for each column of y_pred)
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    if y_pred.ndim == 2:
+        y_true = y_true[:, None]
+    rss = np.sum((y_true - y_pred) ** 2, axis=0)
+    tss = np.sum((y_true - y_true.mean(axis=0)) ** 2, axis=0)
+    return 1 - rss / tss
+
+
+def fit_fold(features: np.ndarray, labels: np.ndarray, fold_indices: dict, lambdas: np.ndarray, refit: bool = True):
+    """
+    Chooses lambda on the 'val' split of a fold, and fits the final weights.
+
+    Args:
+        - features, labels: Features and labels of all clusters, in the order of the fold indices
+        - fold_indices: Maps each split ('train', 'val', 'test') to the indices of its clusters
+        - lambdas: Regularization strengths
+        - refit: Whether to refit on the 'train' and 'val' splits with the chosen lambda
+
+    Returns:
+        - w: Weights, shape [D]
+        - b: Bias
+        - log: DataFrame with the 'val' MSE and R^2 of each lambda
+        - summary: dict with the chosen lambda and its 'val' and 'test' R^2
+    """
+    train, val, test = (fold_indices[split] for split in ['train', 'val', 'test'])
+    W, b = ridge_path(features[train], labels[train], lambdas)
+    val_preds = features[val] @ W + b                           # [N_val, L]
+    val_mse = np.mean((labels[val][:, None] - val_preds) ** 2, axis=0)
+    val_r2 = r2(labels[val], val_preds)
+    best = int(np.argmin(val_mse))
+
+    if refit:
+        train_val = np.concatenate([train, val])
+        W_best, b_best = ridge_path(features[train_val], labels[train_val], lambdas[best:best + 1])
+        w, b_best = W_best[:, 0], b_best[0]
+    else:
+        w, b_best = W[:, best], b[best]
+
+    log = pd.DataFrame({'lambda': lambdas, 'val_mse': val_mse, 'val_r2': val_r2})
+    summary = {
+        'lambda': float(lambdas[best]),
+        'val_r2': float(val_r2[best]),
+        'test_r2': float(r2(labels[test], features[test] @ w + b_best)),
+        'edge_of_grid': best in (0, len(lambdas) - 1),
+    }
+    return w, b_best, log, summary
+
+
+def load_dhs_features(model_dir: str, fold: str, filename: str, ref_locs: np.ndarray, ref_years: np.ndarray):
+    """
+    Args:
+        - model_dir: Directory containing a DHS_Incountry_{fold}_* subdirectory for each fold
+        - fold: Fold of the model
+        - filename: Name of the features file in the model's subdirectory
+        - ref_locs, ref_years: Locations and years of the clusters, in the order of the fold indices
+
+    Returns:
+        - features, labels: Features and labels of the clusters, in the order of ref_locs
+    """
+    features_path = glob(os.path.join(model_dir, f'DHS_Incountry_{fold}_*', filename))[0]
+    npz = np.load(features_path)
+    return align_features(npz['features'], npz['labels'], npz['locs'], npz['years'], ref_locs, ref_years)
+
+
+# ==================== TRAINING =====================
+
+if __name__ == '__main__':
+    ref = np.load(REFERENCE_PATH)
+    weights = {}
+    logs = []
+    for fold in MODEL_FOLDS:
+        features, labels = load_dhs_features(MODEL_DIR, fold, DHS_FEATURES_FILENAME, ref['locs'], ref['years'])
+        fold_indices = incountry_fold_indices(FOLDS_PATH, fold)
+        w, b, log, summary = fit_fold(features, labels, fold_indices, LAMBDAS, refit=REFIT)
+
+        weights[f'{fold}_w'] = w.astype(np.float32)
+        weights[f'{fold}_b'] = np.asarray([b], dtype=np.float32)
+        logs.append(log.assign(fold=fold))
+        print(f'Fold {fold}: {json.dumps(summary)}')
+        if summary['edge_of_grid']:
+            print(f'WARNING: the chosen lambda for fold {fold} is at the edge of LAMBDAS, consider widening the grid')
+
+    np.savez(WEIGHTS_PATH, **weights)
+    pd.concat(logs).to_csv(LOG_PATH, index=False)
+    print(f'Saved ridge weights to {WEIGHTS_PATH} and the lambda path to {LOG_PATH}')
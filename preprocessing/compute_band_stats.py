@@ -0,0 +1,35 @@
+# This script computes per-band means, standard deviations and percentiles over the processed land-deal tiles in
+# a single streaming pass, so that images can be normalized with statistics from our own tiles rather than the DHS
+# statistics in utils/dataset_constants.py. As for the DHS statistics, negative values are set to 0 and pixels that
+# are 0 across all bands are ignored. Only one tile per worker is held in memory at a time, so this scales to any
+# number of tiles. The output JSON can be registered with utils.dataset_constants.load_band_stats() and then selected
+# with Batcher(normalize=NAME), see BAND_STATS_PATH in extract_features.py.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.compute_band_stats
+
+
+import os
+from glob import glob
+
+from utils.band_stats import LS_BANDS, compute_band_stats, save_band_stats
+
+
+# ==================== PARAMETERS ======================
+
+INPUT_DIR = 'data/tfrecords'        # per-tile TFRecords, or the SHARD_DIR of process_tfrecords.py
+OUTPUT_PATH = 'data/band_stats.json'
+NAME = 'LANDDEALS'                  # key under which the statistics are registered in MEANS_DICT and STD_DEVS_DICT
+CROP = True                         # only use the central 224x224 pixels of each tile, as seen by the CNN
+NUM_WORKERS = os.cpu_count() or 1
+
+
+# ==================== COMPUTE STATISTICS ======================
+
+if __name__ == '__main__':
+    tfrecord_paths = sorted(glob(os.path.join(INPUT_DIR, '*', '*.tfrecord.gz'))
+                            + glob(os.path.join(INPUT_DIR, '*.tfrecord.gz')))
+    print(f'Computing band statistics over {len(tfrecord_paths)} TFRecords with {NUM_WORKERS} workers')
+    stats = compute_band_stats(tfrecord_paths, bands=LS_BANDS, crop=CROP, num_workers=NUM_WORKERS)
+    save_band_stats(stats, OUTPUT_PATH, name=NAME,
+                    metadata={'input_dir': INPUT_DIR, 'num_files': len(tfrecord_paths), 'crop': CROP})
@@ -0,0 +1,107 @@
+# This script measures the coverage of every tile of the panel by deal concessions, as a measure of the intensity of
+# treatment beyond the ring of the tile. For every (tile, year), it computes the fraction of the tile's footprint inside
+# the concessions (areas.geojson, of the types in AREA_TYPES) of its own deal, inside the concessions of any other deal,
+# and inside the concessions of other deals active in that year (signed or operational, as for the treatment
+# indicators in merge_and_validate.R). The footprint of each tile is sampled on a grid of SAMPLES x SAMPLES points (see
+# ConcessionCoverage in utils/concessions.py). If the tiles were exported with a tile plan (TILE_PLAN_PATH, see
+# plan_tiles.py), their footprints are read from the plan. The columns are saved to OUTPUT_PATH, keyed by deal_id,
+# tile_id and year, and joined into the panel by merge_and_validate.R.
+#
+# Requires the deal years and Parquet caches written by process_landmatrix.py, and pyarrow.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.concession_coverage
+
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.deal_exposure import load_panel_tiles
+from utils.concessions import ConcessionCoverage, PolygonSet
+from utils.landmatrix import LandMatrixTables
+from utils.tile_geometry import (
+    TILE_SIZE, lonlat_to_mercator, planned_tile_locations, projected_pixel_size, tile_centroids)
+
+
+# ==================== PARAMETERS ======================
+
+RAW_DIR = 'data/raw/landmatrix'
+CACHE_DIR = 'data/intermediate/landmatrix'                    # as in process_landmatrix.py
+DEALS_PATH = 'data/intermediate/deal_years.csv'              # deal_id, lat, lon, year_signed, year_operational
+PREDICTIONS_PATH = 'data/intermediate/asset_predictions.csv'  # (deal_id, tile_id, year) of each panel observation
+OUTPUT_PATH = 'data/intermediate/concession_coverage.csv'
+TILE_PLAN_PATH = None  # tile plan from plan_tiles.py, if tiles were exported with it
+
+AREA_TYPES = ['contract_area', 'production_area']            # types of areas that are concessions
+TREATMENTS = {'signed': 'year_signed', 'operational': 'year_operational'}   # treatment => year it starts
+SAMPLES = 16           # points sampled along each side of each tile
+NRINGS = 2             # as in export_images.py, to locate the tiles
+SCALE = 30
+
+
+# ==================== CONCESSION COVERAGE ======================
+
+def compute_coverage(panel: pd.DataFrame, deals: pd.DataFrame, areas: pd.DataFrame, area_types: list = AREA_TYPES,
+                     treatments: dict = TREATMENTS, samples: int = SAMPLES,
+                     tile_plan: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Args:
+        - panel: Observations, with deal_id, tile_id and year
+        - deals: Deals, with deal_id, lat, lon and the columns of treatments
+        - areas: Areas of the deals, with deal_id, type and geometry (GeoJSON), see utils/landmatrix.py
+        - area_types: Types of areas that are concessions
+        - treatments: Maps the name of each treatment to the column with the year it starts
+        - samples: Number of points sampled along each side of each tile
+        - tile_plan: Tile plan from plan_tiles.py, to locate the tiles if they were exported with it
+
+    Returns:
+        - panel (less observations of deals not in deals) with the columns 'concession_own', 'concession_other' and
+          'concession_other_{treatment}' for each treatment
+    """
+    deals = deals.drop_duplicates('deal_id').reset_index(drop=True)
+    deal_index = pd.Index(deals['deal_id'])
+    deal_codes = deal_index.get_indexer(panel['deal_id'])
+    if np.any(deal_codes < 0):
+        # as for the inner join with lsla in merge_and_validate.R, these observations are dropped
+        print(f'Dropping {np.sum(deal_codes < 0)} observations of deals without a location')
+        panel, deal_codes = panel[deal_codes >= 0], deal_codes[deal_codes >= 0]
+
+    areas = areas[areas['type'].isin(area_types) & areas['geometry'].notna()]
+    polygon_deals = deal_index.get_indexer(areas['deal_id'])
+    if np.any(polygon_deals < 0):
+        print(f'Dropping {np.sum(polygon_deals < 0)} concessions of deals without a location or years')
+        areas, polygon_deals = areas[polygon_deals >= 0], polygon_deals[polygon_deals >= 0]
+    polygons = PolygonSet(areas['geometry'].tolist())
+
+    # observations of the same tile in different years share its coverage
+    tiles, tile_codes = np.unique(np.stack([deal_codes, panel['tile_id'].to_numpy(dtype=int)], axis=1), axis=0,
+                                  return_inverse=True)
+    tile_codes = tile_codes.reshape(-1)
+    if tile_plan is not None:
+        tile_lon, tile_lat, pixel_size = planned_tile_locations(
+            tile_plan, deals['deal_id'].to_numpy()[tiles[:, 0]], tiles[:, 1])
+    else:
+        lon, lat = tile_centroids(deals['lon'].to_numpy(), deals['lat'].to_numpy(), NRINGS, SCALE)  # [D, T]
+        tile_lon, tile_lat = lon[tiles[:, 0], tiles[:, 1]], lat[tiles[:, 0], tiles[:, 1]]
+        pixel_size = projected_pixel_size(deals['lat'].to_numpy(), SCALE)[tiles[:, 0]]
+    tile_x, tile_y = lonlat_to_mercator(tile_lon, tile_lat)
+    half_size = TILE_SIZE * pixel_size / 2
+    coverage = ConcessionCoverage(tile_x, tile_y, half_size, tiles[:, 0], polygons, polygon_deals, samples)
+
+    panel = panel.copy()
+    panel['concession_own'] = coverage.own_fraction()[tile_codes]
+    panel['concession_other'] = coverage.other_fraction()[tile_codes]
+    for treatment, year_col in treatments.items():
+        panel[f'concession_other_{treatment}'] = coverage.other_fraction(
+            tile_codes, panel['year'].to_numpy(), deals[year_col].to_numpy(dtype=np.float64))
+    return panel
+
+
+if __name__ == '__main__':
+    panel = load_panel_tiles(PREDICTIONS_PATH)
+    deals = pd.read_csv(DEALS_PATH)
+    areas = LandMatrixTables(RAW_DIR, CACHE_DIR).load('areas')
+    tile_plan = pd.read_csv(TILE_PLAN_PATH) if TILE_PLAN_PATH is not None else None
+    coverage = compute_coverage(panel, deals, areas, tile_plan=tile_plan)
+    coverage.to_csv(OUTPUT_PATH, index=False)
+    print(f'Saved concession coverage of {len(coverage)} observations to {OUTPUT_PATH}')
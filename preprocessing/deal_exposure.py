@@ -0,0 +1,94 @@
+# This script measures the exposure of every tile of the panel to other land deals. The 5x5 tile grids of nearby deals
+# overlap, so a tile may be close to several deals besides its own. For every (tile, year) and each radius in RADII_KM,
+# it counts the other deals that are active in that year (signed or operational, as for the treatment indicators in
+# merge_and_validate.R) within the radius of the tile centroid, and sums them weighted by 1 - distance / radius. The
+# columns are saved to OUTPUT_PATH, keyed by deal_id, tile_id and year, and joined into the panel by
+# merge_and_validate.R. If the tiles were exported with a tile plan (TILE_PLAN_PATH, see plan_tiles.py), the tile
+# centroids are read from the plan, since its grids are not centered on the deals.
+#
+# Requires the deal years written by process_landmatrix.R.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.deal_exposure
+
+
+import numpy as np
+import pandas as pd
+
+from utils.spatial_index import deal_exposure
+from utils.tile_geometry import planned_tile_locations, tile_centroids
+
+
+# ==================== PARAMETERS ======================
+
+DEALS_PATH = 'data/intermediate/deal_years.csv'              # deal_id, lat, lon, year_signed, year_operational
+PREDICTIONS_PATH = 'data/intermediate/asset_predictions.csv'  # (deal_id, tile_id, year) of each panel observation
+OUTPUT_PATH = 'data/intermediate/deal_exposure.csv'
+TILE_PLAN_PATH = None  # tile plan from plan_tiles.py, if tiles were exported with it
+
+TREATMENTS = {'signed': 'year_signed', 'operational': 'year_operational'}   # treatment => year it starts
+RADII_KM = [10, 25, 50]
+NRINGS = 2             # as in export_images.py, to locate the tile centroids
+SCALE = 30
+
+
+# ==================== DEAL EXPOSURE ======================
+
+def load_panel_tiles(predictions_path: str) -> pd.DataFrame:
+    """
+    Args:
+        - predictions_path: Path to the asset predictions written by predict_assets.py
+
+    Returns:
+        - DataFrame with the deal_id, tile_id and year of each observation of the panel
+    """
+    df = pd.read_csv(predictions_path, usecols=lambda col: col in ('deal_id', 'tile_id', 'year', 'years'))
+    return df.rename(columns={'years': 'year'})[['deal_id', 'tile_id', 'year']]
+
+
+def compute_exposure(panel: pd.DataFrame, deals: pd.DataFrame, radii_km: list = RADII_KM,
+                     treatments: dict = TREATMENTS, tile_plan: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Args:
+        - panel: Observations, with deal_id, tile_id and year
+        - deals: Deals, with deal_id, lat, lon and the columns of treatments
+        - radii_km: Radii within which to measure exposure
+        - treatments: Maps the name of each treatment to the column with the year it starts
+        - tile_plan: Tile plan from plan_tiles.py, to locate the tiles if they were exported with it
+
+    Returns:
+        - panel (less observations of deals not in deals) with the columns 'n_{treatment}_{r}km' and
+          'exposure_{treatment}_{r}km' for each treatment and radius
+    """
+    deals = deals.drop_duplicates('deal_id').reset_index(drop=True)
+    deal_codes = pd.Index(deals['deal_id']).get_indexer(panel['deal_id'])
+    if np.any(deal_codes < 0):
+        # as for the inner join with lsla in merge_and_validate.R, these observations are dropped
+        print(f'Dropping {np.sum(deal_codes < 0)} observations of deals without a location')
+        panel, deal_codes = panel[deal_codes >= 0], deal_codes[deal_codes >= 0]
+
+    tiles = panel['tile_id'].to_numpy(dtype=int)
+    if tile_plan is not None:
+        tile_lon, tile_lat, _ = planned_tile_locations(tile_plan, panel['deal_id'].to_numpy(), tiles)
+    else:
+        lon, lat = tile_centroids(deals['lon'].to_numpy(), deals['lat'].to_numpy(), NRINGS, SCALE)  # [D, T]
+        tile_lon, tile_lat = lon[deal_codes, tiles], lat[deal_codes, tiles]
+
+    panel = panel.copy()
+    for treatment, year_col in treatments.items():
+        exposure = deal_exposure(tile_lon, tile_lat, panel['year'].to_numpy(),
+                                 deals['lon'].to_numpy(), deals['lat'].to_numpy(), deals[year_col].to_numpy(),
+                                 radii_km, tile_deals=deal_codes)
+        for r in radii_km:
+            panel[f'n_{treatment}_{r:g}km'] = exposure[f'count_{r:g}km'].astype(int)
+            panel[f'exposure_{treatment}_{r:g}km'] = exposure[f'weighted_{r:g}km']
+    return panel
+
+
+if __name__ == '__main__':
+    panel = load_panel_tiles(PREDICTIONS_PATH)
+    deals = pd.read_csv(DEALS_PATH)
+    tile_plan = pd.read_csv(TILE_PLAN_PATH) if TILE_PLAN_PATH is not None else None
+    exposure = compute_exposure(panel, deals, tile_plan=tile_plan)
+    exposure.to_csv(OUTPUT_PATH, index=False)
+    print(f'Saved exposure of {len(exposure)} observations to other deals to {OUTPUT_PATH}')
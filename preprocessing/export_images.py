@@ -33,11 +33,12 @@
 import ee
 import math
 import pandas as pd
-from typing import Dict, Tuple, Any
+from typing import Dict, List, Tuple, Any
 
 from ee.batch import Task
 
 from utils import ee_utils
+from utils.tile_geometry import export_region, predict_tile_counts, projected_pixel_size
 
 
 # ==================== PARAMETERS ======================
@@ -52,6 +53,15 @@ START_YEAR = 1985      # first year of range over which to generate image patche
 END_YEAR = 2021        # last year of range over which to generate image patches
 MOSAIC_PERIOD = 3      # length of interval (in years) over which cloud-free mosaics are constructed
 NRINGS = 2             # number of concentric rings of tiles to export
+NEW_PERIODS = None     # to only export newly added periods, set as a list of their start years, e.g. [2021]
+
+# Batched Export Params: set BATCHED = True to build one composite per period over the regions of all deals, and
+# export the patches of DEALS_PER_TASK deals per task (instead of one task per deal and period). Files are named
+# 'batch_{year}_{chunk:04d}.tfrecord.gz' and are split into per-tile TFRecords by process_batched_tfrecords() in
+# process_tfrecords.py.
+BATCHED = False
+DEALS_PER_TASK = 20
+TILE_PLAN_PATH = None  # tile plan from plan_tiles.py, to export tiles shared by several deals only once
 
 # Band Names
 MS_BANDS = ['BLUE', 'GREEN', 'RED', 'NIR', 'SWIR1', 'SWIR2', 'TEMP1']
@@ -61,11 +71,11 @@ PROJECTION = 'EPSG:3857'  # see https://epsg.io/3857
 SCALE = 30                # export resolution: 30m/px
 EXPORT_TILE_RADIUS = 127 + 255*NRINGS  # image dimension = (2*EXPORT_TILE_RADIUS) + 1 = 255px
 
-# Load location candidates
-DATASET = pd.read_csv(CSV_PATH)
-
-# Initialize Earth Engine
-ee.Initialize()
+# Set ALIGN_REGIONS = True to export each deal's tiles on a pixel-aligned EPSG:3857 grid whose pixels cover SCALE meters
+# on the ground at the deal's latitude (i.e. SCALE times the Mercator scale factor), so that every deal yields exactly
+# (2*NRINGS+1)^2 tiles and clean_tfrecords.sh no longer needs to delete exports with the wrong number of tiles. Set to
+# False for the legacy regions of buffer(7700*(NRINGS+0.5)).bounds(), which export extra tiles at high latitudes.
+ALIGN_REGIONS = True
 
 
 # ==================== FUNCTIONS ======================
@@ -80,13 +90,78 @@ def get_batch_ids(df: pd.DataFrame,
     return [i for i in range(math.ceil(n / max_batch_size))]  # EE can process a maximum of 3000 jobs at once
 
 
+def get_period_years(start_year: int,
+                     end_year: int,
+                     mosaic_period: int,
+                     periods: List[int] = None) -> List[int]:
+    """
+    Returns the start year of each period to export: all periods between start_year and end_year, or the given
+    periods (e.g. newly available periods, which may be after end_year) after checking that they are aligned with
+    start_year and mosaic_period.
+    """
+    if periods is None:
+        num_periods = math.floor((end_year - start_year) / mosaic_period)
+        return [start_year + i*mosaic_period for i in range(num_periods)]
+    misaligned = [p for p in periods if p < start_year or (p - start_year) % mosaic_period != 0]
+    if len(misaligned) > 0:
+        raise ValueError(f'Periods {misaligned} are not aligned with start_year and mosaic_period')
+    return sorted(periods)
+
+
+def preflight_tile_counts(df: pd.DataFrame, n: int, align_regions: bool = True) -> pd.Series:
+    """
+    Predicts the number of tiles each deal will export before any task is submitted, and checks that each deal
+    yields exactly (2n+1)^2 tiles. For aligned regions, the tiles are counted in the region export_region() computes
+    for each deal's location.
+
+    Args:
+    - df: pd.Data.Frame with lat, lon, and deal_id columns
+    - n: int, number of concentric rings of tiles
+    - align_regions: bool, whether regions are pixel-aligned (see ALIGN_REGIONS)
+
+    Returns:
+    - pd.Series of predicted tile counts, indexed by deal_id
+
+    Raises a ValueError if align_regions and any deal is predicted to export the wrong number of tiles. For the
+    legacy regions, the affected deals are only reported (clean_tfrecords.sh removes their exports).
+    """
+    expected = (2*n + 1)**2
+    counts = pd.Series(predict_tile_counts(df['lat'].to_numpy(), nrings=n, scale=SCALE, aligned=align_regions,
+                                           lon=df['lon'].to_numpy()),
+                       index=df['deal_id'])
+    wrong = counts[counts != expected]
+    print(f'Pre-flight: {len(counts) - len(wrong)} of {len(counts)} deals are predicted to export {expected} tiles')
+    if len(wrong) > 0:
+        message = f'{len(wrong)} deals are predicted to export the wrong number of tiles: {wrong.to_dict()}'
+        if align_regions:
+            raise ValueError(message)
+        print(f'WARNING: {message}')
+    return counts
+
+
+def get_region(lat: float, lon: float, n: int, align_regions: bool = True) -> Tuple[ee.Geometry, Any]:
+    """
+    Returns:
+    - region: ee.Geometry, export region covering all (2n+1)^2 tiles of a deal
+    - crs_transform: list, affine transform of the pixel grid in PROJECTION if align_regions, else None
+    """
+    if align_regions:
+        bounds, crs_transform = export_region(lon, lat, nrings=n, scale=SCALE)
+        region = ee.Geometry.Rectangle(bounds, proj=PROJECTION, geodesic=False)
+        return region, crs_transform
+    loc = ee.Geometry.Point(lon, lat)
+    return loc.buffer(distance=7700*(n + 0.5)).bounds(), None    # 30m/px * 255pxs + 50m extra for variance
+
+
 def export_images(df: pd.DataFrame,
                   start_year: int,
                   end_year: int,
                   export_folder: str,
                   n: int = 0,
                   mosaic_period: int = 3,
-                  subset_id: int = None
+                  subset_id: int = None,
+                  periods: List[int] = None,
+                  align_regions: bool = True
                   ) -> Dict[Tuple[str, Any, str, int], Task]:
     """
     Args:
@@ -97,6 +172,9 @@ def export_images(df: pd.DataFrame,
     - n: int, sets the number of concentric rings of tiles to be exported (excludes the centroid cell)
     - mosaic_period: int, sets the interval of time, in years, for which each mosaic is created
     - subset_id: int, runs the export only for the ith batch of 2500 observations. None if no subset required.
+    - periods: list of int, start years of the periods to export (e.g. a newly available period), which must be
+      aligned with start_year and mosaic_period. None to export all periods.
+    - align_regions: bool, whether to export on pixel-aligned, latitude-corrected regions (see ALIGN_REGIONS)
 
     Returns:
     - dict of tasks.
@@ -104,37 +182,113 @@ def export_images(df: pd.DataFrame,
     If a date range is supplied that is not a multiple of the mosaic period, the remaining years will be truncated.
     The function will attempt to alert the user when this occurs.
     """
+    # Estimates generated in blocks according to provided mosaic period.
+    period_years = get_period_years(start_year, end_year, mosaic_period, periods)
+
     # Subset df if subset id is supplied
     if subset_id is not None:  # TODO: CHECK THAT ADDITIONS TO SUBSET LOGIC ACTUALLY WORKS
-        periods = math.floor((end_year - start_year) / mosaic_period)
-        batch_size = math.floor(2500 / periods)
+        num_periods = len(period_years)
+        batch_size = math.floor(2500 / num_periods)
         start = subset_id*batch_size
         end = start + batch_size
         df = df[start:end]
 
-    # Estimates generated in blocks according to provided mosaic period.
-    num_periods = math.floor((end_year - start_year) / mosaic_period)
+    # Check the number of tiles each deal will export before submitting any tasks
+    preflight_tile_counts(df, n, align_regions)
     tasks = {}
 
-    for idx, deal_id, lat, lon in df.itertuples():
-        loc = ee.Geometry.Point(lon, lat)
-        max_extent = loc.buffer(distance=7700*(n + 0.5)).bounds()    # 30m/px * 255pxs + 50m extra for variance
-        year = start_year
-        for i in range(num_periods):
+    for idx, deal_id, lat, lon in df[['deal_id', 'lat', 'lon']].itertuples():
+        max_extent, crs_transform = get_region(lat, lon, n, align_regions)
+        for year in period_years:
+            i = (year - start_year) // mosaic_period
             # Creates a cloud-free composite from all images intersecting the max_extent polygon within the interval.
             block_start = str(year) + "-01-01"
             block_end = str(year + mosaic_period - 1) + "-12-31"
-            image_col = ee_utils.LandsatSR(max_extent, block_start, block_end).merged
-            image_col = image_col.map(ee_utils.mask_qaclear).select(MS_BANDS)
+            image_col = ee_utils.LandsatSR(max_extent, block_start, block_end, mask=True).merged
+            image_col = image_col.select(MS_BANDS)
             img = image_col.median()
             img = ee_utils.add_latlon(img)   # add latitude and longitude bands
 
             filename = f'{deal_id}_{year}'
             tasks[(export_folder, deal_id, block_start, i)] = ee_utils.tfexporter(
                 image=img, scale=SCALE, region=max_extent, export=EXPORT,
-                prefix=export_folder, fname=filename, bucket=BUCKET)
+                prefix=export_folder, fname=filename, bucket=BUCKET,
+                crs=PROJECTION if align_regions else None, crs_transform=crs_transform)
+
+    return tasks
+
+
+def export_images_batched(df: pd.DataFrame,
+                          start_year: int,
+                          end_year: int,
+                          export_folder: str,
+                          n: int = 0,
+                          mosaic_period: int = 3,
+                          deals_per_task: int = 20,
+                          periods: List[int] = None,
+                          tile_plan: pd.DataFrame = None
+                          ) -> Dict[Tuple[str, int, int], Task]:
+    """
+    Exports the same tiles as export_images(), but with one median composite per period over the regions of all
+    deals, from which patches centered on the centroid of each tile are sampled server-side. Each task exports the
+    patches of deals_per_task deals as a single TFRecord, with 'deal_id' and 'tile_id' properties identifying each
+    patch, which cuts the number of tasks by a factor of deals_per_task.
+
+    Args:
+    - df: pd.Data.Frame with lat, lon, and deal_id columns
+    - start_year, end_year, export_folder, n, mosaic_period, periods: see export_images()
+    - deals_per_task: int, number of deals whose patches are exported by each task
+    - tile_plan: pd.DataFrame, tile plan of the deals from plan_tiles.py, to only export the canonical tile of each
+      cell of the global grid, in tasks of deals_per_task * (2n+1)^2 tiles. None to export the tiles of every deal.
 
-            year = year + mosaic_period
+    Returns:
+    - dict of tasks, keyed by (export_folder, year, chunk)
+    """
+    period_years = get_period_years(start_year, end_year, mosaic_period, periods)
+
+    # Check the number of tiles each deal will export before submitting any tasks (the patches are sampled on the
+    # latitude-corrected grids of the aligned regions)
+    preflight_tile_counts(df, n, align_regions=True)
+
+    # One region per deal, covering all of its tiles, to filter the Landsat collections (planned grids are shifted by
+    # up to half a tile from the deal)
+    radius = 7700*(n + 0.5) if tile_plan is None else 7700*(n + 1)
+    regions = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Point(lon, lat).buffer(distance=radius).bounds())
+        for lat, lon in zip(df['lat'], df['lon'])])
+    if tile_plan is None:
+        chunks = [df[i:i + deals_per_task] for i in range(0, len(df), deals_per_task)]
+        # Tile centroids and the sampling grid are latitude-corrected per deal, so that pixels cover SCALE ground meters
+        points = [[(ee_utils.tile_points(chunk.iloc[[j]], nrings=n, scale=SCALE),
+                    float(projected_pixel_size(lat, SCALE)))
+                   for j, lat in enumerate(chunk['lat'])]
+                  for chunk in chunks]
+    else:
+        canonical = tile_plan[(tile_plan['deal_id'] == tile_plan['canonical_deal_id'])
+                              & (tile_plan['tile_id'] == tile_plan['canonical_tile_id'])
+                              & tile_plan['deal_id'].isin(df['deal_id'])]
+        tiles_per_task = deals_per_task * (2 * n + 1) ** 2
+        chunks = [canonical[i:i + tiles_per_task] for i in range(0, len(canonical), tiles_per_task)]
+        # The planned tiles share the pixel size of their latitude zone
+        points = [[(ee_utils.planned_tile_points(zone_tiles), float(pixel_size))
+                   for pixel_size, zone_tiles in chunk.groupby('pixel_size', sort=False)]
+                  for chunk in chunks]
+
+    tasks = {}
+    for year in period_years:
+        block_start = str(year) + "-01-01"
+        block_end = str(year + mosaic_period - 1) + "-12-31"
+        image_col = ee_utils.LandsatSR(regions, block_start, block_end, mask=True).merged
+        image_col = image_col.select(MS_BANDS)
+        img = ee_utils.add_latlon(image_col.median())
+
+        for c, chunk_points in enumerate(points):
+            patches = ee.FeatureCollection([
+                ee_utils.sample_patches(img, deal_points, scale=pixel_size, projection=PROJECTION)
+                for deal_points, pixel_size in chunk_points]).flatten()
+            tasks[(export_folder, year, c)] = ee_utils.table_tfexporter(
+                collection=patches, export=EXPORT, prefix=export_folder, fname=f'batch_{year}_{c:04d}',
+                bucket=BUCKET)
 
     return tasks
 
@@ -142,15 +296,32 @@ def export_images(df: pd.DataFrame,
 # ============ RUN EXPORT FUNCTION IF SCRIPT IS RUN ==============
 
 if __name__ == '__main__':
+    # Initialize Earth Engine and load location candidates
+    ee.Initialize()
+    DATASET = pd.read_csv(CSV_PATH)
+
     # Checks if size of request exceeds EE maximums for simultaneous jobs
-    if len(DATASET)*(math.floor((END_YEAR - START_YEAR) / MOSAIC_PERIOD)) > 3000:
+    if TILE_PLAN_PATH is not None and not BATCHED:
+        raise ValueError('TILE_PLAN_PATH requires BATCHED = True')
+    if BATCHED:
+        tile_plan = pd.read_csv(TILE_PLAN_PATH) if TILE_PLAN_PATH is not None else None
+        tasks = export_images_batched(df=DATASET, start_year=START_YEAR, end_year=END_YEAR,
+                                      export_folder=EXPORT_FOLDER, n=NRINGS, mosaic_period=MOSAIC_PERIOD,
+                                      deals_per_task=DEALS_PER_TASK, periods=NEW_PERIODS, tile_plan=tile_plan)
+        print(f"Success! Image patches are exporting in {len(tasks)} tasks.")
+    elif NEW_PERIODS is not None:
+        # Incremental update: only export the new periods (subsetting by batch is not needed for a few periods)
+        export_images(df=DATASET, start_year=START_YEAR, end_year=END_YEAR, export_folder=EXPORT_FOLDER,
+                      n=NRINGS, mosaic_period=MOSAIC_PERIOD, periods=NEW_PERIODS, align_regions=ALIGN_REGIONS)
+        print(f"Success! Image patches for periods {NEW_PERIODS} are exporting.")
+    elif len(DATASET)*(math.floor((END_YEAR - START_YEAR) / MOSAIC_PERIOD)) > 3000:
         subset_ids = get_batch_ids(DATASET, START_YEAR, END_YEAR, MOSAIC_PERIOD)
         print(f'Too many tiles to export at once. Subset IDs are: {subset_ids}')
         subset = int(input("Enter Subset ID to export: "))
         export_images(df=DATASET, start_year=START_YEAR, end_year=END_YEAR, export_folder=EXPORT_FOLDER,
-                      n=NRINGS, mosaic_period=MOSAIC_PERIOD, subset_id=subset)
+                      n=NRINGS, mosaic_period=MOSAIC_PERIOD, subset_id=subset, align_regions=ALIGN_REGIONS)
         print("Success! Re-run this script for each additional subset ID as needed.")
     else:
         export_images(df=DATASET, start_year=START_YEAR, end_year=END_YEAR, export_folder=EXPORT_FOLDER,
-                      n=NRINGS, mosaic_period=MOSAIC_PERIOD, subset_id=None)
+                      n=NRINGS, mosaic_period=MOSAIC_PERIOD, subset_id=None, align_regions=ALIGN_REGIONS)
         print("Success! All image patches are exporting.")
@@ -0,0 +1,238 @@
+# This script downloads completed Earth Engine exports from the export bucket and splits them into per-tile TFRecords,
+# replacing the two serial passes of `gsutil rsync` followed by process_tfrecords.py. Downloads run in a pool of
+# MAX_DOWNLOADS threads, and each .gz export is decompressed as it is streamed in. As soon as a file has been downloaded
+# it is validated and split by one of NUM_WORKERS processes, while other files are still downloading. Network,
+# decompression and CPU work therefore overlap.
+#
+# Objects in the bucket only appear once their export task has completed, so any matching file can be fetched. Exports
+# whose tiles already exist in PROCESSED_DIR are skipped, as are files already in RAW_DIR, so the script can be re-run
+# while exports are still running (or after an interruption) to pick up the remaining files. Exports with no Landsat
+# imagery or the wrong number of tiles are not split (see split_tfrecord() in process_tfrecords.py); they are listed
+# in LOG_PATH, which replaces the lists written by clean_tfrecords.sh.
+#
+# Set SHARD_BY to write the tiles to multi-tile shards in SHARD_DIR instead (see SHARD_BY in process_tfrecords.py).
+# The shards are then written by a single thread of this process, which splits the downloaded files one at a time,
+# since a ShardWriterPool cannot be shared between processes; downloads still overlap with splitting. Exports whose
+# tiles are already listed in the shard index are skipped.
+#
+# SOURCE can also be a local directory (e.g. a copy of the bucket), which is useful for testing.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.fetch_tfrecords
+
+
+import asyncio
+import contextlib
+import gzip
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from preprocessing import process_tfrecords
+from utils.storage import Storage, get_storage
+from utils.tile_shards import INDEX_FILENAME, ShardWriterPool, load_shard_index
+
+
+# ==================== PARAMETERS ======================
+
+SOURCE = 'gs://msc-imagery/tfrecords_raw'       # 'gs://{BUCKET}/{EXPORT_FOLDER}' in export_images.py, or a local dir
+RAW_DIR = 'data/tfrecords_raw'                  # decompressed exports, as read by process_tfrecords.py
+PROCESSED_DIR = 'data/tfrecords'
+CSV_PATH = './data/intermediate/earthengine_locs.csv'
+LOG_PATH = 'data/fetch_log.csv'
+
+# Set BATCHED = True if images were exported with BATCHED = True in export_images.py (multiple deals per TFRecord).
+BATCHED = False
+
+# Set SHARD_BY = 'period' or 'deal' to write tiles to multi-tile shards in SHARD_DIR, as in process_tfrecords.py.
+SHARD_BY = None
+SHARD_DIR = 'data/tfrecord_shards'
+
+# Specify start years of new periods to fetch (e.g. [2021]) for an incremental update, or None to fetch all years.
+NEW_PERIODS = None
+
+MAX_DOWNLOADS = 8                   # number of concurrent downloads
+NUM_WORKERS = os.cpu_count() or 1   # number of processes splitting downloaded TFRecords
+KEEP_RAW = True                     # set to False to delete each raw TFRecord from RAW_DIR once it has been split
+
+
+# ==================== FETCH AND PROCESS ======================
+
+def select_exports(names: List[str], locs: Dict[int, Tuple[float, float]], years: Optional[List[int]] = None,
+                   batched: bool = False) -> List[Tuple[str, Optional[int], int]]:
+    """
+    Selects the exported TFRecords to fetch from the names of the files in the export bucket.
+
+    Args:
+    - names: list of str, names of the files in the bucket (other files, e.g. EE mixer files, are ignored)
+    - locs: dict, maps each deal_id to its (lat, lon); exports of other deals are skipped
+    - years: list of int, only select TFRecords for these years, None for all years
+    - batched: bool, select batched exports ('batch_{year}_{chunk}.tfrecord.gz') instead of per-deal exports
+
+    Returns:
+    - list of (name, deal_id, year) tuples, where deal_id is None for batched exports
+    """
+    exports = []
+    for name in names:
+        basename = os.path.basename(name)
+        if batched:
+            match = process_tfrecords.BATCH_FILENAME_RE.match(basename)
+            if match is None:
+                continue
+            deal_id, year = None, int(match.group(1))
+        else:
+            match = process_tfrecords.DEAL_FILENAME_RE.match(basename)
+            if match is None or int(match.group(1)) not in locs:
+                continue
+            deal_id, year = int(match.group(1)), int(match.group(2))
+        if years is not None and year not in years:
+            continue
+        exports.append((name, deal_id, year))
+    return exports
+
+
+def fetch(storage: Storage, name: str, raw_dir: str) -> str:
+    """
+    Downloads a file from storage into raw_dir, decompressing it while it is streamed if its name ends with '.gz'.
+    The file is written to a temporary name and then renamed, so files in raw_dir are always complete.
+
+    Args:
+    - storage: Storage, the export bucket
+    - name: str, name of the file in storage
+    - raw_dir: directory in which to save the file
+
+    Returns:
+    - str, path to the (decompressed) file in raw_dir
+    """
+    basename = os.path.basename(name)
+    output_path = os.path.join(raw_dir, basename[:-len('.gz')] if basename.endswith('.gz') else basename)
+    if os.path.exists(output_path):
+        return output_path
+
+    tmp_path = output_path + '.partial'
+    with storage.open(name) as src, open(tmp_path, 'wb') as dst:
+        if basename.endswith('.gz'):
+            with gzip.GzipFile(fileobj=src) as unzipped:
+                shutil.copyfileobj(unzipped, dst, length=1024 * 1024)
+        else:
+            shutil.copyfileobj(src, dst, length=1024 * 1024)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def split_export(path: str, deal_id: Optional[int], year: int, locs: Dict[int, Tuple[float, float]],
+                 processed_dir: str, pool: Optional[ShardWriterPool] = None, shard_by: Optional[str] = None) -> str:
+    """
+    Validates and splits a downloaded TFRecord into per-tile TFRecords, or into the shards of pool. Runs in a worker
+    process, or in the thread that owns pool.
+
+    Returns:
+    - str, status of a per-deal export (see split_tfrecord() in process_tfrecords.py), or 'ok' for batched exports
+    """
+    if deal_id is None:
+        process_tfrecords.split_batched_tfrecord(path, year, locs, processed_dir, pool=pool, shard_by=shard_by)
+        return 'ok'
+    lat, lon = locs[deal_id]
+    return process_tfrecords.split_tfrecord(path, deal_id, year, lat, lon, processed_dir, pool=pool, shard_by=shard_by)
+
+
+async def fetch_and_process(storage: Storage, exports: List[Tuple[str, Optional[int], int]],
+                            locs: Dict[int, Tuple[float, float]], raw_dir: str, processed_dir: str,
+                            max_downloads: int = 8, num_workers: int = 1, keep_raw: bool = True,
+                            shard_by: Optional[str] = None) -> pd.DataFrame:
+    """
+    Downloads exports with at most max_downloads concurrent downloads, and splits each one in a pool of num_workers
+    processes as soon as its download completes. If shard_by is set, exports are instead split one at a time by a
+    single thread that writes the tiles to the shards in processed_dir.
+
+    Args:
+    - storage: Storage, the export bucket
+    - exports: list of (name, deal_id, year) tuples, from select_exports()
+    - locs: dict, maps each deal_id to its (lat, lon)
+    - raw_dir: directory in which to save downloaded TFRecords
+    - processed_dir: directory in which to save processed TFRecord files
+    - max_downloads: int, number of concurrent downloads
+    - num_workers: int, number of processes splitting TFRecords
+    - keep_raw: bool, keep downloaded TFRecords in raw_dir after they have been split
+    - shard_by: str, None to write one TFRecord per tile, or 'period' or 'deal' to write tiles to multi-tile shards
+      in processed_dir (see SHARD_BY in process_tfrecords.py)
+
+    Returns:
+    - pd.DataFrame with one row per export: name, deal_id, year, status ('error: ...' if its download or split
+      failed), and the download and split times in seconds
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    downloads = asyncio.Semaphore(max_downloads)
+    threads = ThreadPoolExecutor(max_workers=max_downloads)
+    pool = process_tfrecords.shard_writer_pool(processed_dir, shard_by)
+    if pool is None:
+        # 'spawn' so that workers do not inherit TensorFlow state from the parent process
+        processes = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+        split = split_export
+    else:
+        # the shards are written by a single thread, which owns the pool
+        processes = ThreadPoolExecutor(max_workers=1)
+        split = partial(split_export, pool=pool, shard_by=shard_by)
+
+    async def handle(name: str, deal_id: Optional[int], year: int) -> dict:
+        start = downloaded = time.perf_counter()
+        try:
+            async with downloads:
+                path = await loop.run_in_executor(threads, fetch, storage, name, raw_dir)
+            downloaded = time.perf_counter()
+            status = await loop.run_in_executor(processes, split, path, deal_id, year, locs, processed_dir)
+            if not keep_raw and status == 'ok':
+                os.remove(path)
+        except Exception as e:
+            # e.g. a truncated or corrupt download: record it, and carry on with the other exports
+            status = f'error: {type(e).__name__}: {e}'
+        return {'name': name, 'deal_id': deal_id, 'year': year, 'status': status,
+                'download_seconds': downloaded - start, 'split_seconds': time.perf_counter() - downloaded}
+
+    rows = []
+    try:
+        with pool or contextlib.nullcontext():
+            futures = [handle(*export) for export in exports]
+            for k, future in enumerate(asyncio.as_completed(futures)):
+                row = await future
+                rows.append(row)
+                print(f'[{k + 1}/{len(exports)}] {row["name"]}: {row["status"]}')
+    finally:
+        threads.shutdown()
+        processes.shutdown()
+    return pd.DataFrame(rows, columns=['name', 'deal_id', 'year', 'status', 'download_seconds', 'split_seconds'])
+
+
+if __name__ == '__main__':
+    df = pd.read_csv(CSV_PATH, float_precision='high', index_col=False)
+    locs = dict(zip(df['deal_id'], zip(df['lat'], df['lon'])))
+
+    storage = get_storage(SOURCE)
+    exports = select_exports(storage.list(), locs, years=NEW_PERIODS, batched=BATCHED)
+    processed_dir = SHARD_DIR if SHARD_BY is not None else PROCESSED_DIR
+    if not BATCHED and SHARD_BY is not None:
+        # the tiles of a per-deal export are only written to the shards once all of them are valid
+        sharded = set()
+        if os.path.exists(os.path.join(SHARD_DIR, INDEX_FILENAME)):
+            index = load_shard_index(SHARD_DIR)
+            sharded = set(zip(index['deal_id'], index['year']))
+        exports = [(name, deal_id, year) for name, deal_id, year in exports if (deal_id, year) not in sharded]
+    elif not BATCHED:
+        exports = [(name, deal_id, year) for name, deal_id, year in exports
+                   if not process_tfrecords.tiles_exist(PROCESSED_DIR, deal_id, year)]
+    print(f'Fetching {len(exports)} exports from {SOURCE} with {MAX_DOWNLOADS} downloads and {NUM_WORKERS} workers')
+
+    start = time.perf_counter()
+    log = asyncio.run(
+        fetch_and_process(storage, exports, locs, raw_dir=RAW_DIR, processed_dir=processed_dir,
+                          max_downloads=MAX_DOWNLOADS, num_workers=NUM_WORKERS, keep_raw=KEEP_RAW, shard_by=SHARD_BY))
+    log.to_csv(LOG_PATH, index=False)
+    print(f'Done in {time.perf_counter() - start:.0f}s: {log["status"].value_counts().to_dict()}. '
+          f'Saved log to {LOG_PATH}')
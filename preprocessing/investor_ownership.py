@@ -0,0 +1,69 @@
+# This script resolves the ultimate owners of the operating company of every deal, from the ownership relations
+# between investors in the LandMatrix involvements (see InvestorGraph in utils/investor_graph.py), as heterogeneity
+# variables for the analysis. For each deal, it saves the ultimate owner with the largest share of the operating
+# company, its name, country and classification, whether that country differs from the country of the deal, the
+# number of ultimate owners and of ancestors of the operating company, and whether its ownership involves a cycle.
+# The columns are saved to OUTPUT_PATH, keyed by deal_id, and joined into the panel by merge_and_validate.R.
+#
+# Requires the deal table written by process_landmatrix.py, and pyarrow.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.investor_ownership
+
+
+import pandas as pd
+
+from utils.investor_graph import InvestorGraph
+from utils.landmatrix import LandMatrixTables
+
+
+# ==================== PARAMETERS ======================
+
+RAW_DIR = 'data/raw/landmatrix'
+CACHE_DIR = 'data/intermediate/landmatrix'     # as in process_landmatrix.py
+LSLA_PATH = 'data/intermediate/lsla.parquet'
+OUTPUT_PATH = 'data/intermediate/deal_owners.csv'
+
+RELATION_TYPES = ['Parent company']            # involvements that are ownership, i.e. excluding lenders
+
+
+# ==================== INVESTOR OWNERSHIP ======================
+
+def deal_owners(lsla: pd.DataFrame, investors: pd.DataFrame, involvements: pd.DataFrame,
+                relation_types: list = RELATION_TYPES) -> pd.DataFrame:
+    """
+    Args:
+        - lsla: Deals, with deal_id, investor_id (of the operating company) and country
+        - investors, involvements: Tables of the LandMatrix, see utils/landmatrix.py
+        - relation_types: Relation types of the involvements that are ownership
+
+    Returns:
+        - DataFrame with the ultimate owners of each deal whose operating company is known, see
+          InvestorGraph.deal_owners(), and the name, country and classification of the largest one
+    """
+    graph = InvestorGraph.from_tables(investors, involvements, relation_types)
+    graph.resolve_all()
+    cycles = graph.cycles()
+    if cycles:
+        print(f'Found {len(cycles)} cycles of ownership between investors: {[c.tolist() for c in cycles]}')
+
+    owners = graph.deal_owners(lsla['deal_id'], lsla['investor_id'])
+    attributes = investors[['investor_id', 'name', 'country_of_registration/origin', 'classification']] \
+        .drop_duplicates('investor_id') \
+        .rename(columns={'investor_id': 'ultimate_owner_id', 'name': 'ultimate_owner_name',
+                         'country_of_registration/origin': 'ultimate_owner_country',
+                         'classification': 'ultimate_owner_classification'})
+    owners = owners.merge(attributes, on='ultimate_owner_id', how='left')
+
+    countries = owners['deal_id'].map(lsla.drop_duplicates('deal_id').set_index('deal_id')['country'])
+    owners['foreign_owner'] = (owners['ultimate_owner_country'] != countries).astype('Int64')
+    owners.loc[owners['ultimate_owner_country'].isna() | countries.isna(), 'foreign_owner'] = pd.NA
+    return owners
+
+
+if __name__ == '__main__':
+    tables = LandMatrixTables(RAW_DIR, CACHE_DIR)
+    lsla = pd.read_parquet(LSLA_PATH)
+    owners = deal_owners(lsla, tables.load('investors'), tables.load('involvements'))
+    owners.to_csv(OUTPUT_PATH, index=False)
+    print(f'Saved ultimate owners of {len(owners)} of {lsla["deal_id"].nunique()} deals to {OUTPUT_PATH}')
@@ -0,0 +1,47 @@
+# This script plans the tiles of all deals on a global grid, so that tiles shared by the overlapping grids of nearby
+# deals are only exported, processed and run through the CNN once. Each deal's (2*NRINGS+1)^2 tiles are snapped to
+# the cells of a global EPSG:3857 grid of 255px tiles (~7.65km at SCALE = 30m/px, see plan_tiles() in
+# utils/tile_geometry.py), and cells referenced by several deals are detected by hashing their grid coordinates. The
+# plan lists every (deal_id, tile_id) with the canonical (deal_id, tile_id) of its grid cell.
+#
+# To use the plan, set TILE_PLAN_PATH to OUTPUT_PATH in every script that exports or locates the tiles:
+# - export_images.py (with BATCHED = True), which then only exports the canonical tiles
+# - extract_features.py, which then rejects MOSAIC = True, since the mosaics of deals sharing tiles are incomplete
+# - predict_assets.py, which maps the predictions of each canonical tile back to every tile of every deal that
+#   references it
+# - deal_exposure.py, concession_coverage.py and analysis/randomization_inference.py, which then read the centroid
+#   (and pixel size) of each tile from the plan
+# Snapping shifts each deal's grid by up to half a tile from being centered on the deal, so scripts that are not given
+# the plan would locate the tiles on grids centered on the deals instead.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.plan_tiles
+
+
+import pandas as pd
+
+from utils.tile_geometry import plan_tiles
+
+
+# ==================== PARAMETERS ======================
+
+CSV_PATH = 'data/intermediate/earthengine_locs.csv'   # deal_id, lat and lon of each deal
+OUTPUT_PATH = 'data/intermediate/tile_plan.csv'
+NRINGS = 2             # as in export_images.py
+SCALE = 30
+ZONE_DEG = 1.0         # height of the latitude zones sharing a pixel size, in degrees
+
+
+# ==================== PLAN TILES ======================
+
+if __name__ == '__main__':
+    df = pd.read_csv(CSV_PATH, float_precision='high')
+    plan = plan_tiles(df['deal_id'].to_numpy(), df['lon'].to_numpy(), df['lat'].to_numpy(),
+                      nrings=NRINGS, scale=SCALE, zone_deg=ZONE_DEG)
+    plan.to_csv(OUTPUT_PATH, index=False)
+
+    num_unique = plan.groupby(['canonical_deal_id', 'canonical_tile_id']).ngroups
+    num_shared = (plan.groupby(['zone', 'col', 'row']).size() > 1).sum()
+    print(f'{len(df)} deals reference {len(plan)} tiles, of which {num_unique} are unique '
+          f'({num_shared} are shared by several deals): {1 - num_unique / len(plan):.1%} fewer tiles to export')
+    print(f'Saved tile plan to {OUTPUT_PATH}')
@@ -1,5 +1,13 @@
 # This script uses weights trained using ridge regression on extracted features from extract_features.py to predict
 # household assets.
+#
+# With NEW_PERIODS set, only the new periods are predicted and appended to OUTPUT_PATH. If the merged panel written by
+# merge_and_validate.R exists at PANEL_PATH, the new periods are also added to it (see panel_rows() in utils/panel.py),
+# recomputing the lags and leads of only the (deal_id, tile_id) groups that received new rows, so that
+# analysis/randomization_inference.py can use them without re-running merge_and_validate.R. The yearly covariates
+# joined from other files (institutions scores, deal exposure, concession coverage) are left missing for the new rows
+# and the outlier filter of merge_and_validate.R is not applied to them; re-run merge_and_validate.R for those, and to
+# update mdta.RData, which the R analyses read.
 
 import numpy as np
 import pandas as pd
@@ -7,28 +15,63 @@ import os
 import math
 from glob import glob
 
+from utils.location_index import deal_location_index
+from utils.panel import add_differences, append_rows, panel_rows, update_panel
+
 # Parameters
 MODEL_FOLDS = ['A', 'B', 'C', 'D', 'E']
 MODEL_DIR = 'outputs/ms_incountry'
-FEATURES_PATHS = {i: glob(os.path.join(MODEL_DIR, f'DHS_Incountry_{i}_*', 'features.npz'))[0] for i in MODEL_FOLDS}
+WEIGHTS_PATH = 'outputs/ridge_weights.npz'
+OUTPUT_PATH = 'data/asset_predictions.csv'
+PANEL_PATH = 'data/mdta.csv'    # merged panel from merge_and_validate.R, updated with NEW_PERIODS if it exists
+NRINGS = 2
+NEW_PERIODS = None     # to only predict newly added periods and append them to OUTPUT_PATH, e.g. [2021]
+LOCS_PATH = 'data/intermediate/earthengine_locs.csv'
+DEALS_PATH = 'data/raw/landmatrix/deals.csv'
+COUNTRY_CODES_PATH = 'data/intermediate/country_to_code.csv'
+TILE_PLAN_PATH = None  # tile plan from plan_tiles.py, if tiles were exported with it
+
+
+def load_weights(weights_path: str):
+    """
+    Args:
+        - weights_path: Path to .npz file of ridge weights with keys '{fold}_w' and '{fold}_b'
 
+    Returns:
+        - weights_dict: dict mapping each key to its array
+    """
+    npz = np.load(weights_path)
+    weights_dict = {}
+    for key, value in npz.items():
+        weights_dict[key] = value
+    return weights_dict
 
-# Load Model Weights
-npz = np.load('outputs/ridge_weights.npz')
-weights_dict = {}
-for key, value in npz.items():
-    weights_dict[key] = value
 
-# Load Features and Predictions for Each Model
-features_dict = {}
-labels_dict = {}
-years_dict = {}
-for fold in MODEL_FOLDS:
-    features_path = FEATURES_PATHS[fold]
-    npz = np.load(features_path)
-    features_dict[fold] = npz['features']
-    labels_dict[fold] = npz['labels']
-    years_dict[fold] = npz['years']
+def load_features(model_dir: str, model_folds: list, years: list = None):
+    """
+    Args:
+        - model_dir: Directory containing a DHS_Incountry_{fold}_* subdirectory with features.npz for each fold
+        - model_folds: List of folds
+        - years: Only load tiles for these years, None to load all tiles
+
+    Returns:
+        - features_dict, labels_dict, years_dict, locs_dict: dicts mapping each fold to its features, labels, years
+          and locations
+    """
+    features_paths = {i: glob(os.path.join(model_dir, f'DHS_Incountry_{i}_*', 'features.npz'))[0] for i in model_folds}
+    features_dict = {}
+    labels_dict = {}
+    years_dict = {}
+    locs_dict = {}
+    for fold in model_folds:
+        features_path = features_paths[fold]
+        npz = np.load(features_path)
+        mask = np.isin(npz['years'], years) if years is not None else slice(None)
+        features_dict[fold] = npz['features'][mask]
+        labels_dict[fold] = npz['labels'][mask]
+        years_dict[fold] = npz['years'][mask]
+        locs_dict[fold] = npz['locs'][mask]
+    return features_dict, labels_dict, years_dict, locs_dict
 
 
 def predict_assets(feature_dict: dict,
@@ -91,22 +134,93 @@ def get_ring_ids(rings):
     return ring_map
 
 
-# ==================== INFERENCE =====================
+def build_dataframe(predicted_assets: list, tile_ids: list, years: list, rings: int = NRINGS,
+                    country_codes: list = None):
+    """
+    Args:
+        - predicted_assets: Asset predictions for each tile
+        - tile_ids: Tile labels as str, formatted '{deal_id}{tile_id:03d}'
+        - years: Year of each tile
+        - rings: Number of concentric rings of tiles around each deal
+        - country_codes: ISO3 code of the country of each tile, None to leave it to merge_and_validate.R
+
+    Returns:
+        - dataframe: DataFrame with asset predictions and tile characteristics
+    """
+    # Get mapping from tile_id to which concentric ring the tile falls into
+    ring_map = get_ring_ids(rings)
+
+    # Construct dataframe with asset predictions and tile characteristics
+    dataframe = pd.DataFrame()
+    dataframe['assets'] = predicted_assets
+    dataframe['deal_id'] = [tile_id[0:-3] for tile_id in tile_ids]
+    dataframe['tile_id'] = [tile_id[-3:] for tile_id in tile_ids]
+    dataframe['level'] = [ring_map[int(tile_id[-3:])] for tile_id in tile_ids]
+    dataframe['year'] = years
+    if country_codes is not None:
+        dataframe['country_code'] = country_codes
+    return dataframe
+
+
+def expand_planned_tiles(dataframe: pd.DataFrame, tile_plan: pd.DataFrame):
+    """
+    Maps the predictions for the canonical tiles of a tile plan (i.e. the tiles that were exported) back to every tile
+    of every deal that references the same cell of the global grid.
 
-# Predict household material assets from extracted features using weights from ridge regression
-predicted_assets, tile_ids, years = predict_assets(features_dict, weights_dict, labels_dict, years_dict)
+    Args:
+        - dataframe: DataFrame from build_dataframe(), for the canonical tiles
+        - tile_plan: Tile plan from plan_tiles.py
 
-# Get mapping from tile_id to which concentric ring the tile falls into
-ring_map = get_ring_ids(2)
+    Returns:
+        - dataframe: DataFrame with a row for every (deal_id, tile_id) of the plan and year, and the level of each tile
+          in the grid of its own deal
+    """
+    plan = tile_plan[['deal_id', 'tile_id', 'level', 'canonical_deal_id', 'canonical_tile_id']].astype(
+        {'deal_id': str, 'canonical_deal_id': str})
+    plan['tile_id'] = plan['tile_id'].map('{:03d}'.format)
+    plan['canonical_tile_id'] = plan['canonical_tile_id'].map('{:03d}'.format)
+    predictions = dataframe.drop(columns='level').rename(
+        columns={'deal_id': 'canonical_deal_id', 'tile_id': 'canonical_tile_id'})
+    expanded = predictions.merge(plan, on=['canonical_deal_id', 'canonical_tile_id'], how='inner')
+    return expanded[[*dataframe.columns]]
 
-# Construct dataframe with asset predictions and tile characteristics
-dataframe = pd.DataFrame()
-dataframe['assets'] = predicted_assets
-dataframe['deal_id'] = [tile_id[0:4] for tile_id in tile_ids]
-dataframe['tile_id'] = [tile_id[4:8] for tile_id in tile_ids]
-dataframe['level'] = [ring_map[int(tile_id[4:8])] for tile_id in tile_ids]
-dataframe['year'] = years
 
-# Save dataframe in data directory
-dataframe.to_csv("data/asset_predictions.csv")
+# ==================== INFERENCE =====================
 
+if __name__ == '__main__':
+    # Load model weights, and features and predictions for each model
+    weights_dict = load_weights(WEIGHTS_PATH)
+    features_dict, labels_dict, years_dict, locs_dict = load_features(MODEL_DIR, MODEL_FOLDS, years=NEW_PERIODS)
+
+    # Predict household material assets from extracted features using weights from ridge regression
+    predicted_assets, tile_ids, years = predict_assets(features_dict, weights_dict, labels_dict, years_dict)
+
+    # Country of each tile, looked up by the location of its deal (deals without a country code are left empty)
+    loc_index = deal_location_index(LOCS_PATH, DEALS_PATH, COUNTRY_CODES_PATH)
+    country_codes = loc_index.lookup_names(locs_dict['A'])
+    dataframe = build_dataframe(predicted_assets, tile_ids, years, NRINGS, country_codes)
+    if TILE_PLAN_PATH is not None:
+        dataframe = expand_planned_tiles(dataframe, pd.read_csv(TILE_PLAN_PATH))
+        # Tiles referenced by several deals take the country of their own deal, not that of the canonical tile's deal
+        deal_locs = pd.read_csv(LOCS_PATH, float_precision='high')
+        deal_countries = pd.Series(loc_index.lookup_names(deal_locs[['lat', 'lon']].to_numpy()),
+                                   index=deal_locs['deal_id'].astype(str))
+        dataframe['country_code'] = dataframe['deal_id'].map(deal_countries).fillna('')
+
+    # For an incremental update, append the new periods to the existing predictions
+    new_rows = dataframe
+    if NEW_PERIODS is not None and os.path.exists(OUTPUT_PATH):
+        existing = pd.read_csv(OUTPUT_PATH, index_col=0, dtype={'deal_id': str, 'tile_id': str})
+        dataframe = append_rows(existing, dataframe)
+
+    # Save dataframe in data directory
+    dataframe.to_csv(OUTPUT_PATH)
+
+    # For an incremental update, also add the new periods to the merged panel, recomputing the lags and leads of the
+    # (deal_id, tile_id) groups whose years changed
+    if NEW_PERIODS is not None and PANEL_PATH is not None and os.path.exists(PANEL_PATH):
+        panel = pd.read_csv(PANEL_PATH)
+        new_rows = panel_rows(panel, new_rows.astype({'deal_id': np.int64, 'tile_id': np.int64}))
+        panel = add_differences(update_panel(panel, new_rows))
+        panel.to_csv(PANEL_PATH, index=False)
+        print(f'Added {len(new_rows)} rows for periods {NEW_PERIODS} to {PANEL_PATH}')
@@ -0,0 +1,43 @@
+# This script builds the table of deals (lsla) from the raw LandMatrix export in RAW_DIR, as process_landmatrix.R does,
+# without re-exporting the raw CSVs first: their quoted, multi-line fields are parsed directly. Each raw table is parsed
+# once into a typed Parquet cache in CACHE_DIR, keyed by the SHA-256 hash of its source file, so re-runs only parse the
+# tables whose source changed (see LandMatrixTables in utils/landmatrix.py). The locations of the deals are validated
+# against the GeoJSON export, as in validate_landmatrix.R.
+#
+# Writes lsla.parquet, which merge_and_validate.R reads instead of lsla.RData if it exists, and the deal locations and
+# years used by export_images.py, plan_tiles.py and deal_exposure.py. process_landmatrix.R is still needed for the
+# locations.RData and areas.RData used by the plots.
+#
+# Requires pyarrow.
+#
+# Usage (from the repository root):
+#     python -m preprocessing.process_landmatrix
+
+
+import os
+
+from utils.landmatrix import LandMatrixTables, build_lsla, compare_locations
+
+
+# ==================== PARAMETERS ======================
+
+RAW_DIR = 'data/raw/landmatrix'
+CACHE_DIR = 'data/intermediate/landmatrix'
+LSLA_PATH = 'data/intermediate/lsla.parquet'
+EARTHENGINE_LOCS_PATH = 'data/intermediate/earthengine_locs.csv'   # deal_id, lat and lon, for export_images.py
+DEAL_YEARS_PATH = 'data/intermediate/deal_years.csv'               # for deal_exposure.py
+
+
+# ==================== PROCESS LANDMATRIX ======================
+
+if __name__ == '__main__':
+    tables = LandMatrixTables(RAW_DIR, CACHE_DIR).load_all()
+    lsla = build_lsla(tables)
+    if 'locations_geojson' in tables:
+        compare_locations(lsla, tables['locations_geojson'])
+
+    os.makedirs(os.path.dirname(LSLA_PATH), exist_ok=True)
+    lsla.to_parquet(LSLA_PATH, index=False)
+    lsla[['deal_id', 'lat', 'lon']].to_csv(EARTHENGINE_LOCS_PATH, index=False)
+    lsla[['deal_id', 'lat', 'lon', 'year_signed', 'year_operational']].to_csv(DEAL_YEARS_PATH, index=False)
+    print(f'Saved {len(lsla)} deals to {LSLA_PATH}, {EARTHENGINE_LOCS_PATH} and {DEAL_YEARS_PATH}')
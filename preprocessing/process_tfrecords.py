@@ -1,9 +1,14 @@
+import contextlib
 import os
+import re
 from glob import glob
 
+import numpy as np
 import tensorflow as tf
 import pandas as pd
 
+from utils.tile_shards import ShardWriterPool
+
 
 # ==================== PARAMETERS ===================
 
@@ -14,6 +19,14 @@ PROCESSED_DIR = 'data/tfrecords'
 # Specify CSV file with locations to export
 CSV_PATH = './data/intermediate/earthengine_locs.csv'
 
+# Set BATCHED = True if images were exported with BATCHED = True in export_images.py (multiple deals per TFRecord).
+BATCHED = False
+BATCH_FILENAME_RE = re.compile(r'^batch_(\d{4})_\d+.*\.tfrecord(\.gz)?$')
+DEAL_FILENAME_RE = re.compile(r'^(\d+)_(\d{4})\.tfrecord(\.gz)?$')           # '{deal_id}_{year}.tfrecord(.gz)'
+
+# Specify start years of new periods to process (e.g. [2021]) for an incremental update, or None to process all years.
+NEW_PERIODS = None
+
 # Specify image bands.
 FEATURES = ['BLUE', 'GREEN', 'LAT', 'LON', 'NIR', 'RED', 'SWIR1', 'SWIR2', 'TEMP1']
 
@@ -28,90 +41,333 @@ COLUMNS = [
 # Specifies the schema for the parsed TFRecord
 FEATURE_DESCRIPTION = dict(zip(FEATURES, COLUMNS))                  # Specifies schema for each feature
 
+# Specify how bands are stored in the processed TFRecords: 'float' (a float_list per band, as read by the original
+# pipeline) or 'bytes' (the raw little-endian float32 buffer of each band, which is faster to write and parse). Must
+# match BAND_ENCODING in extract_features.py.
+BAND_ENCODING = 'float'
+
+# Set SHARD_BY = 'period' or 'deal' to write tiles to multi-tile shards in SHARD_DIR (one sequence of shards per period
+# or per deal, each up to SHARD_MAX_BYTES, with at most MAX_OPEN_SHARDS files open at once) instead of one TFRecord per
+# tile in PROCESSED_DIR, for both per-deal and batched exports (and in fetch_tfrecords.py). Shards are listed in
+# SHARD_DIR/shard_index.csv, and are read by setting SHARD_DIR in extract_features.py. Only shards by period can be
+# selected by year (e.g. for an incremental update).
+SHARD_BY = None
+SHARD_DIR = 'data/tfrecord_shards'
+SHARD_MAX_BYTES = 256 * 1024 * 1024
+MAX_OPEN_SHARDS = 16
+
 
 # ================= PARSE TFRECORDS =================
 
-def process_tfrecords(csv_path: str, input_dir: str, processed_dir: str):
+def process_tfrecords(csv_path: str, input_dir: str, processed_dir: str, years: list = None, shard_by: str = None):
     """
-    For each deal_id (i.e. observation), this function applies the parse_tfrecord function
-    to each TFRecord corresponding with a deal_id specified in the CSV path. It then splits the
-    TFRecord for every deal_id into TFRecords for each image patch associated with that deal_id,
-    preserving the id of the tile in the filename. NOTE: It expects a single TFRecord per deal_id
-    (Earth Engine will only ever output a single TFRecord for each call to ee.Export).
+    For each deal_id (i.e. observation), this function parses each TFRecord corresponding with a deal_id specified
+    in the CSV path, and splits it into TFRecords for each image patch associated with that deal_id, preserving the
+    id of the tile in the filename. Patches are streamed (see iter_tiles), so only one is held in memory at a time.
+    NOTE: It expects a single TFRecord per deal_id (Earth Engine will only ever output a single TFRecord for each
+    call to ee.Export).
 
     Args:
     - csv_path: location of CSV file to extract deal_ids from
     - input_dir: directory in which to find TFRecord files
     - output_dir: directory in which to save processed TFRecord files
+    - years: list of int, only process TFRecords for these years (e.g. a newly exported period), None for all years
+    - shard_by: str, None to write one TFRecord per tile, or 'period' or 'deal' to write tiles to multi-tile shards
+      in processed_dir (see SHARD_BY)
     """
     df = pd.read_csv(csv_path, float_precision='high', index_col=False)
     deal_ids = df['deal_id']
     lat = df['lat']
     lon = df['lon']
 
-    for k, deal_id in enumerate(deal_ids):                               # iterate over all deal_ids
-        output_dir = os.path.join(processed_dir, str(deal_id))
-        os.makedirs(output_dir, exist_ok=True)
-        tfrecord_paths = glob(os.path.join(input_dir, str(deal_id) + '*'))
-        tfrecord_paths.sort()
+    pool = shard_writer_pool(processed_dir, shard_by)
+    with pool or contextlib.nullcontext():
+        for k, deal_id in enumerate(deal_ids):                           # iterate over all deal_ids
+            output_dir = os.path.join(processed_dir, str(deal_id))
+            if pool is None:
+                os.makedirs(output_dir, exist_ok=True)
+            tfrecord_paths = glob(os.path.join(input_dir, str(deal_id) + '*'))
+            tfrecord_paths.sort()
+
+            for tfrecord in tfrecord_paths:                # iterate over all years of observation
+                year = int(tfrecord[-13:-9])               # extracts the year from the TFRecord name
+                if years is not None and year not in years:
+                    continue
+                for i, img_dict in iter_tiles(tfrecord):
+                    if pool is None:
+                        write_tile(output_dir, deal_id, year, i, lat[k], lon[k], img_dict)
+                    else:
+                        pool.write(shard_key(shard_by, deal_id, year),
+                                   serialize_tile(deal_id, year, i, lat[k], lon[k], img_dict), deal_id, year, i)
+
+
+def shard_writer_pool(shard_dir: str, shard_by: str = None):
+    """
+    Args:
+    - shard_dir: directory in which to save the shards
+    - shard_by: str, None to write one TFRecord per tile, or 'period' or 'deal' (see SHARD_BY)
 
-        for tfrecord in tfrecord_paths:                    # iterate over all years of observation
-            dataset = tf.data.TFRecordDataset(tfrecord)
-            observation_dict = parse_tfrecord(dataset, FEATURE_DESCRIPTION)
-            year = int(tfrecord[-13:-9])                   # extracts the year from the TFRecord name
+    Returns:
+    - ShardWriterPool writing to shard_dir, or None if shard_by is None
+    """
+    if shard_by not in [None, 'period', 'deal']:
+        raise ValueError(f'got {shard_by} for "shard_by"')
+    if shard_by is None:
+        return None
+    return ShardWriterPool(shard_dir, max_open=MAX_OPEN_SHARDS, max_bytes=SHARD_MAX_BYTES, group_size=NUM_OBS)
 
-            for i, img_dict in observation_dict.items():
-                output_path = os.path.join(output_dir, f'{deal_id}_{year}_{i:03d}.tfrecord.gz')
-                # Float32 cannot represent integers greater than 16777216 without rounding.
-                scalar_dict = {'lat': lat[k], 'lon': lon[k], 'year': year, 'wealthpooled': float(f'{deal_id}{i:03d}')}
-                example = encode_feature_dict(img_dict, scalar_dict)
 
-                with tf.io.TFRecordWriter(output_path) as writer:
-                    writer.write(example.SerializeToString())
+def shard_key(shard_by: str, deal_id: int, year: int):
+    """
+    Returns:
+    - the key of the sequence of shards a tile is written to: its deal_id if shard_by == 'deal', else its year
+    """
+    return deal_id if shard_by == 'deal' else year
 
 
-def parse_tfrecord(raw_dataset: tf.data.TFRecordDataset, feature_description: dict):
+def write_tile(output_dir: str, deal_id: int, year: int, i: int, lat: float, lon: float, img_dict: dict,
+               band_encoding: str = BAND_ENCODING) -> str:
     """
-   This function parses a TFRecord loaded as a TFRecordDataset into its constituent observations
-   and features. It expects the number of observations within the TFRecord dataset to match the
-   amount specified in NUM_OBS (determined by the number of concentric rings of tiles exported
-   when creating the TFRecords for each deal_id).
+    Writes a single image patch to its own TFRecord named '{deal_id}_{year}_{i:03d}.tfrecord.gz' in output_dir.
+    The TFRecord is written to a temporary name and then renamed, so tiles in output_dir are always complete.
 
     Args:
-    - raw_dataset: tf.data.TFRecordDataset, dataset to be parsed
-    - feature description: dict, schema used to parse TFRecord
+    - output_dir: directory in which to save the TFRecord
+    - deal_id, year, i: deal_id, year and tile id of the patch
+    - lat, lon: location of the deal
+    - img_dict: dict, maps each band to a tf.Tensor or np.array of its pixel values
+    - band_encoding: str, 'float' or 'bytes', see BAND_ENCODING
+
+    Returns:
+    - str, path to the TFRecord
+    """
+    output_path = os.path.join(output_dir, f'{deal_id}_{year}_{i:03d}.tfrecord.gz')
+    with tf.io.TFRecordWriter(output_path + '.partial') as writer:
+        writer.write(serialize_tile(deal_id, year, i, lat, lon, img_dict, band_encoding))
+    os.replace(output_path + '.partial', output_path)
+    return output_path
+
+
+def serialize_tile(deal_id: int, year: int, i: int, lat: float, lon: float, img_dict: dict,
+                   band_encoding: str = BAND_ENCODING) -> bytes:
+    """
+    Serializes a single image patch with its location, year and id (see write_tile).
 
     Returns:
-    - dict of observations and corresponding features
+    - bytes, the serialized tf.train.Example
     """
-    feature_description = feature_description
-    feature_dict = {}
+    # Float32 cannot represent integers greater than 16777216 without rounding.
+    scalar_dict = {'lat': lat, 'lon': lon, 'year': year, 'wealthpooled': float(f'{deal_id}{i:03d}')}
+    return encode_feature_dict(img_dict, scalar_dict, band_encoding).SerializeToString()
 
-    def parse_function(example_proto):
-        # Parse the `tf.train.Example` proto using the above dictionary.
-        return tf.io.parse_example(example_proto, feature_description)
 
-    for i, raw_record in enumerate(raw_dataset):
-        parsed_record = parse_function(raw_record)
-        feature_dict[i] = parsed_record
+def process_batched_tfrecords(csv_path: str, input_dir: str, processed_dir: str, years: list = None,
+                              shard_by: str = None):
+    """
+    Splits the multi-deal TFRecords written by export_images_batched() in export_images.py into TFRecords for each
+    image patch, with the same names and contents as those written by process_tfrecords(). Each record of a batched
+    TFRecord is a single patch, identified by its 'deal_id' and 'tile_id' properties. Records are streamed one at a
+    time, so memory use does not depend on the number of deals per file.
 
-    return feature_dict
+    Args:
+    - csv_path: location of CSV file with deal_id, lat and lon columns; patches of other deals are skipped
+    - input_dir: directory in which to find batched TFRecord files named 'batch_{year}_{chunk}*.tfrecord.gz'
+    - processed_dir: directory in which to save processed TFRecord files
+    - years: list of int, only process TFRecords for these years, None for all years
+    - shard_by: str, None to write one TFRecord per tile, or 'period' or 'deal' to write tiles to multi-tile shards
+      in processed_dir (see SHARD_BY)
+    """
+    df = pd.read_csv(csv_path, float_precision='high', index_col=False)
+    locs = dict(zip(df['deal_id'], zip(df['lat'], df['lon'])))
+
+    tfrecord_paths = sorted(glob(os.path.join(input_dir, 'batch_*.tfrecord*')))
+    pool = shard_writer_pool(processed_dir, shard_by)
+    with pool or contextlib.nullcontext():
+        for tfrecord in tfrecord_paths:
+            match = BATCH_FILENAME_RE.match(os.path.basename(tfrecord))
+            if match is None:
+                raise ValueError(f'Unexpected batched TFRecord filename: {tfrecord}')
+            year = int(match.group(1))
+            if years is not None and year not in years:
+                continue
+            split_batched_tfrecord(tfrecord, year, locs, processed_dir, pool=pool, shard_by=shard_by)
+
+
+def split_batched_tfrecord(tfrecord: str, year: int, locs: dict, processed_dir: str,
+                           pool: ShardWriterPool = None, shard_by: str = None) -> int:
+    """
+    Splits a single batched TFRecord (see process_batched_tfrecords) into TFRecords for each image patch.
+
+    Args:
+    - tfrecord: path to the batched TFRecord, optionally GZIP-compressed (if its name ends with '.gz')
+    - year: int, start year of the period of the TFRecord
+    - locs: dict, maps each deal_id to its (lat, lon); patches of other deals are skipped
+    - processed_dir: directory in which to save processed TFRecord files
+    - pool: ShardWriterPool to write the patches to instead of one TFRecord per patch in processed_dir, or None
+    - shard_by: str, 'period' or 'deal', the key of the shards in pool (see SHARD_BY)
+
+    Returns:
+    - int, number of patches written
+    """
+    num_written = 0
+    for record in iter_records(tfrecord):
+        feature = tf.train.Example.FromString(record).features.feature
+        deal_id = int(feature_values(feature['deal_id'])[0])
+        i = int(feature_values(feature['tile_id'])[0])
+        if deal_id not in locs:
+            continue
+
+        img_dict = {}
+        for band in FEATURES:
+            values = np.asarray(feature_values(feature[band]), dtype=np.float32)
+            if values.size != KERNEL_SIZE ** 2:
+                raise ValueError(f'Band {band} of tile {i} of deal {deal_id} in {tfrecord} has {values.size} '
+                                 f'values, expected {KERNEL_SIZE ** 2}')
+            img_dict[band] = values
+
+        lat, lon = locs[deal_id]
+        if pool is None:
+            output_dir = os.path.join(processed_dir, str(deal_id))
+            os.makedirs(output_dir, exist_ok=True)
+            write_tile(output_dir, deal_id, year, i, lat, lon, img_dict)
+        else:
+            pool.write(shard_key(shard_by, deal_id, year), serialize_tile(deal_id, year, i, lat, lon, img_dict),
+                       deal_id, year, i)
+        num_written += 1
+    return num_written
+
+
+def split_tfrecord(tfrecord: str, deal_id: int, year: int, lat: float, lon: float, processed_dir: str,
+                   pool: ShardWriterPool = None, shard_by: str = None) -> str:
+    """
+    Validates and splits the TFRecord exported for a single deal_id and year into TFRecords for each image patch,
+    with the same names and contents as those written by process_tfrecords(). Records are streamed one at a time,
+    and if the TFRecord turns out to be invalid, i.e. it does not have NUM_OBS patches with all FEATURES, the
+    patches written so far are removed. These are the checks that clean_tfrecords.sh makes from file sizes. When
+    writing to shards, the serialized patches are held in memory until the TFRecord has been validated, since records
+    cannot be removed from a shard.
+
+    Args:
+    - tfrecord: path to the TFRecord, optionally GZIP-compressed (if its name ends with '.gz')
+    - deal_id, year: deal_id and year of the TFRecord
+    - lat, lon: location of the deal
+    - processed_dir: directory in which to save processed TFRecord files
+    - pool: ShardWriterPool to write the patches to instead of one TFRecord per patch in processed_dir, or None
+    - shard_by: str, 'period' or 'deal', the key of the shards in pool (see SHARD_BY)
+
+    Returns:
+    - str, 'ok' if the patches were written, 'no_imagery' if only the LAT/LON bands were exported (no Landsat
+      imagery for the period), or 'wrong_tiles' if the TFRecord does not have NUM_OBS patches of KERNEL_SIZE^2 pixels
+    """
+    output_dir = os.path.join(processed_dir, str(deal_id))
+    if pool is None:
+        os.makedirs(output_dir, exist_ok=True)
+    written = []    # paths of the patches written, or serialized patches to write to pool
+    status = 'ok'
+    for i, record in enumerate(iter_records(tfrecord)):
+        if i >= NUM_OBS:
+            status = 'wrong_tiles'
+            break
+        try:
+            img_dict = parse_tile(record)
+        except tf.errors.InvalidArgumentError:
+            feature = tf.train.Example.FromString(record).features.feature
+            status = 'no_imagery' if any(band not in feature for band in FEATURES) else 'wrong_tiles'
+            break
+        if pool is None:
+            written.append(write_tile(output_dir, deal_id, year, i, lat, lon, img_dict))
+        else:
+            written.append(serialize_tile(deal_id, year, i, lat, lon, img_dict))
+    if status == 'ok' and len(written) != NUM_OBS:
+        status = 'wrong_tiles'
+
+    if pool is not None:
+        if status == 'ok':
+            for i, record in enumerate(written):
+                pool.write(shard_key(shard_by, deal_id, year), record, deal_id, year, i)
+    elif status != 'ok':
+        for path in written:
+            os.remove(path)
+    return status
+
+
+def tiles_exist(processed_dir: str, deal_id: int, year: int) -> bool:
+    """
+    Returns True if all NUM_OBS patches of deal_id and year have already been written to processed_dir.
+    """
+    output_dir = os.path.join(processed_dir, str(deal_id))
+    return all(os.path.exists(os.path.join(output_dir, f'{deal_id}_{year}_{i:03d}.tfrecord.gz'))
+               for i in range(NUM_OBS))
+
+
+def iter_records(tfrecord: str):
+    """
+    Yields the serialized records of a TFRecord one at a time, decompressing it if its name ends with '.gz'.
+    """
+    options = tf.io.TFRecordOptions(compression_type='GZIP') if tfrecord.endswith('.gz') else None
+    return tf.compat.v1.io.tf_record_iterator(tfrecord, options=options)
+
+
+def feature_values(feature: tf.train.Feature):
+    """
+    Returns the values of a tf.train.Feature, whichever type of list it holds (EE exports integer properties
+    as int64_list, and numbers and arrays as float_list).
+    """
+    return getattr(feature, feature.WhichOneof('kind')).value
+
+
+def iter_tiles(tfrecord: str, feature_description: dict = FEATURE_DESCRIPTION):
+    """
+    This generator parses the records of a raw TFRecord one at a time, so that each patch can be written as soon as it
+    is parsed and memory use does not depend on the number of patches in the TFRecord. The number of patches is
+    determined by the number of concentric rings of tiles exported when creating the TFRecords for each deal_id.
+
+    Args:
+    - tfrecord: path to the TFRecord, optionally GZIP-compressed (if its name ends with '.gz')
+    - feature_description: dict, schema used to parse the TFRecord
+
+    Yields:
+    - (i, img_dict), the index of the patch within the TFRecord and a dict mapping each band to an np.array
+    """
+    for i, record in enumerate(iter_records(tfrecord)):
+        yield i, parse_tile(record, feature_description)
+
+
+def parse_tile(record: bytes, feature_description: dict = FEATURE_DESCRIPTION) -> dict:
+    """
+    Parses a single serialized patch with the given schema (raises tf.errors.InvalidArgumentError if a band is
+    missing or has the wrong number of values).
+
+    Returns:
+    - dict, maps each band to an np.array of its pixel values (backed by the parsed tensor's buffer)
+    """
+    parsed = tf.io.parse_single_example(record, feature_description)
+    return {band: tensor.numpy() for band, tensor in parsed.items()}
 
 
-def encode_feature_dict(img_dict: dict, scalar_dict: dict):
+def encode_feature_dict(img_dict: dict, scalar_dict: dict, band_encoding: str = 'float'):
     """
     Serializes a dictionary of features so that it can be written as a TFRecord.
 
     Args:
-    -feature_dict: dict, a dictionary containing features for a single observation
+    - img_dict: dict, maps each band to a tf.Tensor or np.array of its pixel values
+    - scalar_dict: dict, maps the name of each scalar feature to its value
+    - band_encoding: str, 'float' to store each band as a float_list, or 'bytes' to store the raw little-endian
+      float32 buffer of each band as a single bytes value, copied in one block rather than value by value
 
     Returns:
     - serialized_feature_dict: tf.train.Example
     """
+    if band_encoding not in ['float', 'bytes']:
+        raise ValueError(f'got {band_encoding} for "band_encoding"')
     serialized_feature_dict = {}
 
     for key, tensor in img_dict.items():
-        feature = tf.train.Feature(float_list=tf.train.FloatList(value=tensor.numpy().flatten()))
+        values = np.ascontiguousarray(tensor, dtype='<f4')
+        if band_encoding == 'bytes':
+            feature = tf.train.Feature(bytes_list=tf.train.BytesList(value=[values.tobytes()]))
+        else:
+            feature = tf.train.Feature(float_list=tf.train.FloatList(value=values.ravel()))
         serialized_feature_dict[key] = feature
 
     for key, scalar in scalar_dict.items():
@@ -126,4 +382,12 @@ def encode_feature_dict(img_dict: dict, scalar_dict: dict):
 
 # Call the function on all deal_ids to generate individual TFRecords
 if __name__ == '__main__':
-    process_tfrecords(csv_path=CSV_PATH, input_dir=INPUT_DIR, processed_dir=PROCESSED_DIR)
+    if BATCHED:
+        process_batched_tfrecords(csv_path=CSV_PATH, input_dir=INPUT_DIR,
+                                  processed_dir=SHARD_DIR if SHARD_BY is not None else PROCESSED_DIR,
+                                  years=NEW_PERIODS, shard_by=SHARD_BY)
+    elif SHARD_BY is not None:
+        process_tfrecords(csv_path=CSV_PATH, input_dir=INPUT_DIR, processed_dir=SHARD_DIR, years=NEW_PERIODS,
+                          shard_by=SHARD_BY)
+    else:
+        process_tfrecords(csv_path=CSV_PATH, input_dir=INPUT_DIR, processed_dir=PROCESSED_DIR, years=NEW_PERIODS)
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+from collections.abc import Iterable, Sequence
+import json
+import multiprocessing
+from typing import Any, Optional
+
+import numpy as np
+
+
+LS_BANDS = ['BLUE', 'GREEN', 'RED', 'SWIR1', 'SWIR2', 'TEMP1', 'NIR']
+
+# fixed histogram ranges for each band, so that histograms computed by different workers
+# can be merged by adding their counts. Values outside the range fall into the edge bins.
+REFLECTANCE_RANGE = (0.0, 1.0)
+HIST_RANGES = {'TEMP1': (200.0, 350.0)}  # Kelvin
+NUM_BINS = 4096
+
+PERCENTILES = (0.5, 1, 2, 5, 25, 50, 75, 95, 98, 99, 99.5)
+
+
+class BandStats:
+    """Mergeable per-band pixel statistics: count, mean and sum of squared
+    deviations (M2) maintained with Welford/Chan updates in float64, plus
+    fixed-bin histograms for approximate percentiles.
+
+    Memory use is independent of the number of pixels, so statistics can be
+    accumulated over any number of tiles, and partial statistics from parallel
+    workers can be combined with merge().
+    """
+    def __init__(self, bands: Sequence[str] = LS_BANDS, num_bins: int = NUM_BINS):
+        self.bands = list(bands)
+        self.num_bins = num_bins
+        self.ranges = np.array([HIST_RANGES.get(band, REFLECTANCE_RANGE) for band in self.bands])
+
+        num_bands = len(self.bands)
+        self.count = 0
+        self.mean = np.zeros(num_bands, dtype=np.float64)
+        self.m2 = np.zeros(num_bands, dtype=np.float64)
+        self.min = np.full(num_bands, np.inf)
+        self.max = np.full(num_bands, -np.inf)
+        self.hist = np.zeros([num_bands, num_bins], dtype=np.int64)
+
+    def update(self, pixels: np.ndarray) -> None:
+        """
+        Args
+        - pixels: np.array, shape [N, num_bands], one row per pixel
+        """
+        n = len(pixels)
+        if n == 0:
+            return
+        pixels = pixels.astype(np.float64, copy=False)
+        batch_mean = pixels.mean(axis=0)
+        batch_m2 = ((pixels - batch_mean) ** 2).sum(axis=0)
+        self._merge_moments(n, batch_mean, batch_m2)
+        self.min = np.minimum(self.min, pixels.min(axis=0))
+        self.max = np.maximum(self.max, pixels.max(axis=0))
+
+        lo, hi = self.ranges[:, 0], self.ranges[:, 1]
+        bins = ((pixels - lo) / (hi - lo) * self.num_bins).astype(np.int64)
+        bins = np.clip(bins, 0, self.num_bins - 1)
+        for b in range(len(self.bands)):
+            self.hist[b] += np.bincount(bins[:, b], minlength=self.num_bins)
+
+    def merge(self, other: BandStats) -> BandStats:
+        """Merges the statistics of `other` (computed over disjoint pixels) into self."""
+        if other.bands != self.bands or other.num_bins != self.num_bins:
+            raise ValueError('Cannot merge BandStats with different bands or bins')
+        if other.count > 0:
+            self._merge_moments(other.count, other.mean, other.m2)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+            self.hist += other.hist
+        return self
+
+    def _merge_moments(self, n: int, mean: np.ndarray, m2: np.ndarray) -> None:
+        # Chan et al. (1979) parallel update
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+
+    def percentiles(self, qs: Iterable[float] = PERCENTILES) -> np.ndarray:
+        """
+        Args
+        - qs: list of float, percentiles in [0, 100]
+        Returns: np.array, shape [num_bands, len(qs)], linearly interpolated within bins
+        """
+        qs = np.asarray(list(qs), dtype=np.float64)
+        result = np.zeros([len(self.bands), len(qs)])
+        for b, (lo, hi) in enumerate(self.ranges):
+            cdf = np.concatenate([[0], np.cumsum(self.hist[b])]) / max(self.count, 1)
+            edges = np.linspace(lo, hi, self.num_bins + 1)
+            result[b] = np.interp(qs / 100, cdf, edges)
+        return result
+
+    def to_dict(self, percentiles: Iterable[float] = PERCENTILES) -> dict[str, Any]:
+        """
+        Returns: dict, JSON-serializable summary with keys
+            'num_pixels', 'means', 'std_devs', 'min', 'max', 'percentiles'
+            where all but 'num_pixels' map band => value(s)
+        """
+        percentiles = list(percentiles)
+        std_devs = np.sqrt(self.m2 / max(self.count - 1, 1))
+        pcts = self.percentiles(percentiles)
+        return {
+            'num_pixels': int(self.count),
+            'means': dict(zip(self.bands, self.mean.tolist())),
+            'std_devs': dict(zip(self.bands, std_devs.tolist())),
+            'min': dict(zip(self.bands, self.min.tolist())),
+            'max': dict(zip(self.bands, self.max.tolist())),
+            'percentiles': {
+                band: {str(q): v for q, v in zip(percentiles, pcts[b].tolist())}
+                for b, band in enumerate(self.bands)},
+        }
+
+
+def tile_pixels(example_bytes: bytes, bands: Sequence[str] = LS_BANDS,
+                crop: bool = True, clipneg: bool = True) -> np.ndarray:
+    """
+    Extracts the valid pixels of a single serialized tile, processed the same
+    way as in Batcher.process_tfrecords, but without TensorFlow ops.
+    Args
+    - example_bytes: bytes, a serialized tf.train.Example of a processed tile
+    - bands: list of str
+    - crop: bool, whether to crop the 255x255 tile to the central 224x224 pixels
+    - clipneg: bool, whether to clip negative values to 0
+    Returns: np.array, shape [N, len(bands)], type float32, excluding pixels
+        that are 0 across all bands
+    """
+    import tensorflow as tf
+
+    ex = tf.train.Example.FromString(example_bytes)
+    feature = ex.features.feature
+    img = np.stack([_band_values(feature[band]) for band in bands], axis=1)
+    if crop:
+        img = img.reshape(255, 255, len(bands))[15:-16, 15:-16].reshape(-1, len(bands))
+    if clipneg:
+        img = np.maximum(img, 0)
+    return img[np.any(img != 0, axis=1)]
+
+
+def _band_values(feature) -> np.ndarray:
+    """Returns the pixel values of a band stored as a float_list or as raw float32 bytes."""
+    if feature.WhichOneof('kind') == 'bytes_list':
+        return np.frombuffer(feature.bytes_list.value[0], dtype='<f4')
+    return np.asarray(feature.float_list.value, dtype=np.float32)
+
+
+def stats_for_files(paths: Sequence[str], bands: Sequence[str] = LS_BANDS,
+                    crop: bool = True, clipneg: bool = True) -> BandStats:
+    """
+    Streams over every record of the given TFRecord files, one record at a time.
+    """
+    import tensorflow as tf
+
+    stats = BandStats(bands)
+    for path in paths:
+        for record in tf.compat.v1.io.tf_record_iterator(path):
+            stats.update(tile_pixels(record, bands, crop=crop, clipneg=clipneg))
+    return stats
+
+
+def _stats_for_files(args: tuple) -> BandStats:
+    return stats_for_files(*args)
+
+
+def compute_band_stats(paths: Sequence[str], bands: Sequence[str] = LS_BANDS,
+                       crop: bool = True, clipneg: bool = True,
+                       num_workers: int = 1, files_per_task: int = 256,
+                       progress: bool = True) -> BandStats:
+    """
+    Computes per-band statistics in one streaming pass over TFRecord files,
+    distributing chunks of files over a pool of worker processes and merging
+    their partial statistics as they finish.
+    Args
+    - paths: list of str, paths to TFRecord files
+    - bands: list of str
+    - crop: bool, whether to only use the central 224x224 pixels of each tile
+    - clipneg: bool, whether to clip negative values to 0
+    - num_workers: int, number of worker processes
+    - files_per_task: int, number of files per task sent to a worker
+    - progress: bool, whether to show a progress bar
+    Returns: BandStats
+    """
+    from tqdm.auto import tqdm
+
+    tasks = [(paths[i:i + files_per_task], bands, crop, clipneg)
+             for i in range(0, len(paths), files_per_task)]
+    stats = BandStats(bands)
+    progbar = tqdm(total=len(paths), disable=not progress)
+    if num_workers <= 1:
+        for task in tasks:
+            stats.merge(_stats_for_files(task))
+            progbar.update(len(task[0]))
+    else:
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            for task, partial_stats in zip(tasks, pool.imap(_stats_for_files, tasks)):
+                stats.merge(partial_stats)
+                progbar.update(len(task[0]))
+    progbar.close()
+    return stats
+
+
+def save_band_stats(stats: BandStats, path: str, name: str,
+                    metadata: Optional[dict[str, Any]] = None) -> None:
+    """
+    Saves band statistics as JSON, in the format read by
+    utils.dataset_constants.load_band_stats().
+    Args
+    - stats: BandStats
+    - path: str, path to .json file
+    - name: str, name under which to register the statistics, e.g. 'LANDDEALS'
+    - metadata: dict, additional JSON-serializable entries, e.g. the source directory
+    """
+    out = {'name': name, **stats.to_dict(), **(metadata or {})}
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2)
+    print(f'Saved band statistics over {stats.count} pixels to {path}')
@@ -8,7 +8,59 @@ import tensorflow as tf
 from utils.dataset_constants import MEANS_DICT, STD_DEVS_DICT
 
 
+# number of views produced by dihedral_views()
+NUM_DIHEDRAL_VIEWS = 8
+
+
+def dihedral_views(images: tf.Tensor) -> tf.Tensor:
+    """
+    Stacks the 8 dihedral transformations (4 rotations, each with and without a
+    left-right flip) of a batch of images along the batch dimension, for
+    deterministic test-time augmentation.
+    Args
+    - images: tf.Tensor, shape [batch_size, H, W, C], H == W
+    Returns: tf.Tensor, shape [8 * batch_size, H, W, C], ordered view-major, i.e.
+        rows [v * batch_size, (v+1) * batch_size) hold view v of the whole batch
+    """
+    flipped = tf.image.flip_left_right(images)
+    views = [tf.image.rot90(img, k=k) for img in [images, flipped] for k in range(4)]
+    return tf.concat(views, axis=0)
+
+
+def undo_dihedral_views(x: tf.Tensor) -> tf.Tensor:
+    """
+    Inverts dihedral_views() on spatial outputs (e.g. conv feature maps) so that
+    every view is aligned with the original image orientation.
+    Args
+    - x: tf.Tensor, shape [8 * batch_size, h, w, C], h == w, ordered as returned by dihedral_views()
+    Returns: tf.Tensor, same shape as x
+    """
+    views = tf.split(x, NUM_DIHEDRAL_VIEWS, axis=0)
+    aligned = []
+    for v, view in enumerate(views):
+        view = tf.image.rot90(view, k=(4 - v % 4) % 4)
+        if v >= 4:
+            view = tf.image.flip_left_right(view)
+        aligned.append(view)
+    return tf.concat(aligned, axis=0)
+
+
+def average_views(x: tf.Tensor, num_views: int = NUM_DIHEDRAL_VIEWS) -> tf.Tensor:
+    """
+    Averages a view-major stacked tensor over its views.
+    Args
+    - x: tf.Tensor, shape [num_views * batch_size, ...]
+    - num_views: int
+    Returns: tf.Tensor, shape [batch_size, ...]
+    """
+    shape = tf.concat([[num_views, -1], tf.shape(x)[1:]], axis=0)
+    return tf.reduce_mean(tf.reshape(x, shape), axis=0)
+
+
 class Batcher():
+    # whether to center-crop each 255x255 tile to the 224x224 input size of the CNN
+    crop = True
+
     def __init__(self,
                  tfrecord_files: Iterable[str] | tf.Tensor,
                  label_name: Optional[str] = None,
@@ -23,7 +75,9 @@ class Batcher():
                  augment: bool = False,
                  clipneg: bool = True,
                  cache: bool = False,
-                 num_threads: int = 1):
+                 num_threads: int = 1,
+                 instrument: bool = False,
+                 band_encoding: str = 'float'):
         """
         Args
         - tfrecord_files: list of str, or a tf.Tensor (e.g. tf.placeholder) of str
@@ -52,6 +106,13 @@ class Batcher():
             - if given, subtracts mean and divides by std-dev
         - cache: bool, whether to cache this dataset in memory
         - num_threads: int, number of threads to use for parallel processing
+        - instrument: bool, whether to record tf.data statistics (latencies after
+            reading, after process_tfrecords and after batching, and prefetch buffer
+            utilization) in self.stats_aggregator, see utils/instrumentation.py
+        - band_encoding: one of ['float', 'bytes'], how image bands are stored in the TFRecords
+            - 'float': a float_list of 255*255 values per band
+            - 'bytes': the raw little-endian float32 buffer of each band, see
+                BAND_ENCODING in preprocessing/process_tfrecords.py
         """
         self.tfrecord_files = tfrecord_files
         self.label_name = label_name
@@ -65,6 +126,9 @@ class Batcher():
         self.cache = cache
         self.num_threads = num_threads
 
+        self.instrument = instrument
+        self.stats_aggregator = tf.data.experimental.StatsAggregator() if instrument else None
+
         if ls_bands not in [None, 'rgb', 'ms']:
             raise ValueError(f'got {ls_bands} for "ls_bands"')
         self.ls_bands = ls_bands
@@ -81,6 +145,10 @@ class Batcher():
             raise ValueError(f'got {nl_label} for "nl_label"')
         self.nl_label = nl_label
 
+        if band_encoding not in ['float', 'bytes']:
+            raise ValueError(f'got {band_encoding} for "band_encoding"')
+        self.band_encoding = band_encoding
+
     def get_batch(self) -> tuple[tf.Operation, dict[str, tf.Tensor]]:
         """Gets the tf.Tensors that represent a batch of data.
         Returns
@@ -121,11 +189,13 @@ class Batcher():
         # filter out unwanted TFRecords
         if getattr(self, 'filter_fn', None) is not None:
             dataset = dataset.filter(self.filter_fn)  # type: ignore
+        dataset = self.add_latency_stats(dataset, 'read_latency')
 
         # prefetch 2 batches at a time to smooth out the time taken to
         # load input files as we go through shuffling and processing
         dataset = dataset.prefetch(buffer_size=2 * self.batch_size)
         dataset = dataset.map(self.process_tfrecords, num_parallel_calls=self.num_threads)
+        dataset = self.add_latency_stats(dataset, 'process_tfrecords_latency')
         if self.nl_band == 'split':
             dataset = dataset.map(self.split_nl_band)
 
@@ -139,23 +209,41 @@ class Batcher():
         # batch then repeat => batches respect epoch boundaries
         # - i.e. last batch of each epoch might be smaller than batch_size
         dataset = dataset.batch(self.batch_size)
+        dataset = self.add_latency_stats(dataset, 'batch_latency')
         if self.epochs > 1:
             dataset = dataset.repeat(self.epochs)
 
         # prefetch 2 batches at a time
         dataset = dataset.prefetch(2)
+        dataset = self.add_stats_aggregator(dataset)
 
         iterator = dataset.make_initializable_iterator()
         batch = iterator.get_next()
         iter_init = iterator.initializer
         return iter_init, batch
 
+    def add_latency_stats(self, dataset: tf.data.Dataset, tag: str) -> tf.data.Dataset:
+        """Records the latency of producing each element at this point of the
+        pipeline under the given tag, if self.instrument."""
+        if self.instrument:
+            dataset = dataset.apply(tf.data.experimental.latency_stats(tag))
+        return dataset
+
+    def add_stats_aggregator(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        """Attaches self.stats_aggregator to the pipeline, if self.instrument. Must be
+        applied last. Prefetch buffers then also report their utilization."""
+        if self.instrument:
+            options = tf.data.Options()
+            options.experimental_stats.aggregator = self.stats_aggregator
+            dataset = dataset.with_options(options)
+        return dataset
+
     def process_tfrecords(self, example_proto: tf.Tensor) -> dict[str, tf.Tensor]:
         """
         Args
         - example_proto: a tf.train.Example protobuf
         Returns: dict {'images': img, 'labels': label, 'locs': loc, 'years': year, ...}
-        - img: tf.Tensor, shape [224, 224, C], type float32
+        - img: tf.Tensor, shape [224, 224, C] (or [255, 255, C] if not self.crop), type float32
           - channel order is [B, G, R, SWIR1, SWIR2, TEMP1, NIR, NIGHTLIGHTS]
         - label: tf.Tensor, scalar or shape [2], type float32
           - not returned if both self.label_name and self.nl_label are None
@@ -183,7 +271,10 @@ class Batcher():
 
         keys_to_features = {}
         for band in ex_bands:
-            keys_to_features[band] = tf.io.FixedLenFeature(shape=[255**2], dtype=tf.float32)
+            if self.band_encoding == 'bytes':
+                keys_to_features[band] = tf.io.FixedLenFeature(shape=[], dtype=tf.string)
+            else:
+                keys_to_features[band] = tf.io.FixedLenFeature(shape=[255**2], dtype=tf.float32)
         for key in scalar_float_keys:
             keys_to_features[key] = tf.io.FixedLenFeature(shape=[], dtype=tf.float32)
         if self.scalar_features is not None:
@@ -203,8 +294,12 @@ class Batcher():
             # for each band, reshape to (255, 255) and crop to (224, 224)
             # then subtract mean and divide by std dev
             for band in ex_bands:
+                if self.band_encoding == 'bytes':
+                    ex[band] = tf.io.decode_raw(ex[band], out_type=tf.float32, little_endian=True)
                 ex[band].set_shape([255 * 255])
-                ex[band] = tf.reshape(ex[band], [255, 255])[15:-16, 15:-16]
+                ex[band] = tf.reshape(ex[band], [255, 255])
+                if self.crop:
+                    ex[band] = ex[band][15:-16, 15:-16]
                 if self.clipneg:
                     ex[band] = tf.nn.relu(ex[band])
                 if self.normalize:
@@ -250,8 +345,8 @@ class Batcher():
         - img: tf.Tensor, shape [H, W, C], type float32, last two bands are [DMSP, VIIRS]
         """
         assert self.nl_band == 'split'
-        all_0 = tf.zeros(shape=[224, 224, 1], dtype=tf.float32, name='all_0')
         img = ex['images']
+        all_0 = tf.zeros_like(img[:, :, :1], name='all_0')
         year = ex['years']
 
         ex['images'] = tf.cond(
@@ -341,4 +436,81 @@ class RuralBatcher(Batcher):
         }
         ex = tf.io.parse_single_example(example_proto, features=keys_to_features)
         do_keep = tf.equal(ex['urban_rural'], 0.0)
-        return do_keep
\ No newline at end of file
+        return do_keep
+
+
+class MosaicBatcher(Batcher):
+    """Batches whole per-deal mosaics instead of individual tiles.
+
+    Reads the uncropped 255x255 tiles of each (deal_id, year) and stitches them
+    back into the (grid_width * 255)^2 image that Earth Engine exported, so that
+    the convolutional part of the CNN can be run once over the whole mosaic. The
+    tfrecord_files must be ordered so that the grid_width^2 tiles of each mosaic
+    are consecutive and in row-major order (see utils.mosaic.group_tile_paths).
+    """
+    crop = False
+
+    def __init__(self, *args, grid_width: int = 5, **kwargs):
+        """
+        Args
+        - grid_width: int, number of tiles along each side of a mosaic, i.e. 2 * NRINGS + 1
+        - all other args are the same as for Batcher; batch_size counts mosaics, not tiles
+        """
+        super(MosaicBatcher, self).__init__(*args, **kwargs)
+        if self.shuffle or self.augment:
+            raise ValueError('MosaicBatcher does not support shuffle or augment')
+        self.grid_width = grid_width
+
+    def get_batch(self) -> tuple[tf.Operation, dict[str, tf.Tensor]]:
+        """Gets the tf.Tensors that represent a batch of mosaics.
+        Returns
+        - iter_init: tf.Operation that should be run before first use
+        - batch: dict, str -> tf.Tensor
+            - 'images': tf.Tensor, shape [batch_size, G * 255, G * 255, C], type float32
+            - 'locs': tf.Tensor, shape [batch_size, G * G, 2], type float32
+            - 'labels': tf.Tensor, shape [batch_size, G * G], type float32
+            - 'years': tf.Tensor, shape [batch_size, G * G], type int32
+            where G = self.grid_width
+        """
+        # read files sequentially (no interleaving) so that the tiles of each mosaic stay consecutive
+        dataset = tf.data.TFRecordDataset(
+            filenames=self.tfrecord_files,
+            buffer_size=1024 * 1024 * 128)  # 128 MB buffer size
+        dataset = self.add_latency_stats(dataset, 'read_latency')
+        dataset = dataset.prefetch(buffer_size=2 * self.batch_size * self.grid_width ** 2)
+        dataset = dataset.map(self.process_tfrecords, num_parallel_calls=self.num_threads)
+        dataset = self.add_latency_stats(dataset, 'process_tfrecords_latency')
+        if self.nl_band == 'split':
+            dataset = dataset.map(self.split_nl_band)
+
+        dataset = dataset.batch(self.grid_width ** 2, drop_remainder=True)
+        dataset = dataset.map(self.assemble_mosaic, num_parallel_calls=self.num_threads)
+        if self.cache:
+            dataset = dataset.cache()
+
+        dataset = dataset.batch(self.batch_size)
+        dataset = self.add_latency_stats(dataset, 'batch_latency')
+        if self.epochs > 1:
+            dataset = dataset.repeat(self.epochs)
+        dataset = dataset.prefetch(2)
+        dataset = self.add_stats_aggregator(dataset)
+
+        iterator = dataset.make_initializable_iterator()
+        batch = iterator.get_next()
+        iter_init = iterator.initializer
+        return iter_init, batch
+
+    def assemble_mosaic(self, tiles: dict[str, tf.Tensor]) -> dict[str, tf.Tensor]:
+        """
+        Args
+        - tiles: dict {'images': img, ...}
+            - img: tf.Tensor, shape [G * G, 255, 255, C], tiles in row-major order
+        Returns: tiles, with img replaced by the stitched mosaic of shape [G * 255, G * 255, C]
+        """
+        g = self.grid_width
+        img = tiles['images']
+        num_channels = img.get_shape()[-1]
+        img = tf.reshape(img, [g, g, 255, 255, num_channels])
+        img = tf.transpose(img, [0, 2, 1, 3, 4])  # [row, y, col, x, C]
+        tiles['images'] = tf.reshape(img, [g * 255, g * 255, num_channels])
+        return tiles
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import json
+from collections.abc import Sequence
+from typing import Optional, Union
+
+import numpy as np
+
+from utils.tile_geometry import lonlat_to_mercator
+
+
+# maximum number of (point, edge) pairs tested at once in points_in_polygon()
+MAX_PAIRS_PER_CHUNK = 1 << 22
+
+
+def geometry_rings(geometry: Union[str, dict]) -> list[np.ndarray]:
+    """
+    Args
+    - geometry: str or dict, GeoJSON Polygon or MultiPolygon (e.g. the geometry column of the areas table
+        of utils/landmatrix.py)
+    Returns: list of np.array, shape [V, 2], lon and lat of the vertices of each ring (outer rings and holes)
+    """
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError(f'Unsupported geometry type: {geometry["type"]}')
+    return [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon if len(ring) >= 3]
+
+
+class PolygonSet:
+    """Polygons (e.g. deal concessions) in EPSG:3857 (Web Mercator) meters,
+    stored as flat arrays of edges, for vectorized point-in-polygon tests.
+
+    Each polygon may have several rings (parts of a MultiPolygon, and holes),
+    and a point is inside it if it is inside an odd number of its rings.
+    """
+    def __init__(self, geometries: Sequence[Union[str, dict]]):
+        """
+        Args
+        - geometries: list of GeoJSON Polygon or MultiPolygon, as str or dict
+        """
+        x0, y0, x1, y1, edge_polygons = [], [], [], [], []
+        for i, geometry in enumerate(geometries):
+            for ring in geometry_rings(geometry):
+                x, y = lonlat_to_mercator(ring[:, 0], ring[:, 1])
+                x0.append(x)
+                y0.append(y)
+                x1.append(np.roll(x, -1))   # closes the ring, whether or not its last vertex repeats the first
+                y1.append(np.roll(y, -1))
+                edge_polygons.append(np.full(len(x), i))
+        empty = [np.empty(0)]
+        self.x0, self.y0 = np.concatenate(x0 + empty), np.concatenate(y0 + empty)
+        self.x1, self.y1 = np.concatenate(x1 + empty), np.concatenate(y1 + empty)
+        edge_polygons = np.concatenate(edge_polygons + [np.empty(0, dtype=int)])
+
+        # edges of polygon p are [edge_ptr[p], edge_ptr[p+1])
+        self.num_polygons = len(geometries)
+        self.edge_ptr = np.concatenate([[0], np.cumsum(np.bincount(edge_polygons, minlength=self.num_polygons))])
+        self.bounds = np.full((self.num_polygons, 4), np.nan)   # [xmin, ymin, xmax, ymax]
+        has_edges = np.diff(self.edge_ptr) > 0
+        starts = self.edge_ptr[:-1][has_edges]
+        self.bounds[has_edges] = np.stack([np.minimum.reduceat(self.x0, starts), np.minimum.reduceat(self.y0, starts),
+                                           np.maximum.reduceat(self.x0, starts), np.maximum.reduceat(self.y0, starts)],
+                                          axis=1)
+
+    def __len__(self) -> int:
+        return self.num_polygons
+
+    def points_in_polygon(self, p: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Args
+        - p: int, index of the polygon
+        - x, y: np.array, shape [M], coordinates of the points in EPSG:3857 meters
+        Returns: np.array of bool, shape [M], whether each point is inside the polygon (even-odd rule)
+        """
+        edges = slice(self.edge_ptr[p], self.edge_ptr[p + 1])
+        x0, y0, x1, y1 = self.x0[edges], self.y0[edges], self.x1[edges], self.y1[edges]
+        inside = np.zeros(len(x), dtype=bool)
+        chunk = max(1, MAX_PAIRS_PER_CHUNK // max(len(x0), 1))
+        for start in range(0, len(x), chunk):
+            px, py = x[start:start + chunk, None], y[start:start + chunk, None]
+            # a ray from each point towards +x crosses the edges that straddle it vertically, right of the point
+            straddles = (y0 > py) != (y1 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            crossings = np.count_nonzero(straddles & (px < x_cross), axis=1)
+            inside[start:start + chunk] = crossings % 2 == 1
+        return inside
+
+
+def box_pairs(boxes_a: np.ndarray, boxes_b: np.ndarray, cell_size: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds all pairs of intersecting boxes with a spatial hash: each box is
+    assigned to the cells of a regular grid that it overlaps, and only boxes
+    sharing a cell are compared.
+    Args
+    - boxes_a, boxes_b: np.array, shapes [A, 4] and [B, 4], each row is [xmin, ymin, xmax, ymax]
+    - cell_size: float, side length of the cells of the grid, e.g. the typical size of the boxes
+    Returns: (i, j), np.arrays of int, indices into boxes_a and boxes_b of each intersecting pair
+    """
+    def cells(boxes):
+        lo = np.floor(boxes[:, :2] / cell_size).astype(np.int64)
+        hi = np.floor(boxes[:, 2:] / cell_size).astype(np.int64)
+        nx, ny = hi[:, 0] - lo[:, 0] + 1, hi[:, 1] - lo[:, 1] + 1
+        box = np.repeat(np.arange(len(boxes)), nx * ny)
+        k = np.arange(len(box)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)   # index of each cell in its box
+        col, row = lo[box, 0] + k % nx[box], lo[box, 1] + k // nx[box]
+        return box, (col << 32) + (row & 0xFFFFFFFF)
+
+    valid_a, valid_b = ~np.isnan(boxes_a).any(axis=1), ~np.isnan(boxes_b).any(axis=1)
+    idx_a, idx_b = np.flatnonzero(valid_a), np.flatnonzero(valid_b)
+    box_a, keys_a = cells(boxes_a[valid_a])
+    box_b, keys_b = cells(boxes_b[valid_b])
+
+    # join on the cell keys
+    order = np.argsort(keys_b, kind='stable')
+    keys_b, box_b = keys_b[order], box_b[order]
+    lo, hi = np.searchsorted(keys_b, keys_a, side='left'), np.searchsorted(keys_b, keys_a, side='right')
+    counts = hi - lo
+    i = np.repeat(box_a, counts)
+    j = box_b[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+    # boxes sharing several cells are paired once, and pairs are checked exactly
+    pairs = np.unique(np.stack([idx_a[i], idx_b[j]], axis=1), axis=0).reshape(-1, 2)
+    i, j = pairs[:, 0], pairs[:, 1]
+    overlaps = (boxes_a[i, 0] <= boxes_b[j, 2]) & (boxes_b[j, 0] <= boxes_a[i, 2]) \
+        & (boxes_a[i, 1] <= boxes_b[j, 3]) & (boxes_b[j, 1] <= boxes_a[i, 3])
+    return i[overlaps], j[overlaps]
+
+
+class ConcessionCoverage:
+    """Coverage of square tiles by the concessions of their own deal and of
+    other deals.
+
+    The footprint of each tile is sampled on a regular grid of samples x samples
+    points, so the fraction of a tile inside a set of concessions is the share
+    of its points inside any of them (this handles overlapping concessions,
+    which would be counted twice by summing areas of overlap). Only the points
+    of tiles whose bounding box intersects the bounding box of a concession,
+    found with box_pairs(), are tested against it.
+    """
+    def __init__(self, tile_x: np.ndarray, tile_y: np.ndarray, tile_half_size: np.ndarray, tile_deals: np.ndarray,
+                 polygons: PolygonSet, polygon_deals: np.ndarray, samples: int = 16):
+        """
+        Args
+        - tile_x, tile_y: np.array, shape [N], centroid of each tile in EPSG:3857 meters
+        - tile_half_size: np.array, shape [N], half the side length of each tile in EPSG:3857 meters
+        - tile_deals: np.array of int, shape [N], code of the deal of each tile
+        - polygons: PolygonSet, concessions
+        - polygon_deals: np.array of int, shape [P], code of the deal of each concession
+        - samples: int, number of points sampled along each side of each tile
+        """
+        tile_x, tile_y = np.asarray(tile_x, dtype=np.float64), np.asarray(tile_y, dtype=np.float64)
+        tile_half_size = np.broadcast_to(np.asarray(tile_half_size, dtype=np.float64), tile_x.shape)
+        tile_deals, polygon_deals = np.asarray(tile_deals), np.asarray(polygon_deals)
+        if len(polygon_deals) != len(polygons):
+            raise ValueError('polygon_deals must have one deal per polygon')
+        if np.any(polygon_deals < 0):
+            raise ValueError('polygon_deals must be valid deal codes')
+        self.num_tiles, self.samples = len(tile_x), samples
+
+        # offsets of the points of each tile, as a fraction of its side length
+        grid = (np.arange(samples) + 0.5) / samples - 0.5
+        dx, dy = [a.reshape(-1) for a in np.meshgrid(grid, grid)]   # [S]
+
+        tile_boxes = np.stack([tile_x - tile_half_size, tile_y - tile_half_size,
+                               tile_x + tile_half_size, tile_y + tile_half_size], axis=1)
+        cell_size = max(2 * np.median(tile_half_size), 1.0) if self.num_tiles > 0 else 1.0
+        tiles, polys = box_pairs(tile_boxes, polygons.bounds, cell_size)
+
+        # own[t, s]: whether point s of tile t is in a concession of the tile's deal
+        # (point, deal): the points of each tile in the concessions of other deals
+        self.own = np.zeros((self.num_tiles, samples * samples), dtype=bool)
+        other_points, other_deals = [], []
+        order = np.argsort(polys, kind='stable')
+        tiles, polys = tiles[order], polys[order]
+        splits = np.flatnonzero(np.diff(polys)) + 1
+        for t, p in zip(np.split(tiles, splits), np.split(polys, splits)):
+            if len(t) == 0:
+                continue
+            p = p[0]
+            x = (tile_x[t, None] + 2 * tile_half_size[t, None] * dx[None, :]).reshape(-1)
+            y = (tile_y[t, None] + 2 * tile_half_size[t, None] * dy[None, :]).reshape(-1)
+            inside = polygons.points_in_polygon(p, x, y).reshape(len(t), -1)
+            own = tile_deals[t] == polygon_deals[p]
+            self.own[t[own]] |= inside[own]
+            rows, cols = np.nonzero(inside[~own])
+            other_points.append(t[~own][rows] * samples * samples + cols)
+            other_deals.append(np.full(len(rows), polygon_deals[p]))
+        empty = [np.empty(0, dtype=np.int64)]
+        pairs = np.unique(np.stack([np.concatenate(other_points + empty),
+                                    np.concatenate(other_deals + empty)], axis=1), axis=0).reshape(-1, 2)
+        self.other_points, self.other_deals = pairs[:, 0], pairs[:, 1]
+
+    def own_fraction(self) -> np.ndarray:
+        """Returns: np.array, shape [N], fraction of each tile inside the concessions of its own deal"""
+        return self.own.mean(axis=1)
+
+    def other_fraction(self, tile_codes: Optional[np.ndarray] = None, years: Optional[np.ndarray] = None,
+                       deal_start_years: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Args
+        - tile_codes: np.array of int, shape [M], tile of each observation, or None for each tile
+        - years: np.array, shape [M], year of each observation, or None to count all concessions
+        - deal_start_years: np.array, shape [D], year in which each deal became active (NaN if never),
+            to only count the concessions of deals active in the year of each observation
+        Returns: np.array, shape [M] (or [N]), fraction of each tile inside the concessions of other deals
+        """
+        if (years is None) != (deal_start_years is None):
+            raise ValueError('years and deal_start_years must be given together')
+        points = self.samples * self.samples
+        tile_codes = np.arange(self.num_tiles) if tile_codes is None else np.asarray(tile_codes)
+
+        # first[t, s]: earliest year in which point s of tile t is in the concession of an active deal
+        first = np.full(self.num_tiles * points, np.inf)
+        start = np.full(len(self.other_deals), -np.inf) if deal_start_years is None \
+            else np.asarray(deal_start_years, dtype=np.float64)[self.other_deals]
+        np.fmin.at(first, self.other_points, start)   # NaN start years are never active
+        first = first.reshape(self.num_tiles, points)
+
+        if years is None:
+            return (first[tile_codes] < np.inf).mean(axis=1)
+        years = np.asarray(years, dtype=np.float64)
+        fraction = np.empty(len(tile_codes))
+        for year in np.unique(years):
+            obs = years == year
+            fraction[obs] = (first[tile_codes[obs]] <= year).mean(axis=1)
+        return fraction
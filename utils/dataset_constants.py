@@ -1,3 +1,9 @@
+from __future__ import annotations
+
+import json
+from typing import Optional
+
+
 DHS_COUNTRIES = [
     'angola', 'benin', 'burkina_faso', 'cameroon', 'cote_d_ivoire',
     'democratic_republic_of_congo', 'ethiopia', 'ghana', 'guinea', 'kenya',
@@ -181,4 +187,22 @@ STD_DEVS_DICT = {
     'DHS': _STD_DEVS_DHS,
     'DHSNL': _STD_DEVS_DHSNL,
     'LSMS': _STD_DEVS_LSMS,
-}
\ No newline at end of file
+}
+
+
+def load_band_stats(path: str, name: Optional[str] = None) -> str:
+    '''Registers band statistics computed by preprocessing/compute_band_stats.py
+    in MEANS_DICT and STD_DEVS_DICT, so that they can be selected with
+    Batcher(normalize=name).
+    Args
+    - path: str, path to JSON file of band statistics
+    - name: str, key to register the statistics under, defaults to the name saved in the file
+    Returns: str, the key the statistics were registered under
+    '''
+    with open(path, 'r') as f:
+        stats = json.load(f)
+    if name is None:
+        name = stats['name']
+    MEANS_DICT[name] = stats['means']
+    STD_DEVS_DICT[name] = stats['std_devs']
+    return name
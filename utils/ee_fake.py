@@ -0,0 +1,210 @@
+"""
+An offline test double for the Earth Engine Python API (`ee`), for testing and
+benchmarking client-side graph construction (e.g. in export_images.py) without
+network access or credentials.
+
+Every ee object is a node that records the call that created it, and every node
+created is counted, so that the size of the graphs built by a function can be
+measured. Functions passed to .map() are traced once on a placeholder, as the
+real client does. Nothing is ever sent to Earth Engine; Task.start() is a no-op.
+
+Usage:
+    from utils import ee_fake
+    ee_fake.install()            # before the first `import ee`
+    from utils import ee_utils   # now uses the fake
+    ee_fake.reset()
+    ...build graphs...
+    print(ee_fake.node_count())
+"""
+
+from __future__ import annotations
+
+import sys
+import types
+from typing import Any, Optional
+
+
+_NUM_NODES = 0
+
+# methods whose result is a different type of object than the object they are called on
+_RETURN_TYPES = {
+    'median': 'Image', 'mean': 'Image', 'mosaic': 'Image', 'first': 'Image', 'reduce': 'Image',
+    'sampleRegions': 'FeatureCollection', 'sample': 'FeatureCollection',
+    'reduceRegions': 'FeatureCollection',
+    'bounds': 'Geometry', 'buffer': 'Geometry', 'geometry': 'Geometry', 'transform': 'Geometry',
+    'get': 'ComputedObject', 'propertyNames': 'List', 'size': 'Number',
+}
+
+
+def node_count() -> int:
+    """Returns the number of ee nodes created since the last reset()."""
+    return _NUM_NODES
+
+
+def reset() -> None:
+    global _NUM_NODES
+    _NUM_NODES = 0
+
+
+class _StaticConstructors(type):
+    """Makes class-level calls like ee.Image.cat(...) or ee.Geometry.Point(...) create nodes."""
+    def __getattr__(cls, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: cls(f'{cls.__name__}.{name}', *args, **kwargs)
+
+
+class ComputedObject(metaclass=_StaticConstructors):
+    def __init__(self, func: Any = None, *args, **kwargs):
+        global _NUM_NODES
+        _NUM_NODES += 1
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        cls = _CLASSES[_RETURN_TYPES.get(name, type(self).__name__)]
+        return lambda *args, **kwargs: cls(f'{type(self).__name__}.{name}', self, *args, **kwargs)
+
+    def map(self, fn, *args, **kwargs) -> ComputedObject:
+        # the real client traces the mapped function once on a placeholder element
+        element_cls = Feature if isinstance(self, FeatureCollection) else Image
+        body = fn(element_cls('variable'))
+        return type(self)(f'{type(self).__name__}.map', self, body, *args, **kwargs)
+
+    def __repr__(self) -> str:
+        return f'<fake ee.{type(self).__name__}: {self.func}>'
+
+
+class Element(ComputedObject):
+    pass
+
+
+class Image(Element):
+    pass
+
+
+class Feature(Element):
+    pass
+
+
+class Collection(ComputedObject):
+    pass
+
+
+class ImageCollection(Collection):
+    pass
+
+
+class FeatureCollection(Collection):
+    pass
+
+
+class Geometry(ComputedObject):
+    pass
+
+
+class Kernel(ComputedObject):
+    pass
+
+
+class Filter(ComputedObject):
+    pass
+
+
+class Reducer(ComputedObject):
+    pass
+
+
+class List(ComputedObject):
+    pass
+
+
+class Number(ComputedObject):
+    pass
+
+
+class String(ComputedObject):
+    pass
+
+
+class Date(ComputedObject):
+    pass
+
+
+class Dictionary(ComputedObject):
+    pass
+
+
+class Projection(ComputedObject):
+    pass
+
+
+_CLASSES = {cls.__name__: cls for cls in [
+    ComputedObject, Element, Image, Feature, Collection, ImageCollection, FeatureCollection, Geometry,
+    Kernel, Filter, Reducer, List, Number, String, Date, Dictionary, Projection]}
+
+
+class Task:
+    def __init__(self, kind: str, config: dict):
+        self.kind = kind
+        self.config = config
+        self.started = False
+
+    def start(self) -> None:
+        self.started = True
+
+    def status(self) -> dict:
+        return {'state': 'READY' if not self.started else 'RUNNING',
+                'description': self.config.get('description')}
+
+
+class _Exporter:
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __getattr__(self, destination: str):
+        if destination.startswith('__'):
+            raise AttributeError(destination)
+        return lambda *args, **config: Task(f'{self.kind}.{destination}', config)
+
+
+class Export:
+    image = _Exporter('image')
+    table = _Exporter('table')
+    video = _Exporter('video')
+
+
+def Initialize(*args, **kwargs) -> None:
+    pass
+
+
+def Authenticate(*args, **kwargs) -> None:
+    pass
+
+
+def install(force: bool = False) -> types.ModuleType:
+    """
+    Installs this module as `ee` (and `ee.batch`) in sys.modules, so that
+    subsequent `import ee` statements get the fake.
+    Args
+    - force: bool, replace `ee` even if the real module was already imported
+    Returns: the fake ee module
+    """
+    existing: Optional[types.ModuleType] = sys.modules.get('ee')
+    if existing is not None and not getattr(existing, 'IS_FAKE', False) and not force:
+        raise RuntimeError('The real ee module was already imported, install the fake before importing ee')
+
+    module = sys.modules[__name__]
+    batch = types.ModuleType('ee.batch')
+    batch.Task = Task
+    batch.Export = Export
+    module.batch = batch
+    sys.modules['ee'] = module
+    sys.modules['ee.batch'] = batch
+    return module
+
+
+IS_FAKE = True
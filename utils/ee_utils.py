@@ -10,8 +10,12 @@
 # ==================== HELPER FUNCTIONS =======================
 
 import ee
+import functools
+import pandas as pd
 from typing import Optional
 
+from utils.tile_geometry import TILE_SIZE, tile_centroids
+
 
 def decode_qamask(img: ee.Image) -> ee.Image:
     """
@@ -85,7 +89,9 @@ def tfexporter(image: ee.Image,
                region: ee.Geometry,
                selectors: Optional[ee.List] = None,
                dropselectors: Optional[ee.List] = None,
-               bucket: Optional[str] = None) -> ee.batch.Task:
+               bucket: Optional[str] = None,
+               crs: Optional[str] = None,
+               crs_transform: Optional[list] = None) -> ee.batch.Task:
     """
     Creates and starts a task to export an ee.FeatureCollection to a TFRecord
     file in Google Drive or Google Cloud Storage (GCS).
@@ -102,10 +108,18 @@ def tfexporter(image: ee.Image,
         output, set to None to include all properties
     - dropselectors: None or ee.List of str, names of properties to exclude
     - bucket: None or str, name of GCS bucket, only used if export=='gcs'
+    - crs: None or str, CRS of the exported image, e.g. 'EPSG:3857'
+    - crs_transform: None or list of 6 floats, affine transform of the pixel grid in crs (see
+        utils.tile_geometry.export_region()), used instead of scale so that the exported pixels are aligned with the
+        region
 
     Returns
     - task: ee.batch.Task
     """
+    # Earth Engine does not accept both a scale and a crsTransform
+    grid = {'crs': crs, 'crsTransform': crs_transform} if crs_transform is not None else {'crs': crs, 'scale': scale}
+    grid = {k: v for k, v in grid.items() if v is not None}
+
     formatOptions = {
         'patchDimensions': [255, 255]
     }
@@ -121,7 +135,7 @@ def tfexporter(image: ee.Image,
     if export == 'gcs':
         task = ee.batch.Export.image.toCloudStorage(
             image=image,
-            scale=scale,
+            **grid,
             description=fname,
             bucket=bucket,
             fileNamePrefix=f'{prefix}/{fname}',
@@ -133,7 +147,7 @@ def tfexporter(image: ee.Image,
     elif export == 'drive':
         task = ee.batch.Export.image.toDrive(
             image=image,
-            scale=scale,
+            **grid,
             description=fname,
             folder=prefix,
             fileNamePrefix=fname,
@@ -149,41 +163,193 @@ def tfexporter(image: ee.Image,
     return task
 
 
+def tile_points(df: pd.DataFrame, nrings: int, scale: float) -> ee.FeatureCollection:
+    """
+    Creates an ee.FeatureCollection with a point at the centroid of every tile of every deal, where tiles are
+    arranged in a (2*nrings+1) x (2*nrings+1) grid around each deal (see utils/tile_geometry.py).
+
+    Args
+    - df: pd.DataFrame with deal_id, lat and lon columns
+    - nrings: int, number of concentric rings of tiles around the center tile
+    - scale: float, ground pixel size in meters
+
+    Returns
+    - ee.FeatureCollection, with integer 'deal_id' and 'tile_id' properties
+    """
+    lons, lats = tile_centroids(df['lon'].to_numpy(), df['lat'].to_numpy(), nrings=nrings, scale=scale)
+    features = [
+        ee.Feature(ee.Geometry.Point(float(lon), float(lat)), {'deal_id': int(deal_id), 'tile_id': tile_id})
+        for deal_id, deal_lons, deal_lats in zip(df['deal_id'], lons, lats)
+        for tile_id, (lon, lat) in enumerate(zip(deal_lons, deal_lats))]
+    return ee.FeatureCollection(features)
+
+
+def planned_tile_points(plan: pd.DataFrame) -> ee.FeatureCollection:
+    """
+    Creates an ee.FeatureCollection with a point at the centroid of every tile of a tile plan (see
+    utils/tile_geometry.py), e.g. of the canonical tiles only.
+
+    Args
+    - plan: pd.DataFrame with deal_id, tile_id, lat and lon (of the tile centroid) columns, e.g. from plan_tiles()
+
+    Returns
+    - ee.FeatureCollection, with integer 'deal_id' and 'tile_id' properties
+    """
+    features = [
+        ee.Feature(ee.Geometry.Point(float(lon), float(lat)), {'deal_id': int(deal_id), 'tile_id': int(tile_id)})
+        for deal_id, tile_id, lat, lon in plan[['deal_id', 'tile_id', 'lat', 'lon']].itertuples(index=False)]
+    return ee.FeatureCollection(features)
+
+
+def sample_patches(image: ee.Image,
+                   points: ee.FeatureCollection,
+                   scale: float,
+                   projection: str = 'EPSG:3857',
+                   tile_size: int = TILE_SIZE,
+                   tile_scale: int = 1) -> ee.FeatureCollection:
+    """
+    Extracts a tile_size x tile_size patch of every band of an image centered on each point, server-side.
+
+    Args
+    - image: ee.Image, image from which to extract patches
+    - points: ee.FeatureCollection of points, e.g. from tile_points(), whose properties are copied to each patch
+    - scale: float, pixel size in meters of the given projection
+    - projection: str, CRS in which to sample patches
+    - tile_size: int, side length of each patch in pixels, must be odd
+    - tile_scale: int, passed to sampleRegions to reduce memory use per EE worker
+
+    Returns
+    - ee.FeatureCollection, one feature per point, with one array-valued property per band
+    """
+    radius = tile_size // 2
+    kernel = ee.Kernel.rectangle(xRadius=radius, yRadius=radius, units='pixels')
+    patches = image.toFloat().neighborhoodToArray(kernel, defaultValue=0)
+    return patches.sampleRegions(
+        collection=points, scale=scale, projection=projection, tileScale=tile_scale, geometries=False)
+
+
+def table_tfexporter(collection: ee.FeatureCollection,
+                     export: str,
+                     prefix: str,
+                     fname: str,
+                     selectors: Optional[list] = None,
+                     bucket: Optional[str] = None) -> ee.batch.Task:
+    """
+    Creates and starts a task to export an ee.FeatureCollection (e.g. of patches from sample_patches()) to a
+    gzipped TFRecord file in Google Drive or Google Cloud Storage (GCS).
+
+    GCS:   gs://bucket/prefix/fname.tfrecord.gz
+    Drive: prefix/fname.tfrecord.gz
+
+    Args
+    - collection: ee.FeatureCollection, features to export
+    - export: str, 'drive' for Google Drive, 'gcs' for GCS
+    - prefix: str, folder name in Drive or GCS to export to, no trailing '/'
+    - fname: str, filename
+    - selectors: None or list of str, names of properties to include in output, set to None to include all
+    - bucket: None or str, name of GCS bucket, only used if export=='gcs'
+
+    Returns
+    - task: ee.batch.Task
+    """
+    if export == 'gcs':
+        task = ee.batch.Export.table.toCloudStorage(
+            collection=collection,
+            description=fname,
+            bucket=bucket,
+            fileNamePrefix=f'{prefix}/{fname}',
+            fileFormat='TFRecord',
+            selectors=selectors)
+
+    elif export == 'drive':
+        task = ee.batch.Export.table.toDrive(
+            collection=collection,
+            description=fname,
+            folder=prefix,
+            fileNamePrefix=fname,
+            fileFormat='TFRecord',
+            selectors=selectors)
+
+    else:
+        raise ValueError(f'export "{export}" is not one of ["gcs", "drive"]')
+
+    task.start()
+    return task
+
+
 # ===================== SATELLITE IMAGERY CLASS =======================
 # This class abstracts interacting with Google Earth collections for Landsat 5, 7 and 8 imagery. It also renames each
 # band and applies transformations to the imagery to ensure consistency with Yeh et al. (2020).
 
 class LandsatSR:
+    # Earth Engine collection ids of Landsat 8, 7 and 5 surface reflectance
+    L8_ID = 'LANDSAT/LC08/C01/T1_SR'
+    L7_ID = 'LANDSAT/LE07/C01/T1_SR'
+    L5_ID = 'LANDSAT/LT05/C01/T1_SR'
+
     def __init__(self, filter_polygon: ee.Geometry.Polygon, start_date: str,
-                 end_date: str) -> None:
+                 end_date: str, mask: bool = False) -> None:
         """
         Args
-        - filter_polygon: ee.Geometry
+        - filter_polygon: ee.Geometry (or ee.FeatureCollection of regions)
         - start_date: str, string representation of start date
         - end_date: str, string representation of end date
+        - mask: bool, whether to mask out cloud, cloud-shadow and snow pixels with mask_qaclear()
+
+        The renamed and rescaled (and optionally masked) collections are built once per process by
+        LandsatSR.collection(), and only the bounds and date filters are applied per instance.
         """
         self.filter_polygon = filter_polygon
         self.start_date = start_date
         self.end_date = end_date
+        self.mask = mask
 
-        self.l8 = self.init_col('LANDSAT/LC08/C01/T1_SR').map(self.rename_l8).map(self.rescale_l8)
-        self.l7 = self.init_col('LANDSAT/LE07/C01/T1_SR').map(self.rename_l57).map(self.rescale_l57)
-        self.l5 = self.init_col('LANDSAT/LT05/C01/T1_SR').map(self.rename_l57).map(self.rescale_l57)
+        self.l8 = self.init_col(self.collection('l8', mask))
+        self.l7 = self.init_col(self.collection('l7', mask))
+        self.l5 = self.init_col(self.collection('l5', mask))
 
-        self.merged = self.l5.merge(self.l7).merge(self.l8).sort('system:time_start')
+        self.merged = self.init_col(self.collection('merged', mask)).sort('system:time_start')
 
-    def init_col(self, name: str) -> ee.ImageCollection:
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def collection(cls, sensor: str, mask: bool = False) -> ee.ImageCollection:
+        """
+        Builds the unfiltered, renamed and rescaled collection for a sensor, memoized so that the (identical)
+        client-side graph is only constructed once per process.
+
+        Args
+        - sensor: str, one of ['l5', 'l7', 'l8', 'merged'], where 'merged' merges all three
+        - mask: bool, whether to apply mask_qaclear() to every image
+
+        Returns:
+        - ee.ImageCollection
+        """
+        if sensor == 'l8':
+            col = ee.ImageCollection(cls.L8_ID).map(cls.rename_l8).map(cls.rescale_l8)
+        elif sensor == 'l7':
+            col = ee.ImageCollection(cls.L7_ID).map(cls.rename_l57).map(cls.rescale_l57)
+        elif sensor == 'l5':
+            col = ee.ImageCollection(cls.L5_ID).map(cls.rename_l57).map(cls.rescale_l57)
+        elif sensor == 'merged':
+            return cls.collection('l5', mask).merge(cls.collection('l7', mask)).merge(cls.collection('l8', mask))
+        else:
+            raise ValueError(f'sensor "{sensor}" is not one of ["l5", "l7", "l8", "merged"]')
+        if mask:
+            col = col.map(mask_qaclear)
+        return col
+
+    def init_col(self, col: ee.ImageCollection) -> ee.ImageCollection:
         """
-        Creates an ee.ImageCollection containing all images intersecting
-        the bounding box between the specified start and end dates.
+        Filters an ee.ImageCollection to all images intersecting the bounding
+        box between the specified start and end dates.
 
         Args
-        - name: str, name of collection
+        - col: ee.ImageCollection, e.g. from LandsatSR.collection()
 
         Returns:
         - ee.ImageCollection
         """
-        return (ee.ImageCollection(name)
+        return (col
                 .filterBounds(self.filter_polygon)
                 .filterDate(self.start_date, self.end_date))
 
@@ -234,8 +400,9 @@ class LandsatSR:
         therm = therm.multiply(0.1)
 
         scaled = ee.Image.cat([opt, therm, masks]).copyProperties(img)
-        # system properties are not copied
+        # system properties are not copied, the footprint is needed to filter by bounds after rescaling
         scaled = scaled.set('system:time_start', img.get('system:time_start'))
+        scaled = scaled.set('system:footprint', img.get('system:footprint'))
         return scaled
 
     @staticmethod
@@ -291,6 +458,7 @@ class LandsatSR:
         therm = therm.multiply(0.1)
 
         scaled = ee.Image.cat([opt, therm, masks, atmos]).copyProperties(img)
-        # system properties are not copied
+        # system properties are not copied, the footprint is needed to filter by bounds after rescaling
         scaled = scaled.set('system:time_start', img.get('system:time_start'))
+        scaled = scaled.set('system:footprint', img.get('system:footprint'))
         return scaled
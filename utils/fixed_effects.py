@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+def fe_codes(df: pd.DataFrame, cols: Sequence[str]) -> list[np.ndarray]:
+    """
+    Args
+    - df: pd.DataFrame
+    - cols: list of str, columns whose levels are absorbed as fixed effects (e.g. deal_id, year, level)
+    Returns: list of np.array of int, shape [N], the level of each observation for each column
+    """
+    return [pd.factorize(df[col], sort=True)[0] for col in cols]
+
+
+def demean(X: np.ndarray, codes: Sequence[np.ndarray], tol: float = 1e-10, max_iter: int = 1000) -> np.ndarray:
+    """
+    Projects columns onto the orthogonal complement of the fixed effects by
+    alternating projections, i.e. by repeatedly subtracting the mean within each
+    level of each set of fixed effects until the means are all ~0. This is
+    exact for a single set of fixed effects, and converges to the same residuals
+    as a regression on all the dummies for several (e.g. unbalanced two-way)
+    sets of fixed effects.
+    Args
+    - X: np.array, shape [N] or [N, K]
+    - codes: list of np.array of int, shape [N], see fe_codes()
+    - tol: float, stop once no mean exceeds tol times the scale of X
+    - max_iter: int, maximum number of passes over all sets of fixed effects
+    Returns: np.array, same shape as X, demeaned columns
+    """
+    X = np.array(X, dtype=np.float64)
+    squeeze = X.ndim == 1
+    X = X.reshape(len(X), -1)
+    counts = [np.bincount(c) for c in codes]
+    scale = max(np.abs(X).max(initial=0), 1.0)
+
+    for _ in range(max_iter):
+        max_mean = 0.0
+        for c, n in zip(codes, counts):
+            # per-level sums of all columns at once: [levels, K]
+            sums = np.stack([np.bincount(c, weights=x, minlength=len(n)) for x in X.T], axis=1)
+            means = sums / n[:, None]
+            X -= means[c]
+            max_mean = max(max_mean, np.abs(means).max(initial=0))
+        if max_mean <= tol * scale or len(codes) == 1:
+            break
+    return X[:, 0] if squeeze else X
+
+
+class FixedEffectsProjection:
+    """Exact projection onto the orthogonal complement of the fixed effects,
+    for when the total number of levels is small (e.g. deals, years and rings).
+
+    The Gram matrix D'D of the fixed-effect dummies D is built from level
+    co-occurrence counts and pseudo-inverted once, so demeaning a column only
+    takes a bincount per set of fixed effects and a product with a
+    [levels, levels] matrix, instead of iterating to convergence as demean() does.
+    """
+    def __init__(self, codes: Sequence[np.ndarray]):
+        """
+        Args
+        - codes: list of np.array of int, shape [N], see fe_codes()
+        """
+        self.codes = list(codes)
+        self.sizes = [int(c.max()) + 1 for c in self.codes]
+        self.offsets = np.cumsum([0] + self.sizes)
+        gram = np.zeros([self.offsets[-1]] * 2)
+        for i, (ci, ni) in enumerate(zip(self.codes, self.sizes)):
+            for j, (cj, nj) in enumerate(zip(self.codes, self.sizes)):
+                block = np.bincount(ci * nj + cj, minlength=ni * nj).reshape(ni, nj)
+                gram[self.offsets[i]:self.offsets[i + 1], self.offsets[j]:self.offsets[j + 1]] = block
+        self.gram_pinv = np.linalg.pinv(gram, hermitian=True)
+
+    def __call__(self, X: np.ndarray) -> np.ndarray:
+        """
+        Args
+        - X: np.array, shape [N] or [N, K]
+        Returns: np.array, same shape as X, residuals of X on the fixed-effect dummies
+        """
+        X = np.array(X, dtype=np.float64)
+        squeeze = X.ndim == 1
+        X = X.reshape(len(X), -1)
+        DtX = np.concatenate([np.stack([np.bincount(c, weights=x, minlength=n) for x in X.T], axis=1)
+                              for c, n in zip(self.codes, self.sizes)])  # [levels, K]
+        coefs = self.gram_pinv @ DtX
+        for c, start, end in zip(self.codes, self.offsets[:-1], self.offsets[1:]):
+            X -= coefs[start:end][c]
+        return X[:, 0] if squeeze else X
+
+
+def num_absorbed(codes: Sequence[np.ndarray]) -> int:
+    """
+    Returns: int, number of parameters absorbed by the fixed effects (levels of
+        each set of fixed effects, less one per additional set), as counted by lm()
+    """
+    return sum(int(c.max()) + 1 for c in codes) - max(len(codes) - 1, 0)
+
+
+def drop_collinear(X: np.ndarray, X_demeaned: np.ndarray, names: Sequence[str], rtol: float = 1e-8
+                   ) -> tuple[np.ndarray, list[str]]:
+    """
+    Drops columns that are (numerically) absorbed by the fixed effects, e.g. deal
+    characteristics that are constant within each deal, as lm() reports NA for them.
+    Args
+    - X: np.array, shape [N, K], columns before demeaning
+    - X_demeaned: np.array, shape [N, K], columns after demeaning
+    - names: list of str, name of each column
+    - rtol: float, columns whose demeaned norm is below rtol times their norm are dropped
+    Returns: the kept demeaned columns and their names
+    """
+    keep = np.linalg.norm(X_demeaned, axis=0) > rtol * np.maximum(np.linalg.norm(X, axis=0), 1e-300)
+    return X_demeaned[:, keep], [name for name, k in zip(names, keep) if k]
+
+
+def cluster_vcov(X: np.ndarray, resid: np.ndarray, clusters: np.ndarray, df_absorbed: int = 0) -> np.ndarray:
+    """
+    Cluster-robust covariance of OLS coefficients, with the small-sample
+    adjustment G/(G-1) * (N-1)/(N-K) of sandwich::vcovCL(type='HC1') as used
+    with coeftest() in analysis/causal_models.R.
+    Args
+    - X: np.array, shape [N, K], (demeaned) regressors
+    - resid: np.array, shape [N], residuals
+    - clusters: np.array, shape [N], cluster of each observation
+    - df_absorbed: int, number of parameters absorbed by fixed effects, see num_absorbed()
+    Returns: np.array, shape [K, K]
+    """
+    n, k = X.shape
+    codes, names = pd.factorize(clusters)
+    g = len(names)
+    scores = np.stack([np.bincount(codes, weights=x * resid, minlength=g) for x in X.T], axis=1)  # [G, K]
+    bread = np.linalg.pinv(X.T @ X)
+    adjust = g / (g - 1) * (n - 1) / (n - k - df_absorbed)
+    return adjust * bread @ (scores.T @ scores) @ bread
+
+
+class ConleyKernel:
+    """Weights of pairs of observations for Conley (1999) spatial-HAC
+    covariance estimates in a panel.
+
+    Pairs of observations in the same period are weighted by a kernel of their
+    great-circle distance up to cutoff_km, and pairs of observations of the same
+    unit in different periods by a Bartlett kernel of their time difference up
+    to lag_cutoff (as in Hsiang (2010)). Only pairs within the cutoffs are
+    enumerated, with a SpatialIndex per period, and stored as a sparse matrix,
+    so the weights take memory and time roughly linear in N and can be reused
+    across regressions on the same sample.
+
+    Requires scipy.
+    """
+    def __init__(self, lon: np.ndarray, lat: np.ndarray, times: np.ndarray, cutoff_km: float,
+                 units: Optional[np.ndarray] = None, lag_cutoff: float = 0, kernel: str = 'bartlett'):
+        """
+        Args
+        - lon, lat: np.array, shape [N], coordinates of each observation in degrees (e.g. tile centroids)
+        - times: np.array, shape [N], period of each observation (e.g. year)
+        - cutoff_km: float, spatial correlation is assumed 0 beyond this distance
+        - units: np.array, shape [N], unit of each observation (e.g. tile), or None to ignore serial correlation
+        - lag_cutoff: float, serial correlation is assumed 0 beyond this time difference
+        - kernel: str, spatial kernel, 'bartlett' (weights 1 - distance / cutoff_km) or 'uniform'
+        """
+        from scipy import sparse
+        from utils.spatial_index import SpatialIndex
+
+        if kernel not in ('bartlett', 'uniform'):
+            raise ValueError(f'got {kernel} for "kernel"')
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        times = np.asarray(times)
+        n = len(lon)
+        rows, cols, vals = [], [], []
+
+        # spatial: pairs of observations in the same period within cutoff_km, incl. each observation with itself
+        for t in np.unique(times):
+            idx = np.flatnonzero(times == t)
+            i, j, dist = SpatialIndex(lon[idx], lat[idx]).pairs_within(cutoff_km)
+            rows += [idx[i]]
+            cols += [idx[j]]
+            vals += [1 - dist / cutoff_km if kernel == 'bartlett' else np.ones(len(dist))]
+
+        # serial: pairs of observations of the same unit in different periods within lag_cutoff
+        if units is not None and lag_cutoff > 0:
+            unit_codes = pd.factorize(units)[0]
+            order = np.lexsort((times, unit_codes))
+            for k in range(1, n):
+                a, b = order[:-k], order[k:]
+                dt = (times[b] - times[a]).astype(np.float64)
+                ok = (unit_codes[a] == unit_codes[b]) & (dt <= lag_cutoff)
+                if not np.any(ok):
+                    break  # observations further apart in the sort order are further apart in time
+                w = 1 - dt[ok] / (lag_cutoff + 1)
+                rows += [a[ok], b[ok]]
+                cols += [b[ok], a[ok]]
+                vals += [w, w]
+
+        self.weights = sparse.csr_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+    def vcov(self, X: np.ndarray, resid: np.ndarray) -> np.ndarray:
+        """
+        Args
+        - X: np.array, shape [N, K], (demeaned) regressors
+        - resid: np.array, shape [N], residuals
+        Returns: np.array, shape [K, K], spatial-HAC covariance of the OLS coefficients
+        """
+        scores = X * resid[:, None]
+        bread = np.linalg.pinv(X.T @ X)
+        return bread @ (scores.T @ (self.weights @ scores)) @ bread
+
+
+class PartialledRegression:
+    """OLS of an outcome on treatment columns T, controls W and absorbed fixed
+    effects, by Frisch-Waugh-Lovell.
+
+    The outcome and controls are demeaned and the outcome is residualized on the
+    controls once, so that refitting with new treatment columns (e.g. for each
+    permutation of treatment timing) only demeans and residualizes T, and solves
+    a small system in the treatment columns.
+
+    Usage:
+        model = PartialledRegression(y, W, fe_codes(df, ['deal_id', 'year']))
+        beta = model.fit(T)
+    """
+    def __init__(self, y: np.ndarray, W: Optional[np.ndarray], codes: Sequence[np.ndarray],
+                 control_names: Optional[Sequence[str]] = None, tol: float = 1e-10, max_dense_levels: int = 5000):
+        """
+        Args
+        - y: np.array, shape [N], outcome
+        - W: np.array, shape [N, K], controls, or None
+        - codes: list of np.array of int, shape [N], see fe_codes()
+        - control_names: list of str, names of the controls
+        - tol: float, tolerance of demean()
+        - max_dense_levels: int, use FixedEffectsProjection if the fixed effects have at most
+            this many levels in total, and demean() otherwise
+        """
+        self.codes = list(codes)
+        self.tol = tol
+        if sum(int(c.max()) + 1 for c in self.codes) <= max_dense_levels:
+            self._demean = FixedEffectsProjection(self.codes)
+        else:
+            self._demean = lambda X: demean(X, self.codes, self.tol)
+        self.y = self._demean(y)
+        if W is None or W.shape[1] == 0:
+            W = np.zeros([len(self.y), 0])
+        names = list(control_names) if control_names is not None else [f'w{k}' for k in range(W.shape[1])]
+        self.W, self.control_names = drop_collinear(W, self._demean(W), names)
+
+        # residual maker for the controls: r = x - W (W'W)^+ W'x
+        self._W_pinv = np.linalg.pinv(self.W) if self.W.shape[1] > 0 else np.zeros([0, len(self.y)])
+        self.y_resid = self._residualize(self.y)
+
+    def _residualize(self, X: np.ndarray) -> np.ndarray:
+        return X - self.W @ (self._W_pinv @ X)
+
+    def partial_out(self, T: np.ndarray) -> np.ndarray:
+        """
+        Returns: np.array, shape [N, J], treatment columns with the fixed effects and controls partialled out
+        """
+        T = np.asarray(T, dtype=np.float64).reshape(len(self.y), -1)
+        return self._residualize(self._demean(T))
+
+    def fit(self, T: np.ndarray) -> np.ndarray:
+        """
+        Args
+        - T: np.array, shape [N, J], treatment columns
+        Returns: np.array, shape [J], coefficients of the treatment columns
+        """
+        T_resid = self.partial_out(T)
+        return np.linalg.lstsq(T_resid, self.y_resid, rcond=None)[0]
+
+    def fit_full(self, T: np.ndarray, treatment_names: Optional[Sequence[str]] = None,
+                 clusters: Optional[np.ndarray] = None, conley: Optional[ConleyKernel] = None) -> pd.DataFrame:
+        """
+        Fits the treatment columns and controls jointly, with cluster-robust and/or spatial-HAC standard errors.
+        Args
+        - T: np.array, shape [N, J], treatment columns
+        - treatment_names: list of str, name of each treatment column
+        - clusters: np.array, shape [N], cluster of each observation, or None for no clustered standard errors
+        - conley: ConleyKernel, for the same observations, or None for no spatial-HAC standard errors
+        Returns: pd.DataFrame, indexed by treatment and control name, with columns 'estimate', and
+            'std_error' (clustered) and 'conley_std_error' if requested
+        """
+        X = np.concatenate([self._demean(np.asarray(T, dtype=np.float64).reshape(len(self.y), -1)), self.W], axis=1)
+        beta = np.linalg.lstsq(X, self.y, rcond=None)[0]
+        if treatment_names is None:
+            treatment_names = [f't{j}' for j in range(X.shape[1] - self.W.shape[1])]
+        names = list(treatment_names) + self.control_names
+        result = pd.DataFrame({'estimate': beta}, index=names)
+        if clusters is not None:
+            vcov = cluster_vcov(X, self.y - X @ beta, clusters, num_absorbed(self.codes))
+            result['std_error'] = np.sqrt(np.diag(vcov))
+        if conley is not None:
+            result['conley_std_error'] = np.sqrt(np.diag(conley.vcov(X, self.y - X @ beta)))
+        return result
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from collections import defaultdict
+import json
+import os
+import time
+from typing import Any, Optional
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+# upper edges (in ms) of the buckets of the sess.run latency histogram, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def log_filename(save_filename: str) -> str:
+    """
+    'features.npz' => 'features_log.json'
+    """
+    root, _ = os.path.splitext(save_filename)
+    return f'{root}_log.json'
+
+
+def parse_stats_summary(summary_str: bytes) -> dict[str, dict[str, float]]:
+    """
+    Parses the serialized tf.Summary produced by a tf.data StatsAggregator.
+    Args
+    - summary_str: bytes, serialized tf.Summary protobuf
+    Returns: dict, tag => {'count', 'mean', 'min', 'max'} for histogram values,
+        or tag => {'value'} for scalar values
+    """
+    summary = tf.Summary.FromString(summary_str)
+    stats = {}
+    for value in summary.value:
+        if value.HasField('histo'):
+            histo = value.histo
+            stats[value.tag] = {
+                'count': histo.num,
+                'mean': histo.sum / histo.num if histo.num > 0 else float('nan'),
+                'min': histo.min,
+                'max': histo.max,
+            }
+        else:
+            stats[value.tag] = {'value': value.simple_value}
+    return stats
+
+
+class RunProfiler:
+    """Times every sess.run() of an extraction loop, and optionally samples the
+    tf.data statistics of the input pipeline and captures a TF profiler trace
+    for a window of batches.
+
+    Usage:
+        profiler = RunProfiler(stats_op=stats_op, trace_batches=(10, 12), trace_dir=out_dir)
+        while ...:
+            outputs = profiler.run(sess, fetches)
+        profiler.save(path, extra={'num_tiles': ...})
+    """
+    def __init__(self, stats_op: Optional[tf.Tensor] = None,
+                 stats_every: int = 10,
+                 trace_batches: Optional[tuple[int, int]] = None,
+                 trace_dir: Optional[str] = None):
+        """
+        Args
+        - stats_op: tf.Tensor, type string, summary op of a tf.data StatsAggregator
+            (see Batcher.stats_aggregator), or None to not sample tf.data statistics
+        - stats_every: int, sample stats_op once every stats_every batches
+        - trace_batches: tuple (start, end), capture a full trace of batches in
+            [start, end), or None to not capture any traces
+        - trace_dir: str, directory to save chrome://tracing JSON files to,
+            required if trace_batches is given
+        """
+        if trace_batches is not None and trace_dir is None:
+            raise ValueError('trace_dir must be given if trace_batches is given')
+        self.stats_op = stats_op
+        self.stats_every = stats_every
+        self.trace_batches = trace_batches
+        self.trace_dir = trace_dir
+
+        self.latencies: list[float] = []  # seconds
+        self.stats_samples: dict[str, list[dict[str, float]]] = defaultdict(list)
+        self.trace_paths: list[str] = []
+
+    def run(self, sess: tf.Session, fetches: Any) -> Any:
+        """Runs sess.run(fetches), recording its latency."""
+        batch = len(self.latencies)
+        trace = (self.trace_batches is not None
+                 and self.trace_batches[0] <= batch < self.trace_batches[1])
+        if trace:
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+            start = time.perf_counter()
+            outputs = sess.run(fetches, options=run_options, run_metadata=run_metadata)
+            self.latencies.append(time.perf_counter() - start)
+            self.save_trace(run_metadata, batch)
+        else:
+            start = time.perf_counter()
+            outputs = sess.run(fetches)
+            self.latencies.append(time.perf_counter() - start)
+
+        # sample tf.data statistics in a separate run so that they don't inflate the latencies
+        if self.stats_op is not None and batch % self.stats_every == 0:
+            for tag, values in parse_stats_summary(sess.run(self.stats_op)).items():
+                self.stats_samples[tag].append(dict(values, batch=batch))
+        return outputs
+
+    def save_trace(self, run_metadata: tf.RunMetadata, batch: int) -> None:
+        os.makedirs(self.trace_dir, exist_ok=True)
+        trace_path = os.path.join(self.trace_dir, f'trace_batch{batch:05d}.json')
+        with open(trace_path, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        self.trace_paths.append(trace_path)
+
+    def summary(self) -> dict[str, Any]:
+        """
+        Returns: dict, JSON-serializable summary of the recorded latencies and statistics
+        """
+        latencies_ms = np.asarray(self.latencies) * 1000
+        edges = [0, *LATENCY_BUCKETS_MS, np.inf]
+        counts, _ = np.histogram(latencies_ms, bins=edges)
+        result: dict[str, Any] = {
+            'num_batches': len(latencies_ms),
+            'total_seconds': float(latencies_ms.sum() / 1000),
+            'sess_run_ms': {
+                'histogram': {
+                    'upper_edges': [*LATENCY_BUCKETS_MS, 'inf'],
+                    'counts': counts.tolist(),
+                },
+            },
+            'tf_data_stats': dict(self.stats_samples),
+            'trace_paths': self.trace_paths,
+        }
+        if len(latencies_ms) > 0:
+            result['sess_run_ms'].update({
+                'mean': float(latencies_ms.mean()),
+                'min': float(latencies_ms.min()),
+                'max': float(latencies_ms.max()),
+                # the first batch includes pipeline warm-up (e.g. filling the prefetch buffers)
+                'first': float(latencies_ms[0]),
+                **{f'p{q}': float(np.percentile(latencies_ms, q)) for q in (50, 90, 99)},
+            })
+        return result
+
+    def save(self, path: str, extra: Optional[dict[str, Any]] = None) -> None:
+        """
+        Saves summary() (updated with extra) as JSON.
+        Args
+        - path: str, path to .json file
+        - extra: dict, additional JSON-serializable entries, e.g. the number of tiles
+        """
+        log = self.summary()
+        if extra is not None:
+            log.update(extra)
+        with open(path, 'w') as f:
+            json.dump(log, f, indent=2)
+        print(f'Saved extraction log to {path}')
@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+def _csr(src: np.ndarray, dst: np.ndarray, num_nodes: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns
+    - indptr: np.array of int, shape [num_nodes + 1], edges of node v are order[indptr[v]:indptr[v+1]]
+    - indices: np.array of int, shape [E], dst of each edge, grouped by src
+    - order: np.array of int, shape [E], index of each grouped edge in the input arrays
+    """
+    order = np.argsort(src, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=num_nodes))])
+    return indptr, dst[order], order
+
+
+def ownership_weights(downstream: np.ndarray, shares: np.ndarray) -> np.ndarray:
+    """
+    Splits the ownership of each investor between its parents: known shares
+    (in percent) are kept, the remainder is split equally between the parents
+    whose share is missing, and the weights of each investor sum to 1 (if the
+    known shares sum to more or less than 100% with no share missing, they are
+    rescaled).
+    Args
+    - downstream: np.array of int, shape [E], code of the owned investor of each edge
+    - shares: np.array of float, shape [E], ownership share in percent, NaN if unknown
+    Returns: np.array of float, shape [E], weight of each edge
+    """
+    num_nodes = downstream.max() + 1 if len(downstream) > 0 else 0
+    shares = np.clip(np.asarray(shares, dtype=np.float64) / 100, 0, 1)
+    missing = np.isnan(shares)
+    known = np.bincount(downstream, weights=np.where(missing, 0, shares), minlength=num_nodes)
+    num_missing = np.bincount(downstream, weights=missing, minlength=num_nodes)
+    remainder = np.clip(1 - known, 0, None) / np.maximum(num_missing, 1)
+    weights = np.where(missing, remainder[downstream], shares)
+
+    totals = np.bincount(downstream, weights=weights, minlength=num_nodes)
+    counts = np.bincount(downstream, minlength=num_nodes)
+    return np.where(totals[downstream] > 0, weights / np.where(totals > 0, totals, 1)[downstream],
+                    1 / np.maximum(counts, 1)[downstream])
+
+
+class InvestorGraph:
+    """Graph of ownership between investors, from the involvements of the
+    LandMatrix, to resolve the ultimate owners of the operating company of
+    each deal.
+
+    Investors are indexed by integer codes, and the edges from each investor to
+    its parents are stored in CSR arrays. Ancestors and ultimate owners are
+    resolved by a DFS over the graph (Tarjan's algorithm), which memoizes the
+    result of each investor, so each investor is visited once however many
+    deals or subsidiaries share it. Cycles of ownership (e.g. two companies
+    holding shares in each other) are detected as strongly connected
+    components, whose investors share their ancestors and owners; the
+    investors of a cycle without any parent outside it are its ultimate owners.
+
+    The ownership share of each ultimate owner is the product of the shares
+    along each path to it, summed over paths, with missing shares split
+    equally (see ownership_weights()).
+
+    After add_involvements(), only the investors downstream of the new edges
+    are resolved again.
+    """
+    def __init__(self, investor_ids: Sequence[int], downstream: Sequence[int], upstream: Sequence[int],
+                 shares: Optional[Sequence[float]] = None):
+        """
+        Args
+        - investor_ids: list of int, IDs of the investors
+        - downstream, upstream: list of int, shape [E], IDs of the owned investor and
+            its parent of each involvement; IDs not in investor_ids are added
+        - shares: list of float, shape [E], ownership share of each involvement in percent,
+            NaN if unknown, or None if all unknown
+        """
+        self.ids = np.asarray(pd.unique(np.asarray(investor_ids, dtype=np.int64)))
+        self._index = pd.Index(self.ids)
+        self.downstream = np.empty(0, dtype=np.int64)
+        self.upstream = np.empty(0, dtype=np.int64)
+        self.shares = np.empty(0, dtype=np.float64)
+        self._ancestors = []
+        self._owners = []
+        self._component = np.empty(0, dtype=np.int64)   # strongly connected component of each resolved investor
+        self._cyclic = np.empty(0, dtype=bool)
+        self._num_components = 0
+        self._no_ancestors, self._full_share = np.empty(0, dtype=np.int64), np.ones(1)
+        self.add_involvements(downstream, upstream, shares)
+
+    @classmethod
+    def from_tables(cls, investors: pd.DataFrame, involvements: pd.DataFrame,
+                    relation_types: Sequence[str] = ('Parent company',)) -> InvestorGraph:
+        """
+        Args
+        - investors, involvements: pd.DataFrame, the tables of the LandMatrix, see utils/landmatrix.py
+        - relation_types: list of str, relation types that are ownership (e.g. excluding lenders)
+        """
+        involvements = involvements[involvements['relation_type'].isin(relation_types)]
+        return cls(investors['investor_id'].dropna(), involvements['investor_id_downstream'],
+                   involvements['investor_id_upstream'], involvements['ownership_share'])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def codes(self, investor_ids: Sequence[int]) -> np.ndarray:
+        """Returns: np.array of int, code of each investor, -1 if not in the graph"""
+        return self._index.get_indexer(pd.Series(investor_ids, dtype='Int64'))
+
+    def add_involvements(self, downstream: Sequence[int], upstream: Sequence[int],
+                         shares: Optional[Sequence[float]] = None) -> None:
+        """
+        Adds edges (and any new investors) to the graph, and forgets the resolved
+        ancestors and owners of the investors downstream of them.
+        Args: as for __init__()
+        """
+        downstream = pd.Series(downstream, dtype='Int64').to_numpy(dtype=np.float64, na_value=np.nan)
+        upstream = pd.Series(upstream, dtype='Int64').to_numpy(dtype=np.float64, na_value=np.nan)
+        shares = np.full(len(downstream), np.nan) if shares is None else np.asarray(shares, dtype=np.float64)
+        if not len(downstream) == len(upstream) == len(shares):
+            raise ValueError('downstream, upstream and shares must have the same length')
+
+        # an investor cannot own itself
+        keep = ~np.isnan(downstream) & ~np.isnan(upstream) & (downstream != upstream)
+        downstream, upstream = downstream[keep].astype(np.int64), upstream[keep].astype(np.int64)
+        new_ids = pd.unique(np.concatenate([downstream, upstream]))
+        new_ids = new_ids[self._index.get_indexer(new_ids) < 0]
+        if len(new_ids) > 0:
+            self.ids = np.concatenate([self.ids, new_ids])
+            self._index = pd.Index(self.ids)
+        num_new = len(self.ids) - len(self._ancestors)
+        self._ancestors += [None] * num_new
+        self._owners += [None] * num_new
+        self._component = np.concatenate([self._component, np.full(num_new, -1)])
+        self._cyclic = np.concatenate([self._cyclic, np.zeros(num_new, dtype=bool)])
+
+        added = self._index.get_indexer(downstream)
+        self.downstream = np.concatenate([self.downstream, added])
+        self.upstream = np.concatenate([self.upstream, self._index.get_indexer(upstream)])
+        self.shares = np.concatenate([self.shares, shares[keep]])
+
+        # parents[indptr[v]:indptr[v+1]] are the parents of investor v
+        self.indptr, self.parents, order = _csr(self.downstream, self.upstream, len(self))
+        self.weights = ownership_weights(self.downstream, self.shares)[order]
+        self.child_indptr, self.children, _ = _csr(self.upstream, self.downstream, len(self))
+
+        for v in self.descendants(np.unique(added)):
+            self._ancestors[v] = self._owners[v] = None
+            self._component[v] = -1
+            self._cyclic[v] = False
+
+    def descendants(self, codes: np.ndarray) -> np.ndarray:
+        """Returns: np.array of int, codes of the given investors and of all investors they own, directly or not"""
+        visited = np.zeros(len(self), dtype=bool)
+        frontier = np.asarray(codes, dtype=np.int64)
+        visited[frontier] = True
+        while len(frontier) > 0:
+            children = np.concatenate([self.children[self.child_indptr[v]:self.child_indptr[v + 1]]
+                                       for v in frontier] + [np.empty(0, dtype=np.int64)])
+            frontier = np.unique(children[~visited[children]])
+            visited[frontier] = True
+        return np.flatnonzero(visited)
+
+    def _resolve(self, codes: Sequence[int]) -> None:
+        """Resolves the ancestors and owners of the given investors (and their ancestors) not resolved yet."""
+        index, low = {}, {}
+        stack, on_stack = [], set()
+        for start in codes:
+            if self._owners[start] is not None or start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            calls = [(start, self.indptr[start])]
+            while calls:
+                v, pos = calls[-1]
+                descended = False
+                while pos < self.indptr[v + 1]:
+                    w = self.parents[pos]
+                    pos += 1
+                    if self._owners[w] is not None:
+                        continue
+                    if w not in index:
+                        calls[-1] = (v, pos)
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        calls.append((w, self.indptr[w]))
+                        descended = True
+                        break
+                    if w in on_stack:
+                        low[v] = min(low[v], index[w])
+                if descended:
+                    continue
+                calls.pop()
+                if calls:
+                    u = calls[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    # v is the root of a strongly connected component, whose parents are all resolved
+                    members = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        members.append(w)
+                        if w == v:
+                            break
+                    self._resolve_component(np.array(members, dtype=np.int64))
+
+    def _resolve_component(self, members: np.ndarray) -> None:
+        """Resolves a strongly connected component, i.e. an investor or a cycle, whose parents are all resolved."""
+        cyclic = len(members) > 1
+        if not cyclic:
+            v = members[0]
+            start, end = self.indptr[v], self.indptr[v + 1]
+            external, weights = np.arange(start, end), self.weights[start:end]
+        else:
+            # within a cycle, the weights of the parents outside it are renormalized for each investor, and the
+            # investors of the cycle with such parents are weighted equally
+            edges = np.concatenate([np.arange(self.indptr[v], self.indptr[v + 1]) for v in members])
+            is_member = np.isin(self.parents[edges], members)
+            external, src = edges[~is_member], np.repeat(members, np.diff(self.indptr)[members])[~is_member]
+            weights = ownership_weights(pd.factorize(src)[0], 100 * self.weights[external]) / len(np.unique(src))
+
+        if not cyclic and len(external) == 0:
+            # most investors have no parents
+            ancestors, owners, shares = self._no_ancestors, members, self._full_share
+        else:
+            parents = self.parents[external]
+            ancestors = [members] if cyclic else []
+            ancestors = np.unique(np.concatenate(ancestors + [parents] + [self._ancestors[p] for p in parents]))
+
+            if len(external) == 0:
+                # the investors of a cycle without parents outside it own it jointly
+                owners, shares = np.sort(members), np.full(len(members), 1 / len(members))
+            else:
+                owner_lists = [self._owners[p] for p in parents]
+                all_owners = np.concatenate([o for o, _ in owner_lists])
+                all_shares = np.concatenate([w * s for w, (_, s) in zip(weights, owner_lists)])
+                owners, inverse = np.unique(all_owners, return_inverse=True)
+                shares = np.bincount(inverse.reshape(-1), weights=all_shares, minlength=len(owners))
+
+        for v in members:
+            self._ancestors[v] = ancestors
+            self._owners[v] = (owners, shares)
+        self._component[members] = self._num_components
+        self._num_components += 1
+        self._cyclic[members] = cyclic
+
+    def resolve_all(self) -> None:
+        """Resolves the ancestors and owners of every investor, in one pass over the graph."""
+        self._resolve(range(len(self)))
+
+    def ancestors(self, investor_id: int) -> np.ndarray:
+        """Returns: np.array of int, IDs of the investors that own the investor, directly or not"""
+        v = self._code(investor_id)
+        self._resolve([v])
+        return self.ids[self._ancestors[v]]
+
+    def ultimate_owners(self, investor_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns
+        - owner_ids: np.array of int, IDs of the ultimate owners of the investor (itself if it has no parents)
+        - shares: np.array of float, share of the investor owned by each ultimate owner, summing to 1
+        """
+        v = self._code(investor_id)
+        self._resolve([v])
+        owners, shares = self._owners[v]
+        return self.ids[owners], shares
+
+    def transitive_closure(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns
+        - indptr: np.array of int, shape [N + 1]
+        - indices: np.array of int, codes of the ancestors of investor v are indices[indptr[v]:indptr[v+1]]
+        """
+        self.resolve_all()
+        indptr = np.concatenate([[0], np.cumsum([len(a) for a in self._ancestors])])
+        return indptr, np.concatenate(self._ancestors + [np.empty(0, dtype=np.int64)])
+
+    def cycles(self) -> list[np.ndarray]:
+        """Returns: list of np.array of int, IDs of the investors of each cycle of ownership"""
+        self.resolve_all()
+        cyclic = np.flatnonzero(self._cyclic)
+        return [np.sort(self.ids[cyclic[self._component[cyclic] == c]]) for c in np.unique(self._component[cyclic])]
+
+    def _code(self, investor_id: int) -> int:
+        v = self._index.get_indexer([investor_id])[0]
+        if v < 0:
+            raise ValueError(f'Unknown investor: {investor_id}')
+        return v
+
+    def deal_owners(self, deal_ids: Sequence[int], investor_ids: Sequence[int]) -> pd.DataFrame:
+        """
+        Args
+        - deal_ids: list of int, shape [D], ID of each deal
+        - investor_ids: list of int, shape [D], ID of the operating company of each deal
+        Returns: pd.DataFrame, for each deal whose operating company is in the graph: deal_id, ultimate_owner_id
+            (the ultimate owner with the largest share, with ties broken by the smallest ID), ultimate_owner_share,
+            num_ultimate_owners, num_ancestors and owner_in_cycle (whether the ownership of the operating company
+            involves a cycle)
+        """
+        codes = self.codes(investor_ids)
+        deal_ids = np.asarray(deal_ids)[codes >= 0]
+        codes = codes[codes >= 0]
+        self._resolve(np.unique(codes))
+
+        rows = []
+        for deal_id, v in zip(deal_ids, codes):
+            owners, shares = self._owners[v]
+            top = np.lexsort((self.ids[owners], -shares))[0]
+            ancestors = self._ancestors[v]
+            rows.append({'deal_id': deal_id, 'ultimate_owner_id': self.ids[owners[top]],
+                         'ultimate_owner_share': shares[top], 'num_ultimate_owners': len(owners),
+                         'num_ancestors': len(ancestors),
+                         'owner_in_cycle': bool(self._cyclic[v] or np.any(self._cyclic[ancestors]))})
+        return pd.DataFrame(rows, columns=['deal_id', 'ultimate_owner_id', 'ultimate_owner_share',
+                                           'num_ultimate_owners', 'num_ancestors', 'owner_in_cycle'])
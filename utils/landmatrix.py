@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+# bump when parsing changes, to rebuild every cached table
+CACHE_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+
+# name of each table => its source file in the raw LandMatrix directory
+TABLE_SOURCES = {
+    'deals': 'deals.csv',
+    'locations': 'locations.csv',
+    'contracts': 'contracts.csv',
+    'investors': 'investors.csv',
+    'involvements': 'involvements.csv',
+    'datasources': 'datasources.csv',
+    'locations_geojson': 'locations.geojson',
+    'areas': 'areas.geojson',
+}
+
+# investment type => pattern of the intentions of investment it groups, in order of precedence
+INVESTMENT_TYPES = {
+    'Food': 'Food crops|Agriculture',
+    'Non-food': 'Non-food|Biofuels',
+    'Livestock': 'Livestock',
+    'Forestry': 'Forest|Timber|Conservation',
+    'Mining': 'Mining',
+    'Energy': 'Energy',
+    'Industry': 'Industry',
+}
+CROP_DUMMIES = {
+    'palm_oil': 'Oil Palm',
+    'rubber': 'Rubber',
+    'staples': 'Rice|Wheat|Corn|Casava|Soya|Beans|Potatoes',
+}
+# investment types inferred from the crops of these deals
+MANUAL_INVESTMENT_TYPES = {3214: 'Forestry', 8906: 'Forestry', 8452: 'Food', 5899: 'Food', 1334: 'Food', 8679: 'Food'}
+
+
+def clean_column_name(name: str) -> str:
+    """
+    Returns: str, name in lowercase, with spaces replaced by '_' and without ':' or a
+        parenthesized suffix, e.g. 'Intended size (in ha)' => 'intended_size'
+    """
+    name = name.lower().replace(' ', '_').replace(':', '')
+    return re.sub(r'_\(.+\)', '', name)
+
+
+def _type_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Cleans the column names, and casts ID columns to nullable integers and text columns to nullable strings."""
+    names = [clean_column_name(col) for col in df.columns]
+    # columns distinguished only by their suffix, e.g. 'Jobs created (total)' and 'Jobs created (foreign)', keep it
+    df.columns = [re.sub(r'[()]', '', col.lower().replace(' ', '_').replace(':', '')) if names.count(name) > 1
+                  else name for col, name in zip(df.columns, names)]
+    for col in df.columns:
+        if re.search(r'(^|_)id($|_)', col):
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
+        elif df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].astype('string')
+    return df
+
+
+def read_csv_table(path: str) -> pd.DataFrame:
+    """
+    Args
+    - path: str, path to a CSV exported by the LandMatrix, which may have quoted
+        fields spanning several lines
+    Returns: pd.DataFrame, with clean column names and typed columns
+    """
+    return _type_columns(pd.read_csv(path, low_memory=False, encoding='utf-8'))
+
+
+def read_geojson_table(path: str) -> pd.DataFrame:
+    """
+    Args
+    - path: str, path to a GeoJSON FeatureCollection exported by the LandMatrix
+    Returns: pd.DataFrame, the properties of each feature, its geometry as a
+        GeoJSON string, and the lon and lat of Point geometries (NaN otherwise)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        features = json.load(f)['features']
+    rows = []
+    for feature in features:
+        geometry = feature.get('geometry') or {}
+        is_point = geometry.get('type') == 'Point'
+        rows.append({
+            **(feature.get('properties') or {}),
+            'geometry': json.dumps(geometry) if geometry else None,
+            'lon': geometry['coordinates'][0] if is_point else np.nan,
+            'lat': geometry['coordinates'][1] if is_point else np.nan,
+        })
+    return _type_columns(pd.DataFrame(rows))
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """Returns: str, hex digest of the SHA-256 hash of the file's contents"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LandMatrixTables:
+    """Typed Parquet caches of the tables of a raw LandMatrix export.
+
+    Each table is parsed from its source file once and saved as
+    '{name}.parquet' in the cache directory. The manifest records the SHA-256
+    hash of the source each table was parsed from, so a table is only parsed
+    again when its source file changes (or CACHE_VERSION is bumped).
+
+    Requires pyarrow (or fastparquet), for pandas to read and write Parquet.
+    """
+    def __init__(self, raw_dir: str, cache_dir: str, sources: Optional[dict[str, str]] = None):
+        """
+        Args
+        - raw_dir: str, directory with the files exported by the LandMatrix
+        - cache_dir: str, directory of the cached tables, created if needed
+        - sources: dict, name of each table => its source file in raw_dir, defaults to TABLE_SOURCES
+        """
+        self.raw_dir = raw_dir
+        self.cache_dir = cache_dir
+        self.sources = dict(TABLE_SOURCES if sources is None else sources)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_FILENAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == CACHE_VERSION:
+                self.manifest = manifest['tables']
+
+    def available(self) -> list[str]:
+        """Returns: list of str, names of the tables whose source file exists"""
+        return [name for name, source in self.sources.items()
+                if os.path.exists(os.path.join(self.raw_dir, source))]
+
+    def _save_manifest(self) -> None:
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'tables': self.manifest}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def load(self, name: str) -> pd.DataFrame:
+        """
+        Args
+        - name: str, name of the table, a key of sources
+        Returns: pd.DataFrame, the cached table, parsed again (and cached) if its source has changed
+        """
+        if name not in self.sources:
+            raise ValueError(f'Unknown table: {name}')
+        source_path = os.path.join(self.raw_dir, self.sources[name])
+        cache_path = os.path.join(self.cache_dir, f'{name}.parquet')
+
+        digest = file_sha256(source_path)
+        entry = self.manifest.get(name)
+        if entry is not None and entry['sha256'] == digest and os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
+
+        if source_path.endswith('.geojson'):
+            df = read_geojson_table(source_path)
+        else:
+            df = read_csv_table(source_path)
+        df.to_parquet(cache_path, index=False)
+        self.manifest[name] = {'source': self.sources[name], 'sha256': digest, 'rows': len(df)}
+        self._save_manifest()
+        print(f'Parsed {len(df)} rows of {name} from {source_path}')
+        return df
+
+    def load_all(self) -> dict[str, pd.DataFrame]:
+        """Returns: dict, name => table, for every table whose source file exists"""
+        return {name: self.load(name) for name in self.available()}
+
+
+def _drop_sparse_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Drops the columns that are missing in at least half of the rows, as most of them are."""
+    return df.loc[:, df.isna().mean() < 0.5]
+
+
+def _split_first(s: pd.Series, sep: str) -> tuple[pd.Series, pd.Series]:
+    """
+    Returns
+    - head: pd.Series, the text before the first sep (the whole text if sep does not occur)
+    - found: pd.Series of bool, whether sep occurs in the text
+    """
+    return s.str.split(sep, regex=False).str[0], s.str.contains(sep, regex=False).fillna(False).astype(bool)
+
+
+def trailing_year(s: pd.Series) -> pd.Series:
+    """
+    Returns: pd.Series of Int64, the year of the date (YYYY, YYYY-MM or YYYY-MM-DD)
+        at the end of each text, or NA
+    """
+    token = s.str.extract(r'([0-9-]{4,10})$', expand=False)
+    suffix = token.str.count('-').map({0: '-01-01', 1: '-01'}).fillna('')
+    dates = pd.to_datetime(token + suffix, format='%Y-%m-%d', errors='coerce')
+    return dates.dt.year.astype('Int64')
+
+
+def _investment_type(intention: pd.Series) -> pd.Series:
+    """Groups the last intention of investment of each deal into INVESTMENT_TYPES, or 'Other'."""
+    candidate = intention.str.extract(r'([A-Za-z\- ,/]+)$', expand=False).fillna('Other')
+    conditions = [candidate.str.contains(pattern).to_numpy(dtype=bool) for pattern in INVESTMENT_TYPES.values()]
+    return pd.Series(np.select(conditions, list(INVESTMENT_TYPES), default='Other'), index=intention.index)
+
+
+def _deal_locations(locations: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns: pd.DataFrame, lat and lon of each deal, the average of its locations
+        more precise than an administrative region
+    """
+    latlon = locations['point'].str.split(',', n=1, expand=True)
+    locations = locations.assign(lat=pd.to_numeric(latlon[0], errors='coerce'),
+                                 lon=pd.to_numeric(latlon[1], errors='coerce'))
+    precise = locations['spatial_accuracy_level'].notna() \
+        & ~locations['spatial_accuracy_level'].isin(['Administrative region', 'Country'])
+    locations = locations[precise].dropna(subset=['lat', 'lon'])
+    return locations.groupby('deal_id', as_index=False)[['lat', 'lon']].mean()
+
+
+def build_lsla(tables: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Builds the table of deals (lsla) as preprocessing/process_landmatrix.R does:
+    joins the contracts, operating investor and location of each deal, extracts
+    the years in which it was signed, became operational and was abandoned,
+    groups its investment type, and drops deals without a location or years.
+    Args
+    - tables: dict, name => table, from LandMatrixTables.load_all(), with at least
+        deals, contracts, investors and locations
+    Returns: pd.DataFrame, one row per deal (per operating investor, for the few
+        deals whose investor ID is duplicated)
+    """
+    deals = _drop_sparse_columns(tables['deals'])
+    deals = deals.drop(columns=['is_public', 'not_public', 'size_under_contract', 'comment_on_land_area',
+                                'current_size_under_contract'], errors='ignore')
+    deals = deals.rename(columns={
+        'operating_company_investor_id': 'investor_id', 'target_country': 'country',
+        'current_size_in_operation': 'area_in_operation', 'deal_size': 'area_contracted',
+        'intended_size': 'area_intended',
+        'operating_company_country_of_registration/origin': 'operating_company_registration'})
+
+    investors = _drop_sparse_columns(tables['investors']).add_prefix('investor_')
+    investors = investors.rename(columns={
+        'investor_investor_id': 'investor_id',
+        'investor_country_of_registration/origin': 'investor_country_of_registration'})
+
+    contracts = _drop_sparse_columns(tables['contracts'])
+    durations = contracts.groupby('deal_id')['duration_of_the_agreement'].max().fillna(0).clip(lower=0)
+    contracts = durations[durations != 0].rename('contract_duration').reset_index()  # keep the longest duration
+
+    locations = _deal_locations(_drop_sparse_columns(tables['locations']))
+
+    lsla = deals.merge(contracts, on='deal_id', how='left') \
+        .merge(investors, on='investor_id', how='left') \
+        .merge(locations, on='deal_id', how='left')
+
+    # Changes of status are separated by '|', with the current one marked by '#current#' after the date of the change.
+    # Only concluded deals are exported, so the date before the current negotiation status is the signing date.
+    before_current, _ = _split_first(lsla['negotiation_status'], '#current#')
+    concluded, _ = _split_first(before_current, '##Concluded (Contract signed)')
+    lsla['year_signed'] = trailing_year(concluded)
+
+    before_current, _ = _split_first(lsla['implementation_status'], '#current#')
+    before_production, was_in_production = _split_first(before_current, '##In operation (production)')
+    year_current, year_production = trailing_year(before_current), trailing_year(before_production)
+
+    status = lsla['current_implementation_status']
+    in_operation = (status == 'In operation (production)').fillna(False).astype(bool)
+    abandoned = ((status == 'Project abandoned').fillna(False) & was_in_production).astype(bool)
+    lsla['year_operational'] = pd.Series(pd.NA, index=lsla.index, dtype='Int64')
+    lsla['year_abandoned'] = pd.Series(pd.NA, index=lsla.index, dtype='Int64')
+    lsla.loc[in_operation, 'year_operational'] = pd.concat(
+        [year_current, year_production], axis=1)[in_operation].min(axis=1, skipna=True).astype('Int64')
+    lsla.loc[abandoned, 'year_operational'] = year_production[abandoned]
+    lsla.loc[abandoned, 'year_abandoned'] = year_current[abandoned]
+
+    # Group investment types and reclassify them according to the crops
+    lsla['investment_type'] = _investment_type(lsla['intention_of_investment'])
+    lsla['crop_type'] = lsla['crops_area/yield/export'].str.extract(r'([A-Za-z\-() ,/]+)$', expand=False)
+    for col, pattern in CROP_DUMMIES.items():
+        lsla[col] = lsla['crop_type'].str.contains(pattern).astype('Int64')
+    lsla.loc[(lsla['rubber'] == 1).fillna(False).astype(bool), 'investment_type'] = 'Non-food'
+    lsla.loc[(lsla['palm_oil'] == 1).fillna(False).astype(bool), 'investment_type'] = 'Food'
+    manual = lsla['deal_id'].map(MANUAL_INVESTMENT_TYPES)
+    lsla['investment_type'] = manual.fillna(lsla['investment_type']).astype('string')
+
+    lsla = lsla.drop(columns=['negotiation_status', 'implementation_status', 'intention_of_investment',
+                              'crops_area/yield/export'])
+
+    # Drop deals without a location or any year
+    lsla = lsla.dropna(subset=['lat', 'lon'])
+    lsla = lsla[lsla['year_signed'].notna() | lsla['year_operational'].notna()].reset_index(drop=True)
+
+    areas = tables.get('areas')
+    if areas is not None:
+        lsla['has_extent'] = lsla['deal_id'].isin(areas['deal_id'].dropna()).astype(int)
+    lsla.loc[lsla['area_contracted'] == 0, 'area_contracted'] = np.nan
+    return lsla
+
+
+def compare_locations(lsla: pd.DataFrame, locations_geojson: pd.DataFrame) -> pd.DataFrame:
+    """
+    Validates the locations of the deals against the GeoJSON export, as
+    preprocessing/validate_landmatrix.R does: both sources should have the same
+    deals, and the same average of their precise locations.
+    Args
+    - lsla: pd.DataFrame, from build_lsla()
+    - locations_geojson: pd.DataFrame, the locations_geojson table
+    Returns: pd.DataFrame, deal_id, lat, lon (from the CSV export) and geojson_lat,
+        geojson_lon (NaN for deals only in the CSV export) of each deal
+    """
+    precise = ~locations_geojson['spatial_accuracy'].fillna('').isin(['ADMINISTRATIVE_REGION', 'COUNTRY', ''])
+    geojson = locations_geojson[precise].groupby('deal_id', as_index=False)[['lat', 'lon']].mean()
+    geojson = geojson.rename(columns={'lat': 'geojson_lat', 'lon': 'geojson_lon'})
+
+    deals = lsla[['deal_id', 'lat', 'lon']].drop_duplicates('deal_id')
+    compared = deals.merge(geojson, on='deal_id', how='left')
+    only_csv = compared['geojson_lat'].isna().sum()
+    dist = np.hypot(compared['lat'] - compared['geojson_lat'], compared['lon'] - compared['geojson_lon'])
+    print(f'{len(deals)} deals: {only_csv} without a precise location in the GeoJSON export, '
+          f'{np.sum(dist > 1e-4)} with a different location (max difference {np.nanmax(dist, initial=0):.4f} deg)')
+    return compared
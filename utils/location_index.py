@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+class LocationIndex:
+    """Maps exact (lat, lon) locations to labels (e.g. countries).
+
+    Locations are stored as a sorted array of 64-bit keys, formed from the
+    float32 bit patterns of lat and lon (the precision at which locations are
+    stored in TFRecords and features.npz), and labels as integer codes into a
+    sorted array of names. Lookups are an exact-match join with np.searchsorted,
+    vectorized over all query locations.
+    """
+    def __init__(self, keys: np.ndarray, codes: np.ndarray, names: Sequence[str]):
+        """
+        Args
+        - keys: np.array of uint64, shape [N], sorted location keys, see location_keys()
+        - codes: np.array of int, shape [N], index into names of each location's label
+        - names: list of str, names of the labels
+        """
+        self.keys = np.asarray(keys, dtype=np.uint64)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.names = np.asarray(names, dtype=str)
+        if np.any(self.keys[1:] <= self.keys[:-1]):
+            raise ValueError('keys must be sorted and unique')
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_locations(cls, locs: np.ndarray, labels: Sequence[str]) -> LocationIndex:
+        """
+        Args
+        - locs: np.array, shape [N, 2], each row is [lat, lon]
+        - labels: list of str, shape [N], label of each location
+        Returns: LocationIndex, raises a ValueError if a location has several labels
+        """
+        keys = location_keys(locs)
+        names, codes = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+        order = np.argsort(keys, kind='stable')
+        keys, codes = keys[order], codes[order]
+
+        dup = keys[1:] == keys[:-1]
+        if np.any(codes[1:][dup] != codes[:-1][dup]):
+            raise ValueError('some locations have more than one label')
+        keep = np.concatenate([[True], ~dup])
+        return cls(keys[keep], codes[keep], names)
+
+    @classmethod
+    def from_loc_dict(cls, loc_dict: Mapping[tuple, Mapping[str, str]], field: str = 'country') -> LocationIndex:
+        """
+        Args
+        - loc_dict: dict, maps (lat, lon) => dict of attributes, e.g. dhs_loc_dict.pkl from Yeh et al. (2020)
+        - field: str, attribute to use as the label
+        """
+        locs = np.array(list(loc_dict.keys()), dtype=np.float64)
+        labels = [attrs[field] for attrs in loc_dict.values()]
+        return cls.from_locations(locs, labels)
+
+    @classmethod
+    def load(cls, path: str) -> LocationIndex:
+        npz = np.load(path)
+        return cls(npz['keys'], npz['codes'], npz['names'])
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, keys=self.keys, codes=self.codes, names=self.names)
+
+    def lookup(self, locs: np.ndarray, missing: Optional[int] = None) -> np.ndarray:
+        """
+        Args
+        - locs: np.array, shape [M, 2], each row is [lat, lon]
+        - missing: int, code to return for locations not in the index, or None
+            to raise a ValueError
+        Returns: np.array of int, shape [M], code of each location's label
+        """
+        keys = location_keys(locs)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys if len(self.keys) > 0 else np.zeros(len(keys), dtype=bool)
+        if missing is None and not np.all(found):
+            raise ValueError(f'{np.sum(~found)} of {len(keys)} locations are not in the index')
+        return np.where(found, self.codes[pos], -1 if missing is None else missing)
+
+    def lookup_names(self, locs: np.ndarray, missing: str = '') -> np.ndarray:
+        """
+        Returns: np.array of str, shape [M], label of each location ('missing' if not in the index)
+        """
+        codes = self.lookup(locs, missing=-1)
+        return np.where(codes >= 0, self.names[np.maximum(codes, 0)], missing)
+
+
+def location_keys(locs: np.ndarray) -> np.ndarray:
+    """
+    Args
+    - locs: np.array, shape [N, 2], each row is [lat, lon]
+    Returns: np.array of uint64, shape [N], key of each location from the
+        float32 bit patterns of its lat (high 32 bits) and lon (low 32 bits)
+    """
+    locs = np.asarray(locs, dtype=np.float32).reshape(-1, 2) + np.float32(0)  # -0.0 => 0.0
+    bits = np.ascontiguousarray(locs).view(np.uint32).astype(np.uint64)
+    return (bits[:, 0] << np.uint64(32)) | bits[:, 1]
+
+
+def deal_location_index(locs_csv_path: str, deals_csv_path: str, country_codes_csv_path: str) -> LocationIndex:
+    """
+    Builds the index of the country (ISO3 code) of each land deal location, i.e.
+    of the location of every tile of the deal, as joined later in
+    merge_and_validate.R from the deal's target country and country_to_code.csv.
+    Args
+    - locs_csv_path: str, path to earthengine_locs.csv (deal_id, lat, lon)
+    - deals_csv_path: str, path to the Land Matrix deals.csv ('Deal ID', 'Target country')
+    - country_codes_csv_path: str, path to country_to_code.csv (country, country_code)
+    Returns: LocationIndex
+    """
+    locs = pd.read_csv(locs_csv_path, float_precision='high')
+    deals = pd.read_csv(deals_csv_path, usecols=['Deal ID', 'Target country'], low_memory=False)
+    deals = deals.rename(columns={'Deal ID': 'deal_id', 'Target country': 'country'})
+    codes = pd.read_csv(country_codes_csv_path)
+
+    df = locs.merge(deals, on='deal_id', how='left').merge(codes, on='country', how='left')
+    missing = df['country_code'].isna()
+    if missing.any():
+        # as for the left join in merge_and_validate.R, these deals are left without a country code
+        print(f'No country code for {sorted(df.loc[missing, "country"].unique())} (deals {df.loc[missing, "deal_id"].tolist()})')
+        df = df[~missing]
+    return LocationIndex.from_locations(df[['lat', 'lon']].to_numpy(), df['country_code'])
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from collections.abc import Iterable
+import os
+import re
+from typing import Optional
+
+import numpy as np
+import tensorflow as tf
+
+
+TILE_SIZE = 255      # side length (in pixels) of each exported tile
+TILE_CROP = (15, 16)  # pixels cropped from the (start, end) of each side by Batcher, 255 -> 224
+
+# processed tiles are named '{deal_id}_{year}_{tile_id:03d}.tfrecord.gz'
+TILE_FILENAME_RE = re.compile(r'^(\d+)_(\d{4})_(\d{3})\.tfrecord(\.gz)?$')
+
+
+def group_tile_paths(tfrecord_paths: Iterable[str], grid_width: int = 5
+                     ) -> list[str]:
+    """
+    Orders processed tile TFRecords so that the grid_width^2 tiles of each
+    (deal_id, year) mosaic are consecutive and in row-major (tile_id) order,
+    dropping mosaics that are missing tiles.
+    Args
+    - tfrecord_paths: list of str, paths to per-tile TFRecords
+    - grid_width: int, number of tiles along each side of a mosaic, i.e. 2 * NRINGS + 1
+    Returns: list of str, ordered paths, length is a multiple of grid_width^2
+    """
+    mosaics: dict[tuple[int, int], dict[int, str]] = defaultdict(dict)
+    for path in tfrecord_paths:
+        match = TILE_FILENAME_RE.match(os.path.basename(path))
+        if match is None:
+            raise ValueError(f'Unexpected tile filename: {path}')
+        deal_id, year, tile_id = (int(x) for x in match.groups()[:3])
+        mosaics[(deal_id, year)][tile_id] = path
+
+    num_tiles = grid_width ** 2
+    ordered = []
+    for key in sorted(mosaics):
+        tiles = mosaics[key]
+        if sorted(tiles) != list(range(num_tiles)):
+            print(f'Skipping incomplete mosaic (deal_id, year) = {key}: found {len(tiles)} tiles')
+            continue
+        ordered.extend(tiles[i] for i in range(num_tiles))
+    return ordered
+
+
+def _interval_overlaps(starts: np.ndarray, ends: np.ndarray, cell_size: float,
+                       num_cells: int) -> np.ndarray:
+    """
+    Args
+    - starts, ends: np.array, shape [N], pixel intervals [start, end)
+    - cell_size: float, number of input pixels covered by each feature-map cell
+    - num_cells: int, number of feature-map cells along the axis
+    Returns: np.array, shape [N, num_cells], number of pixels of each interval inside each cell
+    """
+    cell_starts = np.arange(num_cells) * cell_size
+    cell_ends = cell_starts + cell_size
+    overlap = (np.minimum(ends[:, None], cell_ends[None, :])
+               - np.maximum(starts[:, None], cell_starts[None, :]))
+    return np.clip(overlap, 0, None)
+
+
+def tile_pooling_weights(grid_width: int, feature_size: int,
+                         tile_size: int = TILE_SIZE,
+                         crop: tuple[int, int] = TILE_CROP) -> np.ndarray:
+    """
+    Builds the matrix that average-pools a mosaic's final feature map into one
+    feature vector per tile. Each feature-map cell is assumed to cover an equal
+    share of the mosaic, and is weighted by its area of overlap with the cropped
+    (224x224) footprint of the tile, i.e. the same pixels the per-tile path sees.
+    Args
+    - grid_width: int, number of tiles along each side of the mosaic
+    - feature_size: int, side length of the final feature map, e.g. 40 for a 1275px mosaic
+    - tile_size: int, side length of each tile in pixels
+    - crop: tuple (start, end), pixels cropped from each side of each tile
+    Returns: np.array, shape [grid_width^2, feature_size^2], type float32, rows sum to 1,
+        rows in row-major tile order, columns in row-major cell order
+    """
+    cell_size = grid_width * tile_size / feature_size
+    offsets = np.arange(grid_width) * tile_size
+    starts = offsets + crop[0]
+    ends = offsets + tile_size - crop[1]
+    w1d = _interval_overlaps(starts, ends, cell_size, feature_size)  # [G, h]
+
+    # outer product over (row, col) => [G, G, h, w]
+    w2d = w1d[:, None, :, None] * w1d[None, :, None, :]
+    w2d = w2d.reshape(grid_width ** 2, feature_size ** 2)
+    w2d /= w2d.sum(axis=1, keepdims=True)
+    return w2d.astype(np.float32)
+
+
+def pool_mosaic_tiles(spatial_features: tf.Tensor, grid_width: int) -> tf.Tensor:
+    """
+    Args
+    - spatial_features: tf.Tensor, shape [batch_size, h, w, C], final conv layer of the
+        CNN run over a batch of square mosaics, h == w must be statically known
+    - grid_width: int, number of tiles along each side of each mosaic
+    Returns: tf.Tensor, shape [batch_size * grid_width^2, C], per-tile features in
+        (mosaic, row-major tile) order
+    """
+    _, h, w, num_channels = spatial_features.get_shape().as_list()
+    assert h == w, 'mosaics must be square'
+    weights = tf.constant(tile_pooling_weights(grid_width, h), name='tile_pooling_weights')
+    flat = tf.reshape(spatial_features, [-1, h * w, num_channels])
+    pooled = tf.einsum('tk,bkc->btc', weights, flat)
+    return tf.reshape(pooled, [-1, num_channels])
+
+
+def _synthetic_feature_map(img: np.ndarray, feature_size: int, projection: np.ndarray) -> np.ndarray:
+    """
+    Stand-in for the convolutional part of the CNN: averages the image over each
+    cell of a feature_size x feature_size grid covering it (as the ResNet's
+    receptive fields shrink a 224px tile to 7x7 cells), then applies a 1x1
+    projection and a ReLU to each cell.
+    Args
+    - img: np.array, shape [n, n, C], a tile crop or a mosaic
+    - feature_size: int, side length of the feature map
+    - projection: np.array, shape [C, K]
+    Returns: np.array, shape [feature_size^2, K], in row-major cell order
+    """
+    n = img.shape[0]
+    pixels = np.arange(n, dtype=np.float64)
+    w = _interval_overlaps(pixels, pixels + 1, n / feature_size, feature_size)  # [n, feature_size]
+    w /= w.sum(axis=0, keepdims=True)
+    cells = np.einsum('yh,ywc->hwc', w, np.einsum('xw,yxc->ywc', w, img))
+    return np.maximum(cells.reshape(-1, img.shape[2]) @ projection, 0)
+
+
+def check_pooling_equivalence(grid_width: int = 5, feature_size: Optional[int] = None, tile_feature_size: int = 7,
+                              num_bands: int = 7, num_channels: int = 64, rtol: float = 0.05,
+                              seed: int = 0) -> dict[str, float]:
+    """
+    Checks that features pooled from a mosaic's feature map with
+    tile_pooling_weights() match those of the per-tile path (each 224x224 crop
+    run separately, then average-pooled), on a synthetic, spatially smooth mosaic
+    and a synthetic feature extractor (see _synthetic_feature_map). The two only
+    differ because the cells of the mosaic's feature map straddle the borders of
+    the tile crops. With the defaults (a 5x5 mosaic of 255px tiles, i.e. 1275px
+    and a 40x40 feature map as for ResNet-18) and seed 0, the relative difference
+    is 1.9% on average and 2.4% at most, with cosine similarities above 0.999.
+    Args
+    - grid_width: int, number of tiles along each side of the mosaic
+    - feature_size: int, side length of the mosaic's feature map, None for that of
+        a ResNet (which downsamples by 32 with SAME padding)
+    - tile_feature_size: int, side length of the feature map of each tile crop
+    - num_bands, num_channels: int, number of image bands and of feature channels
+    - rtol: float, maximum relative (L2) difference between the features of any tile
+    - seed: int, seed of the synthetic mosaic and feature extractor
+    Returns: dict, the maximum and mean relative differences and the minimum cosine
+        similarity between the features of the two paths
+    Raises an AssertionError if the features of any tile differ by more than rtol.
+    """
+    rng = np.random.default_rng(seed)
+    size = grid_width * TILE_SIZE
+    if feature_size is None:
+        feature_size = -(-size // 32)
+    y, x = np.mgrid[0:size, 0:size] / 60.0   # smooth over ~60px (~2km), plus pixel noise
+    img = 0.3 * rng.standard_normal((size, size, num_bands))
+    for _ in range(8):
+        fy, fx = rng.standard_normal(2)
+        img += np.sin(fx * x + fy * y + rng.uniform(0, 2 * np.pi))[..., None] * rng.standard_normal(num_bands)
+    projection = rng.standard_normal((num_bands, num_channels))
+
+    mosaic = tile_pooling_weights(grid_width, feature_size) @ _synthetic_feature_map(img, feature_size, projection)
+    tiles = []
+    for row in range(grid_width):
+        for col in range(grid_width):
+            y0, x0 = row * TILE_SIZE, col * TILE_SIZE
+            crop = img[y0 + TILE_CROP[0]:y0 + TILE_SIZE - TILE_CROP[1], x0 + TILE_CROP[0]:x0 + TILE_SIZE - TILE_CROP[1]]
+            tiles.append(_synthetic_feature_map(crop, tile_feature_size, projection).mean(axis=0))
+    tiles = np.stack(tiles)
+
+    norms = np.linalg.norm(tiles, axis=1)
+    rel_diff = np.linalg.norm(mosaic - tiles, axis=1) / norms
+    cosine = np.sum(mosaic * tiles, axis=1) / (np.linalg.norm(mosaic, axis=1) * norms)
+    summary = {
+        'rel_diff_max': float(np.max(rel_diff)),
+        'rel_diff_mean': float(np.mean(rel_diff)),
+        'cosine_min': float(np.min(cosine)),
+    }
+    print('Mosaic pooling check: ' + ', '.join(f'{k}: {v:.4f}' for k, v in summary.items()))
+    assert summary['rel_diff_max'] <= rtol, \
+        f'pooled mosaic features differ from per-tile features by up to {summary["rel_diff_max"]:.4f} > {rtol}'
+    return summary
+
+
+def compare_extractions(tile_npz_path: str, mosaic_npz_path: str) -> dict[str, float]:
+    """
+    Validates mosaic extraction against the per-tile path by matching tiles on
+    (label, year) and comparing their features and predictions.
+    Args
+    - tile_npz_path: str, path to features.npz from per-tile extraction
+    - mosaic_npz_path: str, path to features .npz from mosaic extraction
+    Returns: dict, summary statistics of the agreement between the two
+    """
+    tile = np.load(tile_npz_path)
+    mosaic = np.load(mosaic_npz_path)
+
+    tile_index = {(label, year): i for i, (label, year)
+                  in enumerate(zip(tile['labels'], tile['years']))}
+    pairs = [(tile_index[(label, year)], j) for j, (label, year)
+             in enumerate(zip(mosaic['labels'], mosaic['years']))
+             if (label, year) in tile_index]
+    if len(pairs) == 0:
+        raise ValueError('No tiles in common between the two feature files')
+    ti, mi = (np.asarray(x) for x in zip(*pairs))
+
+    f_tile, f_mosaic = tile['features'][ti], mosaic['features'][mi]
+    p_tile, p_mosaic = tile['preds'][ti], mosaic['preds'][mi]
+    cosine = np.sum(f_tile * f_mosaic, axis=1) / (
+        np.linalg.norm(f_tile, axis=1) * np.linalg.norm(f_mosaic, axis=1) + 1e-12)
+
+    summary = {
+        'num_tiles_matched': float(len(pairs)),
+        'features_cosine_mean': float(np.mean(cosine)),
+        'features_cosine_min': float(np.min(cosine)),
+        'features_max_abs_diff': float(np.max(np.abs(f_tile - f_mosaic))),
+        'preds_corr': float(np.corrcoef(p_tile, p_mosaic)[0, 1]),
+        'preds_mean_abs_diff': float(np.mean(np.abs(p_tile - p_mosaic))),
+        'preds_max_abs_diff': float(np.max(np.abs(p_tile - p_mosaic))),
+    }
+    for k, v in summary.items():
+        print(f'{k}: {v:.6f}')
+    return summary
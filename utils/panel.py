@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+GROUP_COLS = ('deal_id', 'tile_id')
+ORDER_COL = 'year'
+
+# column => (number of lags, number of leads), as constructed in preprocessing/merge_and_validate.R
+LAG_LEAD_SPEC = {
+    'assets': (3, 1),
+    'signed': (3, 3),
+    'operational': (3, 3),
+}
+
+# treatment indicator => column with the year it starts, as constructed in preprocessing/merge_and_validate.R
+TREATMENT_YEARS = {
+    'signed': 'year_signed',
+    'operational': 'year_operational',
+    'abandoned': 'year_abandoned',
+}
+EVENT_STUDY_TREATMENTS = ('signed', 'operational')
+
+
+def lag_lead_columns(spec: Mapping[str, tuple[int, int]] = LAG_LEAD_SPEC) -> list[str]:
+    """
+    Returns: list of str, names of the lag/lead columns, e.g. 'assets_lag_1' and 'assets_lead_1'
+    """
+    names = []
+    for col, (num_lags, num_leads) in spec.items():
+        names += [f'{col}_lag_{k}' for k in range(1, num_lags + 1)]
+        names += [f'{col}_lead_{k}' for k in range(1, num_leads + 1)]
+    return names
+
+
+def add_lags_leads(panel: pd.DataFrame,
+                   spec: Mapping[str, tuple[int, int]] = LAG_LEAD_SPEC,
+                   group_cols: Sequence[str] = GROUP_COLS,
+                   order_col: str = ORDER_COL) -> pd.DataFrame:
+    """
+    Adds lagged and lead values of columns within each (deal_id, tile_id) group,
+    ordered by year. As with dplyr::lag()/lead() in merge_and_validate.R, lags
+    and leads are by position within the group (i.e. by period), not by calendar
+    year, and are NaN where the group has no such period.
+    Args
+    - panel: pd.DataFrame, with group_cols, order_col and the columns in spec
+    - spec: dict, column => (number of lags, number of leads), columns not in panel are skipped
+    - group_cols: list of str, columns identifying each unit of the panel
+    - order_col: str, column to order periods by within each unit
+    Returns: pd.DataFrame, sorted by group_cols and order_col, with lag/lead columns (re)computed
+    """
+    panel = panel.sort_values([*group_cols, order_col], kind='mergesort').reset_index(drop=True)
+    grouped = panel.groupby(list(group_cols), sort=False)
+    for col, (num_lags, num_leads) in spec.items():
+        if col not in panel.columns:
+            continue
+        for k in range(1, num_lags + 1):
+            panel[f'{col}_lag_{k}'] = grouped[col].shift(k)
+        for k in range(1, num_leads + 1):
+            panel[f'{col}_lead_{k}'] = grouped[col].shift(-k)
+    return panel
+
+
+def update_panel(panel: pd.DataFrame, new_rows: pd.DataFrame,
+                 spec: Mapping[str, tuple[int, int]] = LAG_LEAD_SPEC,
+                 group_cols: Sequence[str] = GROUP_COLS,
+                 order_col: str = ORDER_COL,
+                 affected: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Incrementally adds the rows for newly added periods to a panel that already
+    has lag/lead columns. Existing rows for the same (group, year) are replaced,
+    and lag/lead columns are only recomputed for the (deal_id, tile_id) groups
+    that received new rows; all other rows are left untouched.
+    Args
+    - panel: pd.DataFrame, existing panel, e.g. the output of add_lags_leads()
+    - new_rows: pd.DataFrame, rows for the new periods, without lag/lead columns
+    - spec, group_cols, order_col: see add_lags_leads()
+    - affected: pd.DataFrame, with group_cols, groups whose lag/lead columns to
+        recompute, or None to use the groups in new_rows
+    Returns: pd.DataFrame, updated panel, sorted by group_cols and order_col
+    """
+    group_cols = list(group_cols)
+    keys = [*group_cols, order_col]
+    if new_rows.duplicated(keys).any():
+        raise ValueError(f'new_rows has duplicate {keys}')
+
+    # drop existing rows that are replaced by new rows
+    replaced = panel[keys].merge(new_rows[keys], on=keys, how='left', indicator=True)['_merge'] == 'both'
+    panel = panel.loc[~replaced.to_numpy()]
+
+    if affected is None:
+        affected = new_rows[group_cols].drop_duplicates()
+    is_affected = panel[group_cols].merge(
+        affected, on=group_cols, how='left', indicator=True)['_merge'].to_numpy() == 'both'
+
+    derived = set(lag_lead_columns(spec))
+    new_rows = new_rows.drop(columns=[c for c in new_rows.columns if c in derived])
+    recomputed = add_lags_leads(
+        pd.concat([panel.loc[is_affected], new_rows], ignore_index=True),
+        spec=spec, group_cols=group_cols, order_col=order_col)
+
+    updated = pd.concat([panel.loc[~is_affected], recomputed], ignore_index=True)
+    return updated.sort_values(keys, kind='mergesort').reset_index(drop=True)
+
+
+def append_rows(existing: pd.DataFrame, new_rows: pd.DataFrame,
+                group_cols: Sequence[str] = GROUP_COLS,
+                order_col: str = ORDER_COL) -> pd.DataFrame:
+    """
+    Appends rows for new periods to a table without lag/lead columns (e.g.
+    data/asset_predictions.csv), replacing existing rows for the same years.
+    Returns: pd.DataFrame, sorted by group_cols and order_col
+    """
+    keep = ~existing[order_col].isin(np.unique(new_rows[order_col]))
+    print(f'Appending {len(new_rows)} rows (replacing {int((~keep).sum())} existing rows for the same years)')
+    appended = pd.concat([existing.loc[keep], new_rows], ignore_index=True)
+    return appended.sort_values([*group_cols, order_col], kind='mergesort').reset_index(drop=True)
+
+
+def _dummy(condition: np.ndarray, missing: np.ndarray) -> np.ndarray:
+    """Returns: np.array, 1.0 where condition, 0.0 where not, NaN where missing (as ifelse() with NA in R)"""
+    return np.where(missing, np.nan, condition.astype(np.float64))
+
+
+def panel_rows(panel: pd.DataFrame, new_rows: pd.DataFrame,
+               group_cols: Sequence[str] = GROUP_COLS,
+               order_col: str = ORDER_COL) -> pd.DataFrame:
+    """
+    Builds the panel rows of newly added periods from their asset predictions,
+    as merge_and_validate.R would. Columns that are constant within every
+    (deal_id, tile_id) group of the panel (deal, tile and country characteristics)
+    are copied from the latest row of the group, and the treatment indicators,
+    years since treatment, event-study and period dummies are recomputed for the
+    new years. Other columns that vary by year (the institutions scores, deal
+    exposure and concession coverage) are left missing, as are the lag/lead
+    columns, which update_panel() recomputes.
+    Args
+    - panel: pd.DataFrame, existing panel, e.g. data/mdta.csv
+    - new_rows: pd.DataFrame, with group_cols, order_col and 'assets', e.g. rows of data/asset_predictions.csv
+    - group_cols, order_col: see add_lags_leads()
+    Returns: pd.DataFrame, with the columns of panel, for the rows of new_rows whose group is in panel
+    """
+    group_cols = list(group_cols)
+    grouped = panel.groupby(group_cols, sort=False)
+    varying = grouped.nunique(dropna=False).max() > 1
+    constant = [c for c in panel.columns if c not in varying.index or not varying[c]]
+    latest = panel.sort_values(order_col, kind='mergesort').groupby(group_cols, sort=False).tail(1)
+    rows = new_rows[[*group_cols, order_col, 'assets']].merge(
+        latest[[c for c in constant if c not in (order_col, 'assets')]], on=group_cols, how='inner')
+    if len(rows) < len(new_rows):
+        # as for the inner join with lsla in merge_and_validate.R, rows of tiles that are not in the panel are dropped
+        print(f'Dropping {len(new_rows) - len(rows)} new rows of (deal_id, tile_id) groups that are not in the panel')
+
+    year = rows[order_col].to_numpy(dtype=np.float64)
+    derived = {'year_fe': year, 'pre_2000': (year < 2000).astype(np.float64),
+               'post_2003': (year >= 2003).astype(np.float64)}
+    for treatment, year_col in TREATMENT_YEARS.items():
+        since = year - rows[year_col].to_numpy(dtype=np.float64)
+        missing = np.isnan(since)
+        derived[treatment] = _dummy(since >= 0, missing)
+        derived[f'since_{treatment}'] = since
+        if treatment not in EVENT_STUDY_TREATMENTS:
+            continue
+        derived[f'es_lag2_{treatment}'] = _dummy(since == -2, missing)
+        derived[f'es_lag3_{treatment}'] = _dummy(since == -3, missing)
+        derived[f'es_lagplus4_{treatment}'] = _dummy(since < -3, missing)
+        for k in range(4):
+            derived[f'es_lead{k}_{treatment}'] = _dummy(since == k, missing)
+        derived[f'es_leadplus4_{treatment}'] = _dummy(since > 3, missing)
+    for col, values in derived.items():
+        if col in panel.columns:
+            rows[col] = values
+    return rows.reindex(columns=panel.columns)
+
+
+def add_differences(panel: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns: pd.DataFrame, panel with the differences in assets from the previous
+        and next periods (diff_lag and diff_lead), as in merge_and_validate.R
+    """
+    panel = panel.copy()
+    panel['diff_lag'] = panel['assets'] - panel['assets_lag_1']
+    panel['diff_lead'] = panel['assets'] - panel['assets_lead_1']
+    return panel
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Sequence
+import multiprocessing
+import os
+import time
+from typing import Any
+
+import numpy as np
+
+
+def shard_indices(n: int, num_shards: int) -> list[np.ndarray]:
+    """
+    Partitions range(n) into num_shards disjoint, contiguous, near-equal shards.
+    Args
+    - n: int, number of items
+    - num_shards: int
+    Returns: list of np.array of int, the indices in each shard, in order
+    """
+    return np.array_split(np.arange(n), num_shards)
+
+
+def shard_filename(filename: str, shard: int, num_shards: int) -> str:
+    """
+    'features.npz' => 'features.shard-00003-of-00008.npz'
+    """
+    root, ext = os.path.splitext(filename)
+    return f'{root}.shard-{shard:05d}-of-{num_shards:05d}{ext}'
+
+
+def worker_cpus(worker: int, num_workers: int) -> list[int]:
+    """
+    Gets a disjoint set of CPUs (from those available to this process) for a
+    worker, so that the thread pools of concurrent workers don't contend.
+    Args
+    - worker: int, index of this worker on the node, in [0, num_workers)
+    - num_workers: int, number of workers on the node
+    Returns: list of int, CPU ids
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count() or 1))
+    if num_workers > len(cpus):
+        return [cpus[worker % len(cpus)]]
+    return np.array_split(cpus, num_workers)[worker].tolist()
+
+
+def pin_to_cpus(cpus: Iterable[int]) -> None:
+    """Pins the current process (and threads it creates later) to the given CPUs, where supported."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, set(cpus))
+
+
+def run_workers(target: Callable, args_list: Sequence[tuple[Any, ...]]) -> None:
+    """
+    Runs target(*args) for each args in args_list, each in its own freshly
+    spawned process (so no TensorFlow state is inherited from the parent), and
+    waits for all of them to finish.
+    Args
+    - target: callable, must be importable (i.e. defined at module level)
+    - args_list: list of tuple, arguments for each worker process
+    """
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=target, args=args) for args in args_list]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    failed = [i for i, p in enumerate(procs) if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f'Worker(s) {failed} exited with a non-zero exit code')
+
+
+def merge_shards(dir_path: str, filename: str, num_shards: int,
+                 wait: bool = False, poll_seconds: float = 30.0,
+                 remove: bool = True) -> None:
+    """
+    Merges the .npz shards written by data-parallel workers into a single
+    compressed `dir_path/filename`. Shards are contiguous slices of the sorted
+    items (see shard_indices()), so concatenating their rows in shard order
+    restores the order of a single-process run, whatever the number of shards.
+    Args
+    - dir_path: str, directory containing the shards
+    - filename: str, name of the merged file, shards are named by shard_filename()
+    - num_shards: int
+    - wait: bool, whether to wait for missing shards (e.g. written by other nodes)
+        instead of raising an error
+    - poll_seconds: float, how often to check for missing shards if wait=True
+    - remove: bool, whether to delete the shards after merging
+    """
+    paths = [os.path.join(dir_path, shard_filename(filename, i, num_shards))
+             for i in range(num_shards)]
+    missing = [p for p in paths if not os.path.exists(p)]
+    while len(missing) > 0:
+        if not wait:
+            raise FileNotFoundError(f'Missing shards: {missing}')
+        print(f'Waiting for {len(missing)} of {num_shards} shards in {dir_path}...')
+        time.sleep(poll_seconds)
+        missing = [p for p in paths if not os.path.exists(p)]
+
+    # empty shards (with no tiles) are saved without any arrays
+    shards = [shard for shard in (np.load(p) for p in paths) if len(shard.files) > 0]
+    merged = {key: np.concatenate([shard[key] for shard in shards])
+              for key in (shards[0].files if len(shards) > 0 else [])}
+
+    out_path = os.path.join(dir_path, filename)
+    assert not os.path.exists(out_path), f'Path {out_path} already existed!'
+    print(f'Merging {num_shards} shards into {out_path}')
+    np.savez_compressed(out_path, **merged)
+    if remove:
+        for p in paths:
+            os.remove(p)
@@ -5,12 +5,18 @@ from collections.abc import Callable, Iterable, Mapping
 from glob import glob
 import os
 from tqdm.auto import tqdm
+import time
 from typing import Any, Optional
 
 import numpy as np
 import tensorflow as tf
 
 from utils import batcher
+from utils.batcher import (
+    NUM_DIHEDRAL_VIEWS, average_views, dihedral_views, undo_dihedral_views)
+from utils.instrumentation import RunProfiler, log_filename
+from utils.mosaic import pool_mosaic_tiles
+from utils.spatial_features import SpatialFeatureWriter
 
 
 def param_to_str(p: float) -> str:
@@ -124,7 +130,10 @@ def print_number_of_parameters(verbose: bool = True) -> None:
 
 
 def run_batches(sess: tf.Session, tensors_dict_ops: Mapping[str, tf.Tensor],
-                max_nbatches: int = -1) -> dict[str, np.ndarray]:
+                max_nbatches: int = -1,
+                sinks: Optional[Mapping[str, Callable[[np.ndarray], None]]] = None,
+                profiler: Optional[RunProfiler] = None
+                ) -> dict[str, np.ndarray]:
     """
     Runs the ops in tensors_dict_ops for a fixed number of batches or until
     reaching a tf.errors.OutOfRangeError, concatenating the runs.
@@ -135,17 +144,27 @@ def run_batches(sess: tf.Session, tensors_dict_ops: Mapping[str, tf.Tensor],
     - tensors_dict_ops: dict, str => tf.Tensor, shape [batch_size] or [batch_size, D]
     - max_nbatches: int, maximum number of batches to run the ops for,
         set to -1 to run until reaching a tf.errors.OutOfRangeError
+    - sinks: dict, str => callable, for keys in sinks, each batch is passed to
+        the callable instead of being kept in memory and concatenated
+    - profiler: RunProfiler, to time each sess.run(), or None
     Returns
-    - all_tensors: dict, str => np.array, shape [N] or [N, D]
+    - all_tensors: dict, str => np.array, shape [N] or [N, D], excludes keys in sinks
     """
+    sinks = sinks or {}
     all_tensors: dict[str, Any] = defaultdict(list)
     curr_batch = 0
     progbar = tqdm(total=max_nbatches if max_nbatches > 0 else None)
     try:
         while True:
-            tensors_dict = sess.run(tensors_dict_ops)
+            if profiler is not None:
+                tensors_dict = profiler.run(sess, tensors_dict_ops)
+            else:
+                tensors_dict = sess.run(tensors_dict_ops)
             for name, arr in tensors_dict.items():
-                all_tensors[name].append(arr)
+                if name in sinks:
+                    sinks[name](arr)
+                else:
+                    all_tensors[name].append(arr)
             curr_batch += 1
             progbar.update(1)
             if curr_batch >= max_nbatches:
@@ -179,8 +198,44 @@ def save_results(dir_path: str, np_dict: dict, filename: str = 'features.npz'
     np.savez_compressed(npz_path, **np_dict)
 
 
+def append_results(dir_path: str, np_dict: dict, filename: str = 'features.npz',
+                   sort_keys: Iterable[str] = ('years', 'labels')) -> None:
+    """
+    Appends the rows of np_dict (e.g. features extracted for a newly added
+    period) to an existing .npz file in the given dir, replacing any existing
+    rows for the same years, so that re-running an update is idempotent. Creates
+    the file if it does not exist yet.
+    Args
+    - dir_path: str, path to directory containing the .npz file
+    - np_dict: dict, maps str => np.array, must have a 'years' key and the same
+        keys as the existing file
+    - filename: str, name of the .npz file
+    - sort_keys: list of str, keys to sort rows by (last key is the primary key)
+    """
+    npz_path = os.path.join(dir_path, filename)
+    if not os.path.exists(npz_path):
+        save_results(dir_path, np_dict, filename)
+        return
+
+    existing = dict(np.load(npz_path))
+    if set(existing) != set(np_dict):
+        raise ValueError(f'Keys {sorted(np_dict)} do not match the keys of {npz_path}: {sorted(existing)}')
+    keep = ~np.isin(existing['years'], np.unique(np_dict['years']))
+    print(f'Appending {len(np_dict["years"])} rows to {npz_path} '
+          f'(replacing {np.sum(~keep)} existing rows for the same years)')
+    merged = {key: np.concatenate([existing[key][keep], np_dict[key]]) for key in existing}
+    order = np.lexsort([merged[key] for key in sort_keys if key in merged])
+    merged = {key: arr[order] for key, arr in merged.items()}
+
+    # write to a temporary file and then rename, so that the existing file is
+    # never left partially written
+    tmp_path = os.path.join(dir_path, 'partial-' + filename)
+    np.savez_compressed(tmp_path, **merged)
+    os.replace(tmp_path, npz_path)
+
+
 def check_existing(model_dirs: Iterable[str], outputs_root_dir: str,
-                   test_filename: str) -> bool:
+                   test_filename: Optional[str]) -> bool:
     """
     Checks a list of model directories to ensure that they contain model
     checkpoints but not a given filename.
@@ -191,7 +246,8 @@ def check_existing(model_dirs: Iterable[str], outputs_root_dir: str,
     - model_dirs: list of str, model directories within outputs_root_dir
     - outputs_root_dir: str, path to root directory for saving logs and
         checkpoints
-    - test_filename: str, name of file to check for
+    - test_filename: str, name of file to check for, or None to only check for
+        checkpoints
     Returns: bool, True if ckpts exist and no test_filename files found,
         otherwise False
     """
@@ -206,6 +262,8 @@ def check_existing(model_dirs: Iterable[str], outputs_root_dir: str,
             print(f'did not find checkpoint matching: {ckpt_glob}')
 
         # check if test file exists
+        if test_filename is None:
+            continue
         test_path = os.path.join(model_dir, test_filename)
         if os.path.exists(test_path):
             ret = False
@@ -222,7 +280,15 @@ def run_extraction_on_models(model_dirs: Iterable[str],
                              out_root_dir: str,
                              save_filename: str,
                              batch_keys: Iterable[str] = (),
-                             feed_dict: Mapping[tf.Tensor, Any] = None
+                             feed_dict: Mapping[tf.Tensor, Any] = None,
+                             blocks_to_save: Optional[Iterable[int]] = None,
+                             save_spatial: bool = False,
+                             tta: bool = False,
+                             mosaic_grid_width: Optional[int] = None,
+                             config_proto: Optional[tf.ConfigProto] = None,
+                             instrument: bool = False,
+                             trace_batches: Optional[tuple[int, int]] = None,
+                             append: bool = False
                              ) -> None:
     """Runs feature extraction on the given models, and saves the extracted
     features as a compressed numpy .npz file.
@@ -241,25 +307,92 @@ def run_extraction_on_models(model_dirs: Iterable[str],
     - batch_keys: list of str
     - feed_dict: dict, tf.Tensor => python value, feed_dict for initializing
         batcher iterator
+    - blocks_to_save: list of int, BLOCK numbers (not LAYER numbers) whose
+        average-pooled outputs are saved alongside the final features under the
+        key 'block{k}_features', or None to only save the final features
+    - save_spatial: bool, whether to also save the non-pooled final conv layer
+        (model.spatial_features_layer) as float16 memory-mappable chunks in
+        `out_root_dir/model_dir/spatial_features/`, see utils/spatial_features.py
+    - tta: bool, whether to use test-time augmentation, i.e. run the model once on
+        the 8 dihedral flips/rotations of each batch (stacked along the batch
+        dimension) and save the average over views of every output
+    - mosaic_grid_width: int, set if the batcher is a MosaicBatcher with this
+        grid_width, in which case the CNN is run once over each whole mosaic and
+        per-tile features are pooled from the shared final conv layer, see
+        utils/mosaic.py. Saved arrays have one row per tile, as for per-tile batchers.
+    - config_proto: tf.ConfigProto, session config, e.g. to set the size of the
+        thread pools, or None to use the default config (GPU with allow_growth)
+    - instrument: bool, whether to record the latency of every sess.run() (and
+        the tf.data statistics of the batcher, if it was created with
+        instrument=True) to a JSON log next to save_filename, see utils/instrumentation.py
+    - trace_batches: tuple (start, end), if instrument, also capture a TF profiler
+        trace of each batch in [start, end) to `out_root_dir/model_dir/traces/`
+    - append: bool, whether to append the extracted rows to an existing save_filename
+        (replacing existing rows for the same years), see append_results()
     """
+    if append and save_spatial:
+        raise ValueError('save_spatial is not supported when appending')
+    if mosaic_grid_width is not None and (blocks_to_save is not None or save_spatial):
+        raise ValueError('blocks_to_save and save_spatial are not supported for mosaics')
+
     print('Building model...')
     init_iter, batch_op = batcher.get_batch()
-    model = ModelClass(batch_op['images'], **model_params)
-    tensors_dict_ops = {
-        'features': model.features_layer,
-        'preds': tf.squeeze(model.outputs)
-    }
+    if blocks_to_save is not None:
+        model_params = dict(model_params, blocks_to_save=sorted(blocks_to_save))
+
+    images = batch_op['images']
+    num_views = 1
+    if tta:
+        images = dihedral_views(images)
+        num_views = NUM_DIHEDRAL_VIEWS
+
+    def merge_views(x: tf.Tensor) -> tf.Tensor:
+        return average_views(x, num_views) if tta else x
+
+    model = ModelClass(images, **model_params)
+    if mosaic_grid_width is None:
+        tensors_dict_ops = {
+            'features': merge_views(model.features_layer),
+            'preds': tf.squeeze(merge_views(model.outputs))
+        }
+    else:
+        spatial_features = model.spatial_features_layer
+        if tta:
+            spatial_features = undo_dihedral_views(spatial_features)
+        features = pool_mosaic_tiles(merge_views(spatial_features), mosaic_grid_width)
+        fc_weights, fc_biases = model.get_final_layer_weights()
+        tensors_dict_ops = {
+            'features': features,
+            'preds': tf.squeeze(tf.nn.xw_plus_b(features, fc_weights, fc_biases))
+        }
+    if blocks_to_save is not None:
+        for block, block_features in model.block_features.items():
+            tensors_dict_ops[f'block{block}_features'] = merge_views(block_features)
+    if save_spatial:
+        spatial_features = model.spatial_features_layer
+        if tta:
+            spatial_features = undo_dihedral_views(spatial_features)
+        tensors_dict_ops['spatial_features'] = merge_views(spatial_features)
     for key in batch_keys:
         if key in batch_op:
             tensors_dict_ops[key] = batch_op[key]
+            if mosaic_grid_width is not None:
+                # [batch_size, G * G, ...] => [batch_size * G * G, ...]
+                shape = tf.concat([[-1], tf.shape(batch_op[key])[2:]], axis=0)
+                tensors_dict_ops[key] = tf.reshape(batch_op[key], shape)
+
+    stats_op = None
+    if instrument and batcher.stats_aggregator is not None:
+        stats_op = batcher.stats_aggregator.get_summary()
 
     saver = tf.train.Saver(var_list=None)
     var_init_ops = [tf.global_variables_initializer(),
                     tf.local_variables_initializer()]
 
     print('Creating session...')
-    config_proto = tf.ConfigProto()
-    config_proto.gpu_options.allow_growth = True
+    if config_proto is None:
+        config_proto = tf.ConfigProto()
+        config_proto.gpu_options.allow_growth = True
     with tf.Session(config=config_proto) as sess:
         sess.run(init_iter, feed_dict=feed_dict)
 
@@ -272,7 +405,37 @@ def run_extraction_on_models(model_dirs: Iterable[str],
             load(sess, saver, out_dir)
 
             # run the saved model, then save to *.npz files
+            sinks = {}
+            if save_spatial:
+                sinks['spatial_features'] = SpatialFeatureWriter(
+                    os.path.join(out_dir, 'spatial_features'))
+            profiler = None
+            if instrument:
+                profiler = RunProfiler(
+                    stats_op=stats_op, trace_batches=trace_batches,
+                    trace_dir=os.path.join(out_dir, 'traces'))
+            start = time.perf_counter()
             all_tensors = run_batches(
-                sess, tensors_dict_ops, max_nbatches=batches_per_epoch)
-            save_results(
-                dir_path=out_dir, np_dict=all_tensors, filename=save_filename)
+                sess, tensors_dict_ops, max_nbatches=batches_per_epoch, sinks=sinks,
+                profiler=profiler)
+            elapsed = time.perf_counter() - start
+            for sink in sinks.values():
+                sink.close()
+
+            num_tiles = len(all_tensors.get('features', []))
+            print(f'Extracted features for {num_tiles} tiles in {elapsed:.1f}s: '
+                  f'{num_tiles / elapsed:.1f} tiles/s, {num_views} view(s) per tile '
+                  f'({num_tiles * num_views / elapsed:.1f} images/s through the CNN)')
+            if append:
+                append_results(
+                    dir_path=out_dir, np_dict=all_tensors, filename=save_filename)
+            else:
+                save_results(
+                    dir_path=out_dir, np_dict=all_tensors, filename=save_filename)
+            if profiler is not None:
+                profiler.save(os.path.join(out_dir, log_filename(save_filename)), extra={
+                    'num_tiles': num_tiles,
+                    'num_views': num_views,
+                    'elapsed_seconds': elapsed,
+                    'tiles_per_second': num_tiles / elapsed,
+                })
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+import json
+import os
+from typing import Optional, Union
+
+import numpy as np
+
+
+INDEX_FILENAME = 'index.json'
+
+
+class SpatialFeatureWriter:
+    """Writes per-tile spatial (non-pooled) feature maps to a directory of
+    fixed-size float16 .npy chunks that can later be memory-mapped.
+
+    Layout of `dir_path`:
+    - chunk_00000.npy, chunk_00001.npy, ...: each of shape [n, h, w, C], where
+        n == chunk_size for every chunk except possibly the last
+    - index.json: {'dtype', 'shape', 'chunk_size', 'chunks': [[name, n], ...]}
+    """
+    def __init__(self, dir_path: str, chunk_size: int = 1024,
+                 dtype: np.dtype = np.float16):
+        """
+        Args
+        - dir_path: str, directory to save chunks to, must not already contain an index
+        - chunk_size: int, number of tiles per chunk
+        - dtype: np.dtype, storage dtype of the feature maps
+        """
+        if os.path.exists(os.path.join(dir_path, INDEX_FILENAME)):
+            raise ValueError(f'Spatial features already exist at {dir_path}')
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+
+        self.cell_shape: Optional[tuple[int, ...]] = None
+        self.chunks: list[tuple[str, int]] = []
+        self._buffer: list[np.ndarray] = []
+        self._buffered = 0
+
+    def __call__(self, batch: np.ndarray) -> None:
+        self.write(batch)
+
+    def write(self, batch: np.ndarray) -> None:
+        """
+        Args
+        - batch: np.array, shape [batch_size, h, w, C]
+        """
+        if self.cell_shape is None:
+            self.cell_shape = tuple(batch.shape[1:])
+        assert tuple(batch.shape[1:]) == self.cell_shape
+        self._buffer.append(batch.astype(self.dtype, copy=False))
+        self._buffered += len(batch)
+        while self._buffered >= self.chunk_size:
+            self._flush(self.chunk_size)
+
+    def _flush(self, n: int) -> None:
+        buf = np.concatenate(self._buffer)
+        name = f'chunk_{len(self.chunks):05d}.npy'
+        out = np.lib.format.open_memmap(
+            os.path.join(self.dir_path, name), mode='w+', dtype=self.dtype,
+            shape=(n,) + buf.shape[1:])
+        out[:] = buf[:n]
+        out.flush()
+        del out
+        self.chunks.append((name, n))
+        self._buffer = [buf[n:]] if n < len(buf) else []
+        self._buffered = len(buf) - n
+
+    def close(self) -> None:
+        """Flushes any remaining tiles and writes the index file."""
+        if self._buffered > 0:
+            self._flush(self._buffered)
+        index = {
+            'dtype': self.dtype.str,
+            'shape': [sum(n for _, n in self.chunks)] + list(self.cell_shape or ()),
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+        }
+        with open(os.path.join(self.dir_path, INDEX_FILENAME), 'w') as f:
+            json.dump(index, f)
+        print(f'Saved spatial features: shape {tuple(index["shape"])}, dtype {self.dtype} to {self.dir_path}')
+
+
+class SpatialFeatures:
+    """Read-only, memory-mapped view over a directory written by SpatialFeatureWriter."""
+    def __init__(self, dir_path: str):
+        with open(os.path.join(dir_path, INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+        self.dir_path = dir_path
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.chunks = [
+            np.load(os.path.join(dir_path, name), mmap_mode='r')
+            for name, _ in index['chunks']]
+        self.offsets = np.cumsum([0] + [len(c) for c in self.chunks])
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """Returns the [h, w, C] feature map of the i-th tile."""
+        if i < 0:
+            i += len(self)
+        c = np.searchsorted(self.offsets, i, side='right') - 1
+        return self.chunks[c][i - self.offsets[c]]
+
+    def iter_chunks(self) -> Iterator[np.ndarray]:
+        """Yields memory-mapped chunks, each of shape [n, h, w, C], in tile order."""
+        yield from self.chunks
+
+
+def predict_spatial(features: Union[SpatialFeatures, np.ndarray],
+                    weights: np.ndarray, bias: Union[float, np.ndarray]
+                    ) -> np.ndarray:
+    """Applies a linear model (e.g. the ridge weights in outputs/ridge_weights.npz)
+    to every spatial cell of every tile.
+
+    Because the final features layer is the mean over the spatial cells, the
+    mean of the returned cell predictions for a tile equals the tile-level
+    prediction (up to the storage precision of the feature maps).
+
+    Args
+    - features: SpatialFeatures or np.array of shape [N, h, w, C]
+    - weights: np.array, shape [C]
+    - bias: scalar or np.array of shape [1]
+    Returns: np.array, shape [N, h, w], type float32
+    """
+    weights = np.asarray(weights, dtype=np.float32).reshape(-1)
+    bias = np.float32(np.asarray(bias).reshape(-1)[0])
+    chunks = features.iter_chunks() if isinstance(features, SpatialFeatures) else [features]
+    preds = [
+        np.tensordot(chunk.astype(np.float32), weights, axes=([3], [0])) + bias
+        for chunk in chunks]
+    return np.concatenate(preds)
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+
+# mean Earth radius in kilometers, for great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+
+def lonlat_to_unit(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Args
+    - lon, lat: np.array, shape [N], coordinates in degrees
+    Returns: np.array, shape [N, 3], points on the unit sphere
+    """
+    lon, lat = np.radians(np.asarray(lon, dtype=np.float64)), np.radians(np.asarray(lat, dtype=np.float64))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+
+
+def haversine_km(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """
+    Returns: np.array, great-circle distances in kilometers between (lon1, lat1) and (lon2, lat2)
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    """KD-tree over locations on the unit sphere, to enumerate all pairs of
+    locations within a great-circle distance without forming the N x N matrix
+    of distances.
+
+    Great-circle distances are monotonic in chord (3-D Euclidean) distances
+    between points on the sphere, so a radius query on the chord distance
+    returns exactly the pairs within the great-circle cutoff.
+
+    Requires scipy.
+    """
+    def __init__(self, lon: np.ndarray, lat: np.ndarray):
+        """
+        Args
+        - lon, lat: np.array, shape [N], coordinates in degrees
+        """
+        from scipy.spatial import cKDTree
+
+        self.points = lonlat_to_unit(lon, lat)
+        self.tree = cKDTree(self.points)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def pairs_within(self, cutoff_km: float, other: Optional[SpatialIndex] = None
+                     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Args
+        - cutoff_km: float, maximum great-circle distance in kilometers
+        - other: SpatialIndex, to find pairs between this index and other, or None for pairs within this index
+        Returns
+        - i, j: np.array of int, indices of each pair (into this index and other), including
+            each pair in both orders and each location with itself if other is None
+        - dist_km: np.array, great-circle distance of each pair in kilometers
+        """
+        other = self if other is None else other
+        chord = 2 * np.sin(min(cutoff_km / EARTH_RADIUS_KM, np.pi) / 2)
+        pairs = self.tree.sparse_distance_matrix(other.tree, chord, output_type='ndarray')
+        i, j, d = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+        dist_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(d / 2, 0, 1))
+        return i, j, dist_km
+
+
+def deal_exposure(tile_lon: np.ndarray, tile_lat: np.ndarray, tile_years: np.ndarray,
+                  deal_lon: np.ndarray, deal_lat: np.ndarray, deal_start_years: np.ndarray,
+                  radii_km: list[float], tile_deals: Optional[np.ndarray] = None) -> dict[str, np.ndarray]:
+    """
+    Computes the exposure of each (tile, year) to the deals active in that year
+    (i.e. with a start year, e.g. year_signed, no later than the year) within
+    each radius: their number, and their distance-weighted sum, where each deal
+    is weighted by 1 - distance / radius. Only pairs of tiles and deals within
+    the largest radius are enumerated, with a SpatialIndex over the unique tile
+    locations, so this scales to all tiles of all deals.
+    Args
+    - tile_lon, tile_lat: np.array, shape [N], coordinates of the tile of each observation (e.g. tile centroids)
+    - tile_years: np.array, shape [N], year of each observation
+    - deal_lon, deal_lat: np.array, shape [D], coordinates of each deal
+    - deal_start_years: np.array, shape [D], year in which each deal became active, NaN if never
+    - radii_km: list of float, radii in kilometers
+    - tile_deals: np.array of int, shape [N], index of the deal of each observation's tile,
+        to exclude the tile's own deal, or None to include all deals
+    Returns: dict, maps 'count_{r}km' and 'weighted_{r}km' for each radius r to an np.array of shape [N]
+    """
+    from scipy import sparse
+
+    # observations of the same tile in different years share a location
+    locs, tile_codes = np.unique(np.stack([tile_lon, tile_lat], axis=1), axis=0, return_inverse=True)
+    tile_codes = tile_codes.reshape(-1)
+    tiles = SpatialIndex(locs[:, 0], locs[:, 1])
+    deals = SpatialIndex(deal_lon, deal_lat)
+    t, d, dist = tiles.pairs_within(max(radii_km), deals)
+
+    # active[d, y]: whether deal d is active in the y-th year
+    years, year_codes = np.unique(tile_years, return_inverse=True)
+    start = np.asarray(deal_start_years, dtype=np.float64)
+    active = (years[None, :] >= start[:, None]).astype(np.float64)  # NaN start years are never active
+
+    exposure = {}
+    for r in radii_km:
+        mask = dist <= r
+        for name, w in [('count', np.ones(mask.sum())), ('weighted', 1 - dist[mask] / r)]:
+            M = sparse.csr_matrix((w, (t[mask], d[mask])), shape=(len(locs), len(deal_lon)))
+            values = (M @ active)[tile_codes, year_codes]  # [N]
+            if tile_deals is not None:
+                # subtract the tile's own deal, if it is within the radius and active
+                own_w = np.asarray(M[tile_codes, tile_deals]).reshape(-1)
+                values = values - own_w * active[tile_deals, year_codes]
+            exposure[f'{name}_{r:g}km'] = values
+    return exposure
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from abc import ABCMeta, abstractmethod
+import os
+from typing import BinaryIO
+
+
+class Storage(metaclass=ABCMeta):
+    """Read-only interface to a flat store of exported files (e.g. the Earth
+    Engine export bucket), used by preprocessing/fetch_tfrecords.py.
+
+    Implementations must be safe to call from multiple threads at once.
+    """
+    @abstractmethod
+    def list(self) -> list[str]:
+        """Returns: list of str, names of all files in the store, relative to its root"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, name: str) -> BinaryIO:
+        """
+        Opens a file for streaming reads, so that it can be consumed (e.g.
+        decompressed) while it is being downloaded.
+        Returns: binary file object, to be closed by the caller
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """Storage backed by a local directory, e.g. a copy of the export bucket
+    made with `gsutil rsync`, or a directory of test files."""
+    def __init__(self, root: str):
+        if not os.path.isdir(root):
+            raise ValueError(f'Storage directory does not exist: {root}')
+        self.root = root
+
+    def list(self) -> list[str]:
+        names = []
+        for dirpath, _, filenames in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root)
+            names.extend(f if rel == '.' else os.path.join(rel, f) for f in filenames)
+        return sorted(names)
+
+    def open(self, name: str) -> BinaryIO:
+        return open(os.path.join(self.root, name), 'rb')
+
+
+class GCSStorage(Storage):
+    """Storage backed by a Google Cloud Storage bucket, optionally restricted
+    to the objects under a prefix (e.g. the EXPORT_FOLDER of export_images.py).
+
+    Requires the google-cloud-storage package and application default
+    credentials (e.g. from `gcloud auth application-default login`).
+    """
+    def __init__(self, bucket: str, prefix: str = '', chunk_size: int = 8 * 1024 * 1024):
+        from google.cloud import storage  # only needed for downloads from GCS
+
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.chunk_size = chunk_size
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket)
+
+    def list(self) -> list[str]:
+        names = []
+        for blob in self.client.list_blobs(self.bucket, prefix=self.prefix):
+            if blob.name.endswith('/'):
+                continue
+            names.append(blob.name[len(self.prefix):])
+        return sorted(names)
+
+    def open(self, name: str) -> BinaryIO:
+        # objects are served as stored (no decompressive transcoding), so .gz files arrive compressed
+        blob = self.bucket.blob(self.prefix + name)
+        return blob.open('rb', chunk_size=self.chunk_size, raw_download=True)
+
+
+def get_storage(uri: str) -> Storage:
+    """
+    Args
+    - uri: str, either 'gs://bucket/prefix' or a local directory
+    Returns: Storage
+    """
+    if uri.startswith('gs://'):
+        bucket, _, prefix = uri[len('gs://'):].partition('/')
+        return GCSStorage(bucket, prefix)
+    return LocalStorage(uri)
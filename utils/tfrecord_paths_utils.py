@@ -16,6 +16,8 @@ ROOT_DIR = os.path.dirname('/home/jordanimahori/Dissertation/msc-dissertation')
 DHS_TFRECORDS_PATH_ROOT = os.path.join(ROOT_DIR, 'data/dhs_tfrecords')
 DHSNL_TFRECORDS_PATH_ROOT = os.path.join(ROOT_DIR, 'data/dhsnl_tfrecords')
 LSMS_TFRECORDS_PATH_ROOT = os.path.join(ROOT_DIR, 'data/lsms_tfrecords')
+DHS_INCOUNTRY_FOLDS_PATH = os.path.join(ROOT_DIR, 'data/dhs_incountry_folds.pkl')
+LSMS_INCOUNTRY_FOLDS_PATH = os.path.join(ROOT_DIR, 'data/lsms_incountry_folds.pkl')
 
 
 def dhs() -> np.ndarray:
@@ -107,10 +109,7 @@ def _incountry(dataset: str, splits: Iterable[str], tfrecords_glob_path: str,
     all_tfrecord_paths = np.sort(glob(tfrecords_glob_path))
     assert len(all_tfrecord_paths) == SIZES[dataset]['all']
 
-    fold = dataset[-1]
-    with open(folds_pickle_path, 'rb') as f:
-        incountry_folds = pickle.load(f)
-        incountry_fold = incountry_folds[fold]
+    incountry_fold = incountry_fold_indices(folds_pickle_path, fold=dataset[-1])
 
     paths: dict[str, np.ndarray] = {}
     for split in splits:
@@ -123,6 +122,20 @@ def _incountry(dataset: str, splits: Iterable[str], tfrecords_glob_path: str,
     return paths
 
 
+def incountry_fold_indices(folds_pickle_path: str, fold: str) -> dict[str, np.ndarray]:
+    '''
+    Args
+    - folds_pickle_path: str, path to pickle file containing incountry folds
+    - fold: str, one of ['A', 'B', 'C', 'D', 'E']
+    Returns
+    - indices: dict, maps split (str) => np.array of int, indices into the sorted
+        TFRecord paths (i.e. the sorted clusters) of the dataset
+    '''
+    with open(folds_pickle_path, 'rb') as f:
+        incountry_folds = pickle.load(f)
+    return {split: np.asarray(indices) for split, indices in incountry_folds[fold].items()}
+
+
 def dhs_incountry(dataset: str, splits: Iterable[str]) -> dict[str, np.ndarray]:
     '''
     Args
@@ -133,10 +146,9 @@ def dhs_incountry(dataset: str, splits: Iterable[str]) -> dict[str, np.ndarray]:
     - paths: dict, maps split (str) => sorted np.array of str paths
     '''
     glob_path = os.path.join(DHS_TFRECORDS_PATH_ROOT, '*', '*.tfrecord.gz')
-    folds_pickle_path = os.path.join(ROOT_DIR, 'data/dhs_incountry_folds.pkl')
     return _incountry(dataset=dataset, splits=splits,
                       tfrecords_glob_path=glob_path,
-                      folds_pickle_path=folds_pickle_path)
+                      folds_pickle_path=DHS_INCOUNTRY_FOLDS_PATH)
 
 
 def lsms_incountry(dataset: str, splits: Iterable[str]) -> dict[str, np.ndarray]:
@@ -149,10 +161,9 @@ def lsms_incountry(dataset: str, splits: Iterable[str]) -> dict[str, np.ndarray]
     - paths: dict, maps split (str) => sorted np.array of str paths
     '''
     glob_path = os.path.join(LSMS_TFRECORDS_PATH_ROOT, '*', '*.tfrecord.gz')
-    folds_pickle_path = os.path.join(ROOT_DIR, 'data/lsms_incountry_folds.pkl')
     return _incountry(dataset=dataset, splits=splits,
                       tfrecords_glob_path=glob_path,
-                      folds_pickle_path=folds_pickle_path)
+                      folds_pickle_path=LSMS_INCOUNTRY_FOLDS_PATH)
 
 
 def lsms_pairs(indices_dict, delta_pairs_df, index_cols, other_cols=()):
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+
+# Web Mercator (EPSG:3857) sphere radius in meters
+EARTH_RADIUS = 6378137.0
+
+TILE_SIZE = 255  # side length (in pixels) of each exported tile
+
+
+def lonlat_to_mercator(lon: np.ndarray, lat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Args
+    - lon, lat: np.array, coordinates in degrees
+    Returns: (x, y), np.arrays of EPSG:3857 coordinates in meters
+    """
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def mercator_to_lonlat(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Args
+    - x, y: np.array, EPSG:3857 coordinates in meters
+    Returns: (lon, lat), np.arrays of coordinates in degrees
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def tile_offsets(nrings: int) -> np.ndarray:
+    """
+    Gets the offsets (in tiles) of each tile from the center tile of a
+    (2*nrings+1) x (2*nrings+1) grid, in row-major order starting from the
+    north-west corner, i.e. the order of tile_ids in the processed TFRecords.
+    Args
+    - nrings: int, number of concentric rings of tiles around the center tile
+    Returns: np.array, shape [(2*nrings+1)^2, 2], type int, columns are (east, north)
+    """
+    width = 2 * nrings + 1
+    rows, cols = np.divmod(np.arange(width ** 2), width)
+    return np.stack([cols - nrings, nrings - rows], axis=1)
+
+
+def tile_centroids(lon: np.ndarray, lat: np.ndarray, nrings: int, scale: float,
+                   tile_size: int = TILE_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Gets the centroids of the tiles of a grid centered on each location, where
+    tiles are tile_size x tile_size pixels that each cover `scale` meters on the
+    ground at the location's latitude (see projected_pixel_size()).
+    Args
+    - lon, lat: np.array, shape [N], coordinates of the center of each grid in degrees
+    - nrings: int, number of concentric rings of tiles around the center tile
+    - scale: float, ground pixel size in meters
+    - tile_size: int, side length of each tile in pixels
+    Returns: (lon, lat), np.arrays of shape [N, (2*nrings+1)^2], tiles in tile_id order
+    """
+    lon, lat = np.atleast_1d(lon), np.atleast_1d(lat)
+    x, y = lonlat_to_mercator(lon, lat)
+    px = projected_pixel_size(lat, scale)  # [N]
+    offsets = tile_offsets(nrings) * tile_size  # [T, 2] in pixels
+    tile_x = x[:, None] + offsets[None, :, 0] * px[:, None]
+    tile_y = y[:, None] + offsets[None, :, 1] * px[:, None]
+    return mercator_to_lonlat(tile_x, tile_y)
+
+
+def projected_pixel_size(lat: np.ndarray, scale: float) -> np.ndarray:
+    """
+    Gets the EPSG:3857 pixel size at each latitude that covers `scale` meters on
+    the ground, i.e. scale times the Mercator scale factor sec(lat).
+    Args
+    - lat: np.array, latitudes in degrees
+    - scale: float, ground pixel size in meters
+    Returns: np.array, pixel size in EPSG:3857 meters
+    """
+    return scale / np.cos(np.radians(np.asarray(lat, dtype=np.float64)))
+
+
+def export_region(lon: float, lat: float, nrings: int, scale: float,
+                  tile_size: int = TILE_SIZE) -> tuple[list[float], list[float]]:
+    """
+    Gets a pixel-aligned EPSG:3857 export region for the grid of tiles around a
+    location, whose pixels cover `scale` meters on the ground at its latitude, so
+    that exactly (2*nrings+1)^2 tiles of tile_size x tile_size pixels are exported
+    at any latitude.
+    Args
+    - lon, lat: float, center of the grid in degrees
+    - nrings: int, number of concentric rings of tiles around the center tile
+    - scale: float, ground pixel size in meters
+    - tile_size: int, side length of each tile in pixels
+    Returns
+    - bounds: list [xmin, ymin, xmax, ymax] in EPSG:3857 meters, inset by a quarter
+        pixel from the pixel grid so that no partial pixels are included
+    - crs_transform: list [px, 0, x0, 0, -px, y0], affine transform of the pixel grid,
+        where (x0, y0) is the north-west corner of the grid
+    """
+    x, y = lonlat_to_mercator(lon, lat)
+    px = float(projected_pixel_size(lat, scale))
+    half_width = (2 * nrings + 1) * tile_size * px / 2
+    x0, y0 = float(x) - half_width, float(y) + half_width
+    inset = px / 4
+    bounds = [x0 + inset, y0 - 2 * half_width + inset, x0 + 2 * half_width - inset, y0 - inset]
+    crs_transform = [px, 0.0, x0, 0.0, -px, y0]
+    return bounds, crs_transform
+
+
+def predict_tile_counts(lat: np.ndarray, nrings: int, scale: float, aligned: bool = True,
+                        tile_size: int = TILE_SIZE, lon: np.ndarray = None) -> np.ndarray:
+    """
+    Predicts the number of full tiles Earth Engine exports for each location,
+    assuming that only full tile_size x tile_size patches are exported.
+    Args
+    - lat: np.array, latitudes of the locations in degrees
+    - nrings: int, number of concentric rings of tiles around the center tile
+    - scale: float, ground pixel size in meters
+    - aligned: bool, True for regions from export_region(), False for the legacy
+        regions of `buffer(7700 * (nrings + 0.5)).bounds()` exported at `scale`
+        meters per pixel in the default (EPSG:4326) projection
+    - tile_size: int, side length of each tile in pixels
+    - lon: np.array, longitudes of the locations in degrees, to count the tiles in
+        the aligned region of each location (at longitude 0 if None)
+    Returns: np.array of int, predicted number of tiles for each location
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    if aligned:
+        lon = np.zeros_like(lat) if lon is None else np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        counts = []
+        for lo, la in zip(lon, lat):
+            (xmin, ymin, xmax, ymax), (px, _, x0, _, _, y0) = export_region(lo, la, nrings, scale, tile_size)
+            # pixels whose centers fall inside the region
+            num_x = np.floor((xmax - x0) / px - 0.5) - np.ceil((xmin - x0) / px - 0.5) + 1
+            num_y = np.floor((y0 - ymin) / px - 0.5) - np.ceil((y0 - ymax) / px - 0.5) + 1
+            counts.append((num_x // tile_size) * (num_y // tile_size))
+        return np.asarray(counts, dtype=np.int64)
+
+    # legacy: a box of 2 * 7700 * (nrings + 0.5) ground meters, whose width in degrees of longitude grows with
+    # sec(lat), exported with pixels of `scale` meters measured at the equator
+    width_m = 2 * 7700 * (nrings + 0.5)
+    num_y = np.floor(width_m / scale)
+    num_x = np.floor(width_m / (scale * np.cos(np.radians(lat))))
+    return ((num_x // tile_size) * (num_y // tile_size)).astype(np.int64)
+
+
+def grid_zones(lat: np.ndarray, zone_deg: float) -> np.ndarray:
+    """
+    Args
+    - lat: np.array, latitudes in degrees
+    - zone_deg: float, height of each zone in degrees of latitude
+    Returns: np.array of int, index of the latitude zone of each location
+    """
+    return np.floor(np.asarray(lat, dtype=np.float64) / zone_deg).astype(np.int64)
+
+
+def zone_pixel_size(zones: np.ndarray, zone_deg: float, scale: float) -> np.ndarray:
+    """
+    Returns: np.array, EPSG:3857 pixel size of each zone, that covers `scale` ground meters at the zone's center
+    """
+    return projected_pixel_size((np.asarray(zones) + 0.5) * zone_deg, scale)
+
+
+def plan_tiles(deal_ids: np.ndarray, lon: np.ndarray, lat: np.ndarray, nrings: int, scale: float,
+               zone_deg: float = 1.0, tile_size: int = TILE_SIZE) -> pd.DataFrame:
+    """
+    Plans the tiles of every deal on a global grid, so that deals whose grids
+    overlap share their overlapping tiles, which then only need to be exported
+    and run through the CNN once.
+
+    The globe is divided into latitude zones of zone_deg degrees. Within each
+    zone, tiles are cells of a global EPSG:3857 grid of tile_size pixels whose
+    size covers `scale` ground meters at the zone's center latitude (so the ground
+    pixel size is within a fraction of a percent of `scale` across the zone), with
+    cell centers on pixel centers. The center tile of each deal is the cell that
+    contains the deal, and its (2*nrings+1)^2 tiles are the cells around it, so
+    each deal's grid is shifted by up to half a tile from being centered on the
+    deal. Tiles are identified by their (zone, column, row) on the grid, and one
+    (deal_id, tile_id) referencing each unique tile is chosen as its canonical tile.
+    Tiles of deals in different zones are never shared, even if they overlap.
+    Args
+    - deal_ids: np.array, shape [D], id of each deal
+    - lon, lat: np.array, shape [D], coordinates of each deal in degrees
+    - nrings: int, number of concentric rings of tiles around the center tile
+    - scale: float, ground pixel size in meters
+    - zone_deg: float, height of each latitude zone in degrees
+    - tile_size: int, side length of each tile in pixels, must be odd
+    Returns: pd.DataFrame, one row per (deal_id, tile_id) in tile_id order, with columns
+        deal_id, tile_id, level (ring of the tile), zone, col, row, pixel_size (EPSG:3857
+        meters), lon, lat (tile centroid), canonical_deal_id and canonical_tile_id
+    """
+    deal_ids = np.asarray(deal_ids)
+    zones = grid_zones(lat, zone_deg)
+    px = zone_pixel_size(zones, zone_deg, scale)
+    x, y = lonlat_to_mercator(lon, lat)
+    width = tile_size * px  # [D]
+
+    # cell (c, r) covers [(c * tile_size - tile_size // 2) * px, ...), so that its center is on a pixel center
+    center_col = np.floor(x / width - 0.5 / tile_size + 0.5).astype(np.int64)
+    center_row = np.floor(y / width - 0.5 / tile_size + 0.5).astype(np.int64)
+    offsets = tile_offsets(nrings)  # [T, 2]
+    num_tiles = len(offsets)
+
+    plan = pd.DataFrame({
+        'deal_id': np.repeat(deal_ids, num_tiles),
+        'tile_id': np.tile(np.arange(num_tiles), len(deal_ids)),
+        'level': np.tile(np.abs(offsets).max(axis=1), len(deal_ids)),
+        'zone': np.repeat(zones, num_tiles),
+        'col': (center_col[:, None] + offsets[None, :, 0]).reshape(-1),
+        'row': (center_row[:, None] + offsets[None, :, 1]).reshape(-1),
+        'pixel_size': np.repeat(px, num_tiles),
+    })
+    tile_x = (plan['col'].to_numpy() * tile_size + 0.5) * plan['pixel_size'].to_numpy()
+    tile_y = (plan['row'].to_numpy() * tile_size + 0.5) * plan['pixel_size'].to_numpy()
+    plan['lon'], plan['lat'] = mercator_to_lonlat(tile_x, tile_y)
+
+    # spatial hash of the grid cells: the first (deal_id, tile_id) referencing each cell is its canonical tile
+    first = plan.groupby(['zone', 'col', 'row'], sort=False)[['deal_id', 'tile_id']].transform('first')
+    plan['canonical_deal_id'] = first['deal_id']
+    plan['canonical_tile_id'] = first['tile_id']
+    return plan
+
+
+def planned_tile_locations(plan: pd.DataFrame, deal_ids: np.ndarray, tile_ids: np.ndarray
+                           ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Looks up the planned tiles of a tile plan, whose centroids are snapped to the
+    global grid rather than centered on their deal as in tile_centroids().
+    Args
+    - plan: pd.DataFrame, tile plan from plan_tiles()
+    - deal_ids, tile_ids: np.array, shape [N], (deal_id, tile_id) of each tile to look up
+    Returns
+    - lon, lat: np.array, shape [N], coordinates of the centroid of each tile in degrees
+    - pixel_size: np.array, shape [N], EPSG:3857 pixel size of each tile in meters
+    """
+    index = pd.MultiIndex.from_arrays([plan['deal_id'].to_numpy(dtype=np.int64),
+                                       plan['tile_id'].to_numpy(dtype=np.int64)])
+    rows = index.get_indexer(pd.MultiIndex.from_arrays([np.asarray(deal_ids, dtype=np.int64),
+                                                        np.asarray(tile_ids, dtype=np.int64)]))
+    if np.any(rows < 0):
+        missing = sorted(set(np.asarray(deal_ids)[rows < 0].tolist()))
+        raise ValueError(f'{np.sum(rows < 0)} tiles of deals {missing} are not in the tile plan')
+    return (plan['lon'].to_numpy()[rows], plan['lat'].to_numpy()[rows], plan['pixel_size'].to_numpy()[rows])
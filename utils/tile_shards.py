@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+import csv
+from glob import glob
+import os
+import re
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+# processed tiles can be written to multi-tile shards named '{key}_{seq:04d}.tfrecord.gz',
+# where key is the deal_id or year of the shard, listed in an index of every tile
+SHARD_FILENAME_RE = re.compile(r'^(\w+)_(\d{4})\.tfrecord(\.gz)?$')
+INDEX_FILENAME = 'shard_index.csv'
+INDEX_COLUMNS = ['shard', 'record', 'deal_id', 'year', 'tile_id']
+
+PARTIAL_SUFFIX = '.partial'
+
+
+class _OpenShard:
+    def __init__(self, path: str):
+        import tensorflow as tf
+
+        self.path = path
+        self.writer = tf.io.TFRecordWriter(path + PARTIAL_SUFFIX)
+        self.num_bytes = 0
+        self.rows: list[tuple[int, int, int]] = []  # (deal_id, year, tile_id) of each record
+
+
+class ShardWriterPool:
+    """Writes processed tiles to multi-tile TFRecord shards instead of one file
+    per tile, keeping a bounded number of shard writers open at once.
+
+    Each key (e.g. a deal_id or a year) is written to its own sequence of
+    shards. Records are written to '{name}.partial' files, which are only
+    renamed to their final name when the shard is closed, so a crash never
+    leaves an incomplete file that looks like a complete shard. The tiles in
+    each closed shard are then appended to the shard index (INDEX_FILENAME),
+    which is how readers find tiles, so a shard is only visible once complete.
+
+    A shard is closed (and the next one for its key started) once it reaches
+    max_bytes, or when it is the least recently used of more than max_open
+    writers. Shards are only closed after a multiple of group_size records, so
+    that the tiles of a (deal_id, year) mosaic are never split across shards.
+
+    Usage:
+        with ShardWriterPool(shard_dir) as pool:
+            pool.write(year, record, deal_id, year, tile_id)
+    """
+    def __init__(self, output_dir: str, max_open: int = 16, max_bytes: int = 256 * 1024 * 1024,
+                 group_size: int = 25):
+        """
+        Args
+        - output_dir: str, directory in which to save the shards and the index
+        - max_open: int, maximum number of shard writers kept open at once
+        - max_bytes: int, approximate maximum size of each shard
+        - group_size: int, number of consecutive records written together for each key
+            that must not be split across shards, i.e. the number of tiles per mosaic
+        """
+        if max_open < 1:
+            raise ValueError(f'got {max_open} for "max_open"')
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.group_size = group_size
+        self.index_path = os.path.join(output_dir, INDEX_FILENAME)
+
+        self.open_shards: OrderedDict[Hashable, _OpenShard] = OrderedDict()  # in least recently used order
+        self.next_seq: dict[str, int] = {}
+        for path in glob(os.path.join(output_dir, '*.tfrecord*')):
+            match = SHARD_FILENAME_RE.match(os.path.basename(path))
+            if match is not None:
+                key, seq = match.group(1), int(match.group(2))
+                self.next_seq[key] = max(self.next_seq.get(key, 0), seq + 1)
+        self.num_shards_written = 0
+
+    def write(self, key: Hashable, record: bytes, deal_id: int, year: int, tile_id: int) -> None:
+        """
+        Args
+        - key: deal_id or year of the shard to write to, must be a str or int
+        - record: bytes, a serialized tf.train.Example
+        - deal_id, year, tile_id: int, identify the tile in the shard index
+        """
+        shard = self.open_shards.get(key)
+        if shard is None:
+            shard = self._open(key)
+        else:
+            self.open_shards.move_to_end(key)
+        shard.writer.write(record)
+        shard.num_bytes += len(record) + 16  # length, CRCs and record
+        shard.rows.append((deal_id, year, tile_id))
+
+        if shard.num_bytes >= self.max_bytes and self._at_group_boundary(shard):
+            self._close(key)
+
+    def close(self) -> None:
+        """Closes all open shards, renaming them and adding them to the index."""
+        for key in list(self.open_shards):
+            self._close(key)
+
+    def abort(self) -> None:
+        """Closes all open shards without finalizing them, removing their partial files."""
+        for shard in self.open_shards.values():
+            shard.writer.close()
+            os.remove(shard.path + PARTIAL_SUFFIX)
+        self.open_shards.clear()
+
+    def __enter__(self) -> ShardWriterPool:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _at_group_boundary(self, shard: _OpenShard) -> bool:
+        return len(shard.rows) % self.group_size == 0
+
+    def _open(self, key: Hashable) -> _OpenShard:
+        if len(self.open_shards) >= self.max_open:
+            # evict the least recently used shard that does not end in the middle of a group
+            for lru_key, lru_shard in self.open_shards.items():
+                if self._at_group_boundary(lru_shard):
+                    self._close(lru_key)
+                    break
+        name = str(key)
+        seq = self.next_seq.get(name, 0)
+        self.next_seq[name] = seq + 1
+        shard = _OpenShard(os.path.join(self.output_dir, f'{name}_{seq:04d}.tfrecord.gz'))
+        self.open_shards[key] = shard
+        return shard
+
+    def _close(self, key: Hashable) -> None:
+        shard = self.open_shards.pop(key)
+        shard.writer.close()
+        os.replace(shard.path + PARTIAL_SUFFIX, shard.path)
+
+        write_header = not os.path.exists(self.index_path)
+        with open(self.index_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(INDEX_COLUMNS)
+            name = os.path.basename(shard.path)
+            writer.writerows((name, r, *row) for r, row in enumerate(shard.rows))
+        self.num_shards_written += 1
+
+
+def load_shard_index(shard_dir: str) -> pd.DataFrame:
+    """
+    Loads the index of the tiles in the shards written by ShardWriterPool.
+    Args
+    - shard_dir: str, directory containing the shards and INDEX_FILENAME
+    Returns: pd.DataFrame with columns INDEX_COLUMNS, plus 'path' (the full path
+        to each shard), in the order in which shards were written
+    """
+    index = pd.read_csv(os.path.join(shard_dir, INDEX_FILENAME))
+    index['path'] = [os.path.join(shard_dir, shard) for shard in index['shard']]
+    return index
+
+
+def select_shards(index: pd.DataFrame, years: Optional[Iterable[int]] = None,
+                  group_size: Optional[int] = None) -> tuple[list[str], np.ndarray]:
+    """
+    Selects the shards to read from a shard index.
+    Args
+    - index: pd.DataFrame, from load_shard_index()
+    - years: list of int, only select shards of these years, or None to select all
+        shards. Raises a ValueError if a selected shard also contains other years,
+        i.e. unless tiles were sharded by year.
+    - group_size: int, if given, check that every shard consists of complete
+        groups (mosaics) of group_size consecutive tiles of the same (deal_id, year)
+        in tile_id order, as needed by MosaicBatcher
+    Returns
+    - paths: list of str, paths to the selected shards, in the order they were written
+    - num_records: np.array of int, number of tiles in each selected shard
+    """
+    if years is not None:
+        in_years = index['year'].isin(set(years))
+        by_shard = in_years.groupby(index['path'], sort=False)
+        mixed = by_shard.any() & ~by_shard.all()
+        if mixed.any():
+            raise ValueError(f'{mixed.sum()} shards contain tiles of several years, '
+                             f'only tiles sharded by year can be selected by year')
+        index = index[in_years]
+
+    if group_size is not None:
+        record = index['record'].to_numpy()
+        group = index[['path', 'deal_id', 'year']].to_numpy()
+        starts = record % group_size == 0
+        valid = (len(index) % group_size == 0) and np.all(index['tile_id'].to_numpy() == record % group_size)
+        if valid and len(index) > 0:
+            first = np.repeat(group[starts], group_size, axis=0)
+            valid = first.shape == group.shape and bool(np.all(first == group))
+        if not valid:
+            raise ValueError(f'Shards must consist of complete groups of {group_size} tiles in tile_id order')
+
+    counts = index.groupby('path', sort=False).size()
+    return counts.index.tolist(), counts.to_numpy()